@@ -12,9 +12,10 @@ from flask_alembic import alembic_script
 from flask_script import Manager, Command, Option, Server
 from orlo.exceptions import OrloStartupError
 
+import orlo.cache
 from orlo.config import config
-from orlo.app import app, OrloApplication, alembic
-from orlo.orm import db
+from orlo.app import app, OrloApplication, alembic, log_queue
+from orlo.orm import db, refresh_current_versions
 
 
 __author__ = 'alforbes'
@@ -69,6 +70,7 @@ class Start(Command):
             console else '-',
             'loglevel': loglevel or config.get('logging', 'level'),
             'on_starting': on_starting,
+            'post_fork': post_fork,
             'workers': workers or config.get('gunicorn', 'workers'),
         }
         try:
@@ -93,9 +95,24 @@ class WriteConfig(Command):
         config.write(config_file)
 
 
+class RebuildVersions(Command):
+    """
+    Rebuild the current_version table from the package table
+    """
+
+    def run(self):
+        """ Rebuild current versions """
+        with app.app_context():
+            refresh_current_versions(db.session)
+            db.session.commit()
+            # Cached responses of /info/packages/versions are now stale
+            orlo.cache.bump_generation()
+
+
 script_manager = Manager(app)
 script_manager.add_command('db', alembic_script)
 script_manager.add_command('start', Start)
+script_manager.add_command('rebuild_versions', RebuildVersions)
 
 
 def on_starting(server):
@@ -103,6 +120,12 @@ def on_starting(server):
     check_database()
 
 
+def post_fork(server, worker):
+    # The log queue's thread does not survive the fork
+    if log_queue:
+        log_queue.start()
+
+
 def stamp_initial_revision():
     """ Stamp the database with the initial revision """
     app.logger.warning("*** Stamping the database with the initial revision. \
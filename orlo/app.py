@@ -1,12 +1,18 @@
 from __future__ import print_function
 
+import atexit
 import os
 import logging
 import gunicorn.app.base
 from gunicorn.six import iteritems
+from six.moves import queue
 
 from logging import Formatter
 from logging.handlers import RotatingFileHandler
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # Python 2
+    QueueHandler = QueueListener = None
 
 from flask import Flask
 from flask_alembic import Alembic
@@ -19,6 +25,46 @@ __author__ = 'alforbes'
 
 app = Flask(__name__)
 
+
+class LogQueue(object):
+    """
+    Hand log records to a thread which passes them to the real handlers, so
+    that logging does not block on disk I/O
+
+    Threads do not survive a fork, so each gunicorn worker calls start()
+    after forking, see orlo.__main__.
+    """
+
+    def __init__(self, *handlers):
+        self.handlers = handlers
+        self.handler = QueueHandler(queue.Queue(-1))
+        self.listener = None
+        self.pid = None
+
+    def start(self):
+        """
+        Start the listener thread, once per process
+        """
+        if self.pid == os.getpid():
+            return
+        # Records queued before a fork belong to the parent
+        self.handler.queue = queue.Queue(-1)
+        self.listener = QueueListener(
+            self.handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def stop(self):
+        """
+        Stop the listener thread, after it has handled the queued records
+        """
+        if self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+
+
+log_queue = None
+
 alembic = Alembic()
 alembic.init_app(app)
 
@@ -70,14 +116,20 @@ if not app.debug:
     if log_dir != 'disabled':
         file_handler = RotatingFileHandler(
             logfile,
-            maxBytes=1048576,
-            backupCount=1,
+            maxBytes=config.getint('logging', 'max_bytes'),
+            backupCount=config.getint('logging', 'backup_count'),
         )
 
         file_handler.setFormatter(formatter)
         file_handler.setLevel(logging.DEBUG)
 
-        app.logger.addHandler(file_handler)
+        if config.getboolean('logging', 'queue') and QueueHandler:
+            log_queue = LogQueue(file_handler)
+            log_queue.start()
+            atexit.register(log_queue.stop)
+            app.logger.addHandler(log_queue.handler)
+        else:
+            app.logger.addHandler(file_handler)
 
 
 class OrloApplication(gunicorn.app.base.BaseApplication):
@@ -108,5 +160,6 @@ app.logger.debug("Log level: {}".format(config.get('logging', 'level')))
 # Must be imported last
 
 import orlo.error_handlers
+import orlo.instrumentation
 import orlo.routes
 import orlo.user_auth
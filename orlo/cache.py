@@ -0,0 +1,290 @@
+from __future__ import print_function
+import arrow
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, request, make_response, Response
+from six.moves.urllib.parse import urlencode
+from sqlalchemy import exc
+
+from orlo.app import app
+from orlo.config import config, get_settings
+from orlo.exceptions import OrloError
+from orlo.orm import db, write_generation
+
+__author__ = 'alforbes'
+
+"""
+Caching of responses to read-only endpoints
+
+Cached responses are keyed on the write generation, a counter in the database
+which the write routes increase. Bumping the generation makes every cached
+response unreachable, and they age out of the cache. The generation is also
+used as the ETag of responses, see conditional_response.
+"""
+
+
+class CacheBackend(object):
+    """
+    Interface for cache backends
+
+    Values are strings.
+    """
+
+    def get(self, key):
+        """
+        Return the value stored for key, or None if there isn't one
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """
+        Store value for key
+
+        :param string key:
+        :param string value:
+        :param int ttl: Seconds after which the value expires
+        """
+        raise NotImplementedError
+
+
+class LocalCache(CacheBackend):
+    """
+    In-process least recently used cache with expiry
+
+    Each process has its own cache, so with several gunicorn workers a
+    response may be computed once per worker.
+    """
+
+    def __init__(self, max_entries=1000, clock=time.time):
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= self.clock():
+                return None
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, self.clock() + ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisCache(CacheBackend):
+    """
+    Cache shared between processes, stored in redis
+
+    :param client: A redis.StrictRedis, or anything with the same get and set
+        methods
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            import redis
+        except ImportError:
+            raise OrloError(
+                "The redis cache backend requires the redis package")
+        return cls(redis.StrictRedis.from_url(url))
+
+    def get(self, key):
+        value = self.client.get(key)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return value
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=ttl)
+
+
+backend = None
+
+
+def get_backend():
+    """
+    Return the configured cache backend, creating it on first use
+    """
+    global backend
+    if backend is None:
+        name = config.get('cache', 'backend')
+        if name == 'local':
+            backend = LocalCache(config.getint('cache', 'max_entries'))
+        elif name == 'redis':
+            backend = RedisCache.from_url(config.get('cache', 'redis_url'))
+        else:
+            raise OrloError("Unknown cache backend {}".format(name))
+    return backend
+
+
+def generation_info():
+    """
+    Return the write generation and when it was last bumped
+
+    This is only read once per request.
+
+    :return: Tuple of (generation, Arrow or None)
+    """
+    if 'write_generation' not in g:
+        query = db.select([write_generation.c.value,
+                           write_generation.c.modified]) \
+            .where(write_generation.c.id == 1)
+        row = db.session.execute(query).first()
+        g.write_generation = (row.value, row.modified) if row else (0, None)
+    return g.write_generation
+
+
+@app.teardown_request
+def forget_generation(exception=None):
+    """
+    Forget the generation read during the request
+
+    The application context may outlive the request, e.g. in tests.
+    """
+    g.pop('write_generation', None)
+
+
+def current_generation():
+    """
+    Return the write generation
+    """
+    return generation_info()[0]
+
+
+def bump_generation():
+    """
+    Increase the write generation, invalidating cached responses
+
+    This commits, call it after committing the write.
+    """
+    modified = arrow.utcnow()
+    update = write_generation.update() \
+        .where(write_generation.c.id == 1) \
+        .values(value=write_generation.c.value + 1, modified=modified)
+    if db.session.execute(update).rowcount == 0:
+        try:
+            db.session.execute(write_generation.insert().values(
+                id=1, value=1, modified=modified))
+        except exc.IntegrityError:
+            # Another process inserted it
+            db.session.rollback()
+            db.session.execute(update)
+    db.session.commit()
+    g.pop('write_generation', None)
+
+
+def cache_key(generation):
+    """
+    Return the cache key for the current request
+
+    The query arguments are sorted, so their order doesn't matter.
+    """
+    args = sorted((k, sorted(v)) for k, v in request.args.lists())
+    return 'orlo:{}:{}?{}'.format(
+        generation, request.path, urlencode(args, doseq=True))
+
+
+def cached_response(func):
+    """
+    Decorator to cache the responses of a read-only view
+
+    Only 200 responses are cached.
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        settings = get_settings()
+        if not settings.cache_enabled:
+            return func(*args, **kwargs)
+
+        cache = get_backend()
+        key = cache_key(current_generation())
+        cached = cache.get(key)
+        if cached is not None:
+            app.logger.debug("Cache hit for {}".format(key))
+            cached = json.loads(cached)
+            return Response(cached['body'], status=cached['status'],
+                            mimetype=cached['mimetype'])
+
+        response = make_response(func(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            cache.set(key, json.dumps({
+                'body': response.get_data(as_text=True),
+                'status': response.status_code,
+                'mimetype': response.mimetype,
+            }), settings.cache_ttl)
+        return response
+    return wrapped
+
+
+def conditional_response(func):
+    """
+    Decorator to answer conditional GETs of a read-only view
+
+    Responses have a weak ETag of the write generation, and a Last-Modified
+    of when it was bumped. If the client already has the current generation,
+    304 is returned without calling the view.
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        if not get_settings().conditional_requests:
+            return func(*args, **kwargs)
+
+        generation, modified = generation_info()
+        etag = str(generation)
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since and modified:
+            # HTTP dates have a resolution of one second
+            not_modified = \
+                modified.floor('second') <= arrow.get(request.if_modified_since)
+        else:
+            not_modified = False
+
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag, weak=True)
+        if modified:
+            response.last_modified = modified.datetime
+        return response
+    return wrapped
+
+
+def invalidates_cache(func):
+    """
+    Decorator for views which write, to bump the write generation when they
+    succeed
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        response = make_response(func(*args, **kwargs))
+        if response.status_code < 400:
+            bump_generation()
+        return response
+    return wrapped
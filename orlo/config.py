@@ -1,4 +1,5 @@
 from __future__ import print_function
+from collections import namedtuple
 import os
 from six.moves.configparser import RawConfigParser
 
@@ -21,7 +22,55 @@ for var, default in defaults.items():
 if os.environ.get('READTHEDOCS', None) == 'True':
     defaults['ORLO_LOGDIR'] = 'disabled'
 
-config = RawConfigParser()
+
+
+class OrloConfigParser(RawConfigParser):
+    """
+    RawConfigParser which counts changes, so get_settings knows when to parse
+
+    The count goes up after each change, so that get_settings can not keep
+    settings parsed part way through one.
+    """
+    version = 0
+
+    def changed(self, method, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.version += 1
+
+    def set(self, section, option, value=None):
+        return self.changed(RawConfigParser.set, section, option, value)
+
+    def remove_option(self, section, option):
+        return self.changed(RawConfigParser.remove_option, section, option)
+
+    def remove_section(self, section):
+        return self.changed(RawConfigParser.remove_section, section)
+
+    def read(self, filenames, *args, **kwargs):
+        return self.changed(RawConfigParser.read, filenames, *args, **kwargs)
+
+    # Removed in python 3.12
+    if hasattr(RawConfigParser, 'readfp'):
+        def readfp(self, fp, *args, **kwargs):
+            return self.changed(RawConfigParser.readfp, fp, *args, **kwargs)
+
+    # Python 3 only
+    if hasattr(RawConfigParser, 'read_file'):
+        def read_file(self, f, *args, **kwargs):
+            return self.changed(RawConfigParser.read_file, f, *args, **kwargs)
+
+        def read_string(self, string, *args, **kwargs):
+            return self.changed(
+                RawConfigParser.read_string, string, *args, **kwargs)
+
+        def read_dict(self, dictionary, *args, **kwargs):
+            return self.changed(
+                RawConfigParser.read_dict, dictionary, *args, **kwargs)
+
+
+config = OrloConfigParser()
 
 config.add_section('main')
 config.set('main', 'time_format', '%Y-%m-%dT%H:%M:%SZ')
@@ -42,11 +91,21 @@ config.set('security', 'token_ttl', '3600')
 config.set('security', 'ldap_server', 'localhost.localdomain')
 config.set('security', 'ldap_port', '389')
 config.set('security', 'user_base_dn', 'ou=people,ou=example,o=test')
+config.set('security', 'auth_cache_ttl', '300')
+config.set('security', 'auth_cache_size', '1000')
+config.set('security', 'ldap_pool_size', '10')
+config.set('security', 'ldap_timeout', '5')
+config.set('security', 'ldap_check_interval', '60')
+config.set('security', 'ldap_failure_ttl', '30')
 
 config.add_section('db')
 config.set('db', 'uri', 'sqlite://')
 config.set('db', 'echo_queries', 'false')
 config.set('db', 'pool_size', '50')
+config.set('db', 'explain', 'false')
+config.set('db', 'query_stats', 'false')
+config.set('db', 'warn_queries', '0')
+config.set('db', 'warn_ms', '0')
 
 config.add_section('flask')
 config.set('flask', 'propagate_exceptions', 'true')
@@ -60,8 +119,102 @@ config.set('logging', 'format', '%(asctime)s [%(name)s] %(levelname)s %('
                                 'message)s')
 config.set('logging', 'directory', defaults['ORLO_LOGDIR'])  # "disabled" for no
                                                              # log files
+config.set('logging', 'max_bytes', '10485760')
+config.set('logging', 'backup_count', '5')
+config.set('logging', 'queue', 'true')
+config.set('logging', 'request_sample_rate', '1.0')
+config.set('logging', 'request_body_max', '4096')
+
+config.add_section('import')
+config.set('import', 'batch_size', '1000')
+
+config.add_section('cache')
+config.set('cache', 'enabled', 'false')
+config.set('cache', 'backend', 'local')
+config.set('cache', 'ttl', '60')
+config.set('cache', 'max_entries', '1000')
+config.set('cache', 'redis_url', 'redis://localhost:6379/0')
+config.set('cache', 'conditional_requests', 'true')
 
 config.add_section('behaviour')
 config.set('behaviour', 'versions_by_release', 'false')
 
 config.read(defaults['ORLO_CONFIG'])
+
+
+class Settings(namedtuple('Settings', [
+        'time_format',
+        'time_zone',
+        'security_enabled',
+        'secret_key',
+        'passwd_file',
+        'token_ttl',
+        'auth_cache_ttl',
+        'ldap_failure_ttl',
+        'user_base_dn',
+        'explain',
+        'query_stats',
+        'warn_queries',
+        'warn_ms',
+        'request_sample_rate',
+        'request_body_max',
+        'cache_enabled',
+        'cache_ttl',
+        'conditional_requests',
+        'versions_by_release',
+])):
+    """
+    Typed, read only copy of the options which are read on every request
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, parser):
+        """
+        Parse the options from a config parser
+
+        :param RawConfigParser parser: Config to read
+        """
+        return cls(
+            time_format=parser.get('main', 'time_format'),
+            time_zone=parser.get('main', 'time_zone'),
+            security_enabled=parser.getboolean('security', 'enabled'),
+            secret_key=parser.get('security', 'secret_key'),
+            passwd_file=parser.get('security', 'passwd_file'),
+            token_ttl=parser.getint('security', 'token_ttl'),
+            auth_cache_ttl=parser.getint('security', 'auth_cache_ttl'),
+            ldap_failure_ttl=parser.getint('security', 'ldap_failure_ttl'),
+            user_base_dn=parser.get('security', 'user_base_dn'),
+            explain=parser.getboolean('db', 'explain'),
+            query_stats=parser.getboolean('db', 'query_stats'),
+            warn_queries=parser.getint('db', 'warn_queries'),
+            warn_ms=parser.getfloat('db', 'warn_ms'),
+            request_sample_rate=parser.getfloat(
+                'logging', 'request_sample_rate'),
+            request_body_max=parser.getint('logging', 'request_body_max'),
+            cache_enabled=parser.getboolean('cache', 'enabled'),
+            cache_ttl=parser.getint('cache', 'ttl'),
+            conditional_requests=parser.getboolean(
+                'cache', 'conditional_requests'),
+            versions_by_release=parser.getboolean(
+                'behaviour', 'versions_by_release'),
+        )
+
+
+_settings = (None, None)
+
+
+def get_settings():
+    """
+    Return the Settings of the current config
+
+    The config is only parsed again after it has been changed, e.g. by
+    config.set in tests.
+    """
+    global _settings
+    version, settings = _settings
+    if version != config.version:
+        version = config.version
+        settings = Settings.from_config(config)
+        _settings = (version, settings)
+    return settings
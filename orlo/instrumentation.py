@@ -0,0 +1,175 @@
+from __future__ import print_function, division
+from contextlib import contextmanager
+from timeit import default_timer
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from orlo.app import app
+from orlo.config import get_settings
+
+__author__ = 'alforbes'
+
+"""
+Count and time the SQL statements executed by each request
+
+Enabled with query_stats under [db]. The totals are sent in a Server-Timing
+header and logged, with a warning when a request goes over warn_queries or
+warn_ms.
+
+Statements executed while a streamed response is being sent happen after the
+headers have gone, so are not counted.
+"""
+
+
+class QueryStats(object):
+    """
+    Statements executed during a request
+    """
+
+    def __init__(self, record=False):
+        """
+        :param bool record: Keep each statement and its parameters in
+            statements, e.g. for orlo.queries.explain_query
+        """
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        self.statements = [] if record else None
+
+    def add(self, statement, seconds, parameters=None):
+        """
+        Record a statement
+
+        :param string statement: SQL executed
+        :param float seconds: Time taken
+        :param parameters: Parameters of the statement
+        """
+        self.count += 1
+        self.seconds += seconds
+        if self.slowest_statement is None or seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+        if self.statements is not None:
+            self.statements.append((statement, parameters))
+
+    def merge(self, other):
+        """
+        Add the statements recorded by another QueryStats to these
+        """
+        self.count += other.count
+        self.seconds += other.seconds
+        if other.slowest_statement is not None and (
+                self.slowest_statement is None or
+                other.slowest_seconds > self.slowest_seconds):
+            self.slowest_seconds = other.slowest_seconds
+            self.slowest_statement = other.slowest_statement
+        if self.statements is not None and other.statements is not None:
+            self.statements.extend(other.statements)
+
+    def server_timing(self):
+        """
+        Return the value of a Server-Timing header for the statements
+        """
+        return 'db;dur={:.3f};desc="{} queries"'.format(
+            self.seconds * 1000, self.count)
+
+    def to_dict(self):
+        return {
+            'db_queries': self.count,
+            'db_ms': round(self.seconds * 1000, 3),
+            'db_slowest_ms': round(self.slowest_seconds * 1000, 3),
+        }
+
+
+def current_stats():
+    """
+    Return the QueryStats of the current request, or None if there isn't one
+    """
+    if not has_app_context():
+        return None
+    return g.get('query_stats')
+
+
+@contextmanager
+def collect_query_stats(record=True):
+    """
+    Collect the statements executed in the current application context
+
+    Statements of other requests, which have their own context, are not seen.
+    They are added to the stats of the request, if query_stats is enabled.
+
+    :param bool record: Keep the statements, see QueryStats
+    :return: Context manager giving a QueryStats
+    """
+    stats = QueryStats(record=record)
+    previous = g.get('query_stats')
+    g.query_stats = stats
+    try:
+        yield stats
+    finally:
+        if previous is None:
+            g.pop('query_stats', None)
+        else:
+            previous.merge(stats)
+            g.query_stats = previous
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_start', []).append(default_timer())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    stats = current_stats()
+    starts = conn.info.get('query_start')
+    if stats is not None and starts:
+        stats.add(statement, default_timer() - starts.pop(), parameters)
+
+
+@app.before_request
+def start_query_stats():
+    if get_settings().query_stats:
+        g.query_stats = QueryStats()
+
+
+@app.after_request
+def report_query_stats(response):
+    """
+    Add the Server-Timing header and log the statements of the request
+    """
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+
+    response.headers.add('Server-Timing', stats.server_timing())
+
+    slowest = ' '.join((stats.slowest_statement or '').split())[:200]
+    message = "{} {}: {} queries in {:.1f}ms, slowest {:.1f}ms: {}".format(
+        request.method, request.path, stats.count, stats.seconds * 1000,
+        stats.slowest_seconds * 1000, slowest)
+    extra = dict(stats.to_dict(), path=request.path, method=request.method)
+
+    settings = get_settings()
+    warn_queries = settings.warn_queries
+    warn_ms = settings.warn_ms
+    if (warn_queries and stats.count > warn_queries) or \
+            (warn_ms and stats.seconds * 1000 > warn_ms):
+        app.logger.warning(message, extra=extra)
+    else:
+        app.logger.debug(message, extra=extra)
+    return response
+
+
+@app.teardown_request
+def forget_query_stats(exception=None):
+    """
+    The application context may outlive the request, e.g. in tests
+    """
+    g.pop('query_stats', None)
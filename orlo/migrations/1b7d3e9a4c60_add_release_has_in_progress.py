@@ -0,0 +1,46 @@
+"""Add release has_in_progress summary column
+
+Revision ID: 1b7d3e9a4c60
+Revises: e83f0b6c2a19
+Create Date: 2026-10-17 18:05:12.640913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b7d3e9a4c60'
+down_revision = 'e83f0b6c2a19'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    op.add_column('release', sa.Column(
+        'has_in_progress', sa.Boolean(create_constraint=False),
+        nullable=True))
+    op.create_index(op.f('ix_release_has_in_progress'), 'release',
+                    ['has_in_progress'], unique=False)
+
+    # Backfill, using the same rules as orlo.orm.release_summary_update
+    release = sa.sql.table(
+        'release',
+        sa.sql.column('id'),
+        sa.sql.column('has_in_progress'),
+    )
+    package = sa.sql.table(
+        'package',
+        sa.sql.column('release_id'),
+        sa.sql.column('status'),
+    )
+    op.execute(release.update().values(
+        has_in_progress=sa.exists().where(sa.and_(
+            package.c.release_id == release.c.id,
+            package.c.status == 'IN_PROGRESS')),
+    ))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_release_has_in_progress'), table_name='release')
+    op.drop_column('release', 'has_in_progress')
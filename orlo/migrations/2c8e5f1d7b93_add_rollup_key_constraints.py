@@ -0,0 +1,75 @@
+"""Add unique constraints on the rollup keys
+
+Revision ID: 2c8e5f1d7b93
+Revises: 1b7d3e9a4c60
+Create Date: 2026-10-17 18:47:30.118254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c8e5f1d7b93'
+down_revision = '1b7d3e9a4c60'
+branch_labels = ()
+depends_on = None
+
+TEXT_KEYS = [('platform', sa.Text()), ('team', sa.String()),
+             ('user', sa.String())]
+ROLLUPS = [
+    ('uq_release_rollup_key', 'release_rollup',
+     ['bucket', 'platform', 'team', 'user', 'status', 'rollback']),
+    ('uq_package_rollup_key', 'package_rollup',
+     ['bucket', 'platform', 'team', 'user', 'name', 'status', 'rollback']),
+]
+
+
+def upgrade():
+    connection = op.get_bind()
+    for name, table_name, keys in ROLLUPS:
+        table = sa.sql.table(table_name, sa.sql.column('id'),
+                             sa.sql.column('count'),
+                             *[sa.sql.column(k) for k in keys])
+
+        # NULLs are distinct in a unique constraint, so missing platforms,
+        # teams and users are stored as empty strings instead
+        for k, _ in TEXT_KEYS:
+            op.execute(table.update().where(table.c[k] == None).values(
+                {k: ''}))
+
+        # Merge the rows duplicated by concurrent inserts
+        key_columns = [table.c[k] for k in keys]
+        duplicates = connection.execute(
+            sa.select([sa.func.min(table.c.id), sa.func.sum(table.c.count)] +
+                      key_columns)
+            .group_by(*key_columns)
+            .having(sa.func.count() > 1)).fetchall()
+        for row in duplicates:
+            keep, total, values = row[0], row[1], row[2:]
+            match = sa.and_(*[c == v for c, v in zip(key_columns, values)])
+            connection.execute(table.update().where(table.c.id == keep)
+                               .values(count=total))
+            connection.execute(table.delete().where(
+                sa.and_(match, table.c.id != keep)))
+
+        with op.batch_alter_table(table_name) as batch_op:
+            for k, type_ in TEXT_KEYS:
+                batch_op.alter_column(k, existing_type=type_, nullable=False,
+                                      server_default='')
+            batch_op.create_unique_constraint(name, keys)
+
+
+def downgrade():
+    for name, table_name, _ in reversed(ROLLUPS):
+        with op.batch_alter_table(table_name) as batch_op:
+            batch_op.drop_constraint(name, type_='unique')
+            for k, type_ in TEXT_KEYS:
+                batch_op.alter_column(k, existing_type=type_, nullable=True,
+                                      server_default=None)
+
+        table = sa.sql.table(table_name, *[sa.sql.column(k)
+                                           for k, _ in TEXT_KEYS])
+        for k, _ in TEXT_KEYS:
+            op.execute(table.update().where(table.c[k] == '').values(
+                {k: None}))
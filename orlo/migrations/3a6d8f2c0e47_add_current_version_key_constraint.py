@@ -0,0 +1,64 @@
+"""Add unique constraint on the current version key
+
+Revision ID: 3a6d8f2c0e47
+Revises: 2c8e5f1d7b93
+Create Date: 2026-10-17 19:32:04.581736
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a6d8f2c0e47'
+down_revision = '2c8e5f1d7b93'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    table = sa.sql.table(
+        'current_version',
+        sa.sql.column('id'),
+        sa.sql.column('name'),
+        sa.sql.column('platform'),
+        sa.sql.column('by_release'),
+        sa.sql.column('version'),
+    )
+
+    # NULLs are distinct in a unique constraint, so the rows for any
+    # platform are stored with an empty platform instead
+    op.execute(table.update().where(table.c.platform == None).values(
+        platform=''))
+
+    # Remove the rows duplicated by concurrent inserts
+    key_columns = [table.c.name, table.c.platform, table.c.by_release,
+                   table.c.version]
+    duplicates = connection.execute(
+        sa.select([sa.func.min(table.c.id)] + key_columns)
+        .group_by(*key_columns)
+        .having(sa.func.count() > 1)).fetchall()
+    for row in duplicates:
+        keep, values = row[0], row[1:]
+        match = sa.and_(*[c == v for c, v in zip(key_columns, values)])
+        connection.execute(table.delete().where(
+            sa.and_(match, table.c.id != keep)))
+
+    with op.batch_alter_table('current_version') as batch_op:
+        batch_op.alter_column('platform', existing_type=sa.Text(),
+                              nullable=False, server_default='')
+        batch_op.create_unique_constraint(
+            'uq_current_version_key',
+            ['name', 'platform', 'by_release', 'version'])
+
+
+def downgrade():
+    with op.batch_alter_table('current_version') as batch_op:
+        batch_op.drop_constraint('uq_current_version_key', type_='unique')
+        batch_op.alter_column('platform', existing_type=sa.Text(),
+                              nullable=True, server_default=None)
+
+    table = sa.sql.table('current_version', sa.sql.column('platform'))
+    op.execute(table.update().where(table.c.platform == '').values(
+        platform=None))
@@ -0,0 +1,72 @@
+"""Add release status and rollback summary columns
+
+Revision ID: 3f1c7a9d2b64
+Revises: 0868747e62ff
+Create Date: 2026-10-17 10:12:31.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c7a9d2b64'
+down_revision = '0868747e62ff'
+branch_labels = ()
+depends_on = None
+
+STATUSES = ('NOT_STARTED', 'IN_PROGRESS', 'SUCCESSFUL', 'FAILED')
+
+
+def upgrade():
+    # The status_types enum already exists for package.status
+    op.add_column('release', sa.Column(
+        'status',
+        sa.Enum(*STATUSES, name='status_types', create_constraint=False),
+        nullable=True))
+    op.add_column('release', sa.Column(
+        'has_rollback', sa.Boolean(create_constraint=False), nullable=True))
+    op.create_index(op.f('ix_release_status'), 'release', ['status'],
+                    unique=False)
+    op.create_index(op.f('ix_release_has_rollback'), 'release',
+                    ['has_rollback'], unique=False)
+
+    # Backfill, using the same rules as orlo.orm.release_summary_update
+    release = sa.sql.table(
+        'release',
+        sa.sql.column('id'),
+        sa.sql.column('status'),
+        sa.sql.column('has_rollback'),
+    )
+    package = sa.sql.table(
+        'package',
+        sa.sql.column('release_id'),
+        sa.sql.column('status'),
+        sa.sql.column('rollback'),
+    )
+
+    def any_package(*conditions):
+        return sa.exists().where(
+            sa.and_(package.c.release_id == release.c.id, *conditions))
+
+    def any_status(status):
+        return any_package(package.c.status == status)
+
+    op.execute(release.update().values(
+        status=sa.case([
+            (any_status('FAILED'), 'FAILED'),
+            (any_status('IN_PROGRESS'), 'IN_PROGRESS'),
+            (sa.and_(any_status('SUCCESSFUL'), any_status('NOT_STARTED')),
+             'IN_PROGRESS'),
+            (any_status('SUCCESSFUL'), 'SUCCESSFUL'),
+            (any_status('NOT_STARTED'), 'NOT_STARTED'),
+        ], else_=None),
+        has_rollback=any_package(package.c.rollback == sa.true()),
+    ))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_release_has_rollback'), table_name='release')
+    op.drop_index(op.f('ix_release_status'), table_name='release')
+    op.drop_column('release', 'has_rollback')
+    op.drop_column('release', 'status')
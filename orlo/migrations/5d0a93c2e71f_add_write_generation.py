@@ -0,0 +1,30 @@
+"""Add write generation
+
+Revision ID: 5d0a93c2e71f
+Revises: 8b2e4f6a1c39
+Create Date: 2026-10-17 13:41:05.917204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d0a93c2e71f'
+down_revision = '8b2e4f6a1c39'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    write_generation = op.create_table(
+        'write_generation',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(write_generation, [{'id': 1, 'value': 0}])
+
+
+def downgrade():
+    op.drop_table('write_generation')
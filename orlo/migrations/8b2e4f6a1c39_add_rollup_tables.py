@@ -0,0 +1,142 @@
+"""Add release and package rollup tables
+
+Revision ID: 8b2e4f6a1c39
+Revises: 3f1c7a9d2b64
+Create Date: 2026-10-17 11:02:47.531920
+
+"""
+from alembic import op
+import arrow
+import collections
+import sqlalchemy as sa
+from sqlalchemy_utils.types.arrow import ArrowType
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4f6a1c39'
+down_revision = '3f1c7a9d2b64'
+branch_labels = ()
+depends_on = None
+
+STATUSES = ('NOT_STARTED', 'IN_PROGRESS', 'SUCCESSFUL', 'FAILED')
+# The status_types enum already exists for package.status
+STATUS_TYPE = sa.Enum(*STATUSES, name='status_types').with_variant(
+    postgresql.ENUM(*STATUSES, name='status_types', create_type=False),
+    'postgresql')
+
+
+def upgrade():
+    op.create_table(
+        'release_rollup',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('bucket', ArrowType(),
+                  nullable=False),
+        sa.Column('platform', sa.Text(), nullable=True),
+        sa.Column('team', sa.String(), nullable=True),
+        sa.Column('user', sa.String(), nullable=True),
+        sa.Column('status', STATUS_TYPE, nullable=True),
+        sa.Column('rollback', sa.Boolean(), nullable=True),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_release_rollup_bucket'), 'release_rollup',
+                    ['bucket'], unique=False)
+    op.create_table(
+        'package_rollup',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('bucket', ArrowType(),
+                  nullable=False),
+        sa.Column('platform', sa.Text(), nullable=True),
+        sa.Column('team', sa.String(), nullable=True),
+        sa.Column('user', sa.String(), nullable=True),
+        sa.Column('name', sa.String(length=120), nullable=True),
+        sa.Column('status', STATUS_TYPE, nullable=True),
+        sa.Column('rollback', sa.Boolean(), nullable=True),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_package_rollup_bucket'), 'package_rollup',
+                    ['bucket'], unique=False)
+
+    # Count the existing finished releases, with the same rules as
+    # orlo.orm.rollup_counts
+    release = sa.sql.table(
+        'release',
+        sa.sql.column('id'),
+        sa.sql.column('stime', ArrowType()),
+        sa.sql.column('team'),
+        sa.sql.column('user'),
+        sa.sql.column('status'),
+        sa.sql.column('has_rollback'),
+    )
+    package = sa.sql.table(
+        'package',
+        sa.sql.column('id'),
+        sa.sql.column('release_id'),
+        sa.sql.column('name'),
+        sa.sql.column('stime', ArrowType()),
+    )
+    release_platform = sa.sql.table(
+        'release_platform',
+        sa.sql.column('release_id'),
+        sa.sql.column('platform_id'),
+    )
+    platform = sa.sql.table(
+        'platform',
+        sa.sql.column('id'),
+        sa.sql.column('name'),
+    )
+    platforms = release.outerjoin(
+        release_platform, release_platform.c.release_id == release.c.id
+    ).outerjoin(platform, platform.c.id == release_platform.c.platform_id)
+    finished = release.c.status.in_(['SUCCESSFUL', 'FAILED'])
+
+    releases = sa.select([
+        release.c.id, release.c.stime, release.c.team, release.c.user,
+        release.c.status, release.c.has_rollback,
+        platform.c.name.label('platform')
+    ]).select_from(platforms).where(finished).order_by(release.c.id)
+    packages = sa.select([
+        package.c.id, package.c.stime, package.c.name, release.c.team,
+        release.c.user, release.c.status, release.c.has_rollback,
+        platform.c.name.label('platform')
+    ]).select_from(
+        platforms.join(package, package.c.release_id == release.c.id)
+    ).where(finished).order_by(package.c.id)
+
+    connection = op.get_bind()
+    for table, query, has_name in (('release_rollup', releases, False),
+                                   ('package_rollup', packages, True)):
+        counts = collections.Counter()
+        last_id = None
+        for row in connection.execute(query):
+            if row.stime is None:
+                continue
+            bucket = arrow.get(row.stime).to('UTC').floor('hour').naive
+            key = (row.team or None, row.user or None) + \
+                ((row.name,) if has_name else ()) + \
+                (row.status, row.has_rollback)
+            # One row per platform, the first also counts towards the total
+            if row.id != last_id:
+                counts[(bucket, None) + key] += 1
+                last_id = row.id
+            if row.platform is not None:
+                counts[(bucket, row.platform) + key] += 1
+
+        keys = ['bucket', 'platform', 'team', 'user'] + \
+            (['name'] if has_name else []) + ['status', 'rollback']
+        rollup = sa.sql.table(table, *[sa.sql.column(k) for k in keys] +
+                              [sa.sql.column('count')])
+        if counts:
+            connection.execute(rollup.insert(), [
+                dict(zip(keys, key), count=n) for key, n in counts.items()])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_package_rollup_bucket'),
+                  table_name='package_rollup')
+    op.drop_table('package_rollup')
+    op.drop_index(op.f('ix_release_rollup_bucket'),
+                  table_name='release_rollup')
+    op.drop_table('release_rollup')
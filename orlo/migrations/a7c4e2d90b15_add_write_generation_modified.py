@@ -0,0 +1,26 @@
+"""Add write generation modified time
+
+Revision ID: a7c4e2d90b15
+Revises: 5d0a93c2e71f
+Create Date: 2026-10-17 14:20:11.004392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils.types.arrow import ArrowType
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c4e2d90b15'
+down_revision = '5d0a93c2e71f'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    op.add_column('write_generation',
+                  sa.Column('modified', ArrowType(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('write_generation', 'modified')
@@ -0,0 +1,110 @@
+"""Add current version table
+
+Revision ID: c31e8f5a7d42
+Revises: a7c4e2d90b15
+Create Date: 2026-10-17 15:08:36.219874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils.types.arrow import ArrowType
+
+
+# revision identifiers, used by Alembic.
+revision = 'c31e8f5a7d42'
+down_revision = 'a7c4e2d90b15'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'current_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=120), nullable=False),
+        sa.Column('platform', sa.Text(), nullable=True),
+        sa.Column('by_release', sa.Boolean(), nullable=False),
+        sa.Column('version', sa.String(length=32), nullable=False),
+        sa.Column('stime', ArrowType(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_current_version_lookup', 'current_version',
+                    ['by_release', 'platform', 'name'], unique=False)
+
+    # Work out the current versions, as orlo.orm.current_versions: the
+    # version of the last SUCCESSFUL package to start, for any platform and
+    # each platform, and with by_release, only counting SUCCESSFUL releases
+    current_version = sa.sql.table(
+        'current_version',
+        sa.sql.column('name'),
+        sa.sql.column('platform'),
+        sa.sql.column('by_release'),
+        sa.sql.column('version'),
+        sa.sql.column('stime', ArrowType()),
+    )
+    package = sa.sql.table(
+        'package',
+        sa.sql.column('name'),
+        sa.sql.column('version'),
+        sa.sql.column('status'),
+        sa.sql.column('stime', ArrowType()),
+        sa.sql.column('release_id'),
+    )
+    release = sa.sql.table(
+        'release',
+        sa.sql.column('id'),
+        sa.sql.column('status'),
+    )
+    release_platform = sa.sql.table(
+        'release_platform',
+        sa.sql.column('release_id'),
+        sa.sql.column('platform_id'),
+    )
+    platform = sa.sql.table(
+        'platform',
+        sa.sql.column('id'),
+        sa.sql.column('name'),
+    )
+
+    query = sa.select([
+        package.c.name, package.c.version, package.c.stime,
+        release.c.status, platform.c.name,
+    ]).select_from(
+        package
+        .outerjoin(release, package.c.release_id == release.c.id)
+        .outerjoin(release_platform,
+                   release_platform.c.release_id == release.c.id)
+        .outerjoin(platform, release_platform.c.platform_id == platform.c.id)
+    ).where(sa.and_(package.c.status == 'SUCCESSFUL',
+                    package.c.stime != None))
+
+    current = {}
+    for name, version, stime, release_status, platform_name in \
+            op.get_bind().execute(query):
+        platforms = (None, ) if platform_name is None \
+            else (None, platform_name)
+        modes = (False, True) if release_status == 'SUCCESSFUL' \
+            else (False, )
+        for platform_key in platforms:
+            for by_release in modes:
+                key = (name, platform_key, by_release)
+                best = current.get(key)
+                if best is None or stime > best[0]:
+                    current[key] = (stime, set([version]))
+                elif stime == best[0]:
+                    best[1].add(version)
+
+    rows = [
+        {'name': name, 'platform': platform_key, 'by_release': by_release,
+         'version': version, 'stime': stime}
+        for (name, platform_key, by_release), (stime, versions)
+        in current.items()
+        for version in versions
+    ]
+    if rows:
+        op.bulk_insert(current_version, rows)
+
+
+def downgrade():
+    op.drop_index('ix_current_version_lookup', table_name='current_version')
+    op.drop_table('current_version')
@@ -0,0 +1,24 @@
+"""Add package name, status and stime index
+
+Revision ID: d52b9e1c6f08
+Revises: c31e8f5a7d42
+Create Date: 2026-10-17 16:02:14.771350
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd52b9e1c6f08'
+down_revision = 'c31e8f5a7d42'
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_package_name_status_stime', 'package',
+                    ['name', 'status', 'stime'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_package_name_status_stime', table_name='package')
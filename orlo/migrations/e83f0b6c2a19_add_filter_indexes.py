@@ -0,0 +1,38 @@
+"""Add composite indexes for the release and package filters
+
+Revision ID: e83f0b6c2a19
+Revises: d52b9e1c6f08
+Create Date: 2026-10-17 16:41:52.386105
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e83f0b6c2a19'
+down_revision = 'd52b9e1c6f08'
+branch_labels = ()
+depends_on = None
+
+# platform.name is unique, so already has an index, and package.name is
+# covered by ix_package_name_status_stime
+INDEXES = [
+    ('ix_release_user_stime', 'release', ['user', 'stime']),
+    ('ix_release_team_stime', 'release', ['team', 'stime']),
+    ('ix_package_release_id_status_rollback', 'package',
+     ['release_id', 'status', 'rollback']),
+    ('ix_release_platform_release_id_platform_id', 'release_platform',
+     ['release_id', 'platform_id']),
+    ('ix_release_platform_platform_id_release_id', 'release_platform',
+     ['platform_id', 'release_id']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -1,10 +1,14 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.orm import Session
 from sqlalchemy_utils.types.uuid import UUIDType
 from sqlalchemy_utils.types.arrow import ArrowType
 
 from orlo.app import app
-from orlo.config import config
+from orlo.config import config, get_settings
 from orlo.exceptions import OrloWorkflowError
+import collections
+import datetime
 import pytz
 import uuid
 import arrow
@@ -27,10 +31,41 @@ except pytz.exceptions.UnknownTimeZoneError:
 release_platform = db.Table(
     'release_platform', db.Model.metadata,
     db.Column('release_id', UUIDType, db.ForeignKey('release.id')),
-    db.Column('platform_id', UUIDType, db.ForeignKey('platform.id'))
+    db.Column('platform_id', UUIDType, db.ForeignKey('platform.id')),
+    # Platforms of a release, and releases on a platform
+    db.Index('ix_release_platform_release_id_platform_id',
+             'release_id', 'platform_id'),
+    db.Index('ix_release_platform_platform_id_release_id',
+             'platform_id', 'release_id'),
 )
 
 
+# Single row counting writes, see orlo.cache
+write_generation = db.Table(
+    'write_generation', db.Model.metadata,
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('value', db.Integer, nullable=False),
+    db.Column('modified', ArrowType),
+)
+
+
+def format_time(value, time_format):
+    """
+    Format an optional time for to_dict
+    """
+    return value.strftime(time_format) if value else None
+
+
+def merge_dicts(dicts):
+    """
+    Merge dictionaries, later keys winning
+    """
+    merged = {}
+    for d in dicts:
+        merged.update(d)
+    return merged
+
+
 def string_to_list(string):
     """
     Load a list from a string
@@ -55,6 +90,12 @@ class Release(db.Model):
     The main Release object
     """
     __tablename__ = 'release'
+    __table_args__ = (
+        # Filters on user or team, usually with a time range or ordered by
+        # time, see orlo.queries.apply_filters
+        db.Index('ix_release_user_stime', 'user', 'stime'),
+        db.Index('ix_release_team_stime', 'team', 'stime'),
+    )
 
     id = db.Column(UUIDType, primary_key=True, unique=True, nullable=False)
     platforms = db.relationship('Platform', secondary=release_platform)
@@ -64,6 +105,16 @@ class Release(db.Model):
     duration = db.Column(db.Interval)
     user = db.Column(db.String, nullable=False)
     team = db.Column(db.String)
+    # Summaries of the packages in this release, maintained by
+    # update_release_summaries
+    status = db.Column(
+        db.Enum('NOT_STARTED', 'IN_PROGRESS', 'SUCCESSFUL', 'FAILED',
+                name='status_types'),
+        index=True)
+    has_rollback = db.Column(db.Boolean(create_constraint=True),
+                             default=False, index=True)
+    has_in_progress = db.Column(db.Boolean(create_constraint=True),
+                                default=False, index=True)
     packages = db.relationship("Package", backref=db.backref("release"))
     notes = db.relationship("ReleaseNote", backref=db.backref("release"))
 
@@ -84,38 +135,46 @@ class Release(db.Model):
     def __str__(self):
         return self.to_dict()
 
-    def to_dict(self):
-        time_format = config.get('main', 'time_format')
-
-        metadata = {}
-        for m in self.metadata:
-            metadata.update(m.to_dict())
-
-        return {
-            'id': str(self.id),
-            'packages': [p.to_dict() for p in self.packages],
-            'platforms': [platform.name for platform in self.platforms],
-            'references': string_to_list(self.references),
-            'stime': self.stime.strftime(config.get('main', 'time_format')) if self.stime else None,
-            'ftime': self.ftime.strftime(config.get('main', 'time_format')) if self.ftime else None,
-            'duration': self.duration.seconds if self.duration else None,
-            'metadata': metadata,
-            'user': self.user,
-            'team': self.team,
-            'notes': [n.content for n in self.notes],
-        }
+    def to_dict(self, fields=None):
+        """
+        Serialize the release
+
+        :param fields: Only include these fields. Relationships which are not
+            included are not loaded.
+        """
+        time_format = get_settings().time_format
+        serializers = self.serializers
+        return dict((f, serializers[f](self, time_format))
+                    for f in fields or serializers)
+
+    # Field name to function(release, time_format), used by to_dict
+    serializers = {
+        'id': lambda r, tf: str(r.id),
+        'packages': lambda r, tf: [p.to_dict() for p in r.packages],
+        'platforms': lambda r, tf: [platform.name for platform in r.platforms],
+        'references': lambda r, tf: string_to_list(r.references),
+        'stime': lambda r, tf: format_time(r.stime, tf),
+        'ftime': lambda r, tf: format_time(r.ftime, tf),
+        'duration': lambda r, tf: r.duration.seconds if r.duration else None,
+        'metadata': lambda r, tf: merge_dicts(m.to_dict() for m in r.metadata),
+        'user': lambda r, tf: r.user,
+        'team': lambda r, tf: r.team,
+        'status': lambda r, tf: r.status,
+        'has_rollback': lambda r, tf: r.has_rollback,
+        'notes': lambda r, tf: [n.content for n in r.notes],
+    }
 
     def start(self):
         """
         Mark a release as started
         """
-        self.stime = arrow.now(config.get('main', 'time_zone'))
+        self.stime = arrow.now(get_settings().time_zone)
 
     def stop(self):
         """
         Mark a release as stopped
         """
-        self.ftime = arrow.now(config.get('main', 'time_zone'))
+        self.ftime = arrow.now(get_settings().time_zone)
         td = self.ftime - self.stime
         self.duration = td
 
@@ -125,6 +184,11 @@ class Package(db.Model):
     A deployed instance of a package
     """
     __tablename__ = 'package'
+    __table_args__ = (
+        db.Index('ix_package_name_status_stime', 'name', 'status', 'stime'),
+        db.Index('ix_package_release_id_status_rollback',
+                 'release_id', 'status', 'rollback'),
+    )
 
     id = db.Column(UUIDType, primary_key=True, unique=True, nullable=False)
     name = db.Column(db.String(120), nullable=False)
@@ -152,7 +216,7 @@ class Package(db.Model):
         """
         Mark a package deployment as started
         """
-        self.stime = arrow.now(config.get('main', 'time_zone'))
+        self.stime = arrow.now(get_settings().time_zone)
         self.status = 'IN_PROGRESS'
 
     def stop(self, success):
@@ -164,7 +228,7 @@ class Package(db.Model):
         if self.stime is None:
             raise OrloWorkflowError(
                 "Can not stop a package which has not been started")
-        self.ftime = arrow.now(config.get('main', 'time_zone'))
+        self.ftime = arrow.now(get_settings().time_zone)
 
         td = self.ftime - self.stime
         self.duration = td
@@ -174,20 +238,31 @@ class Package(db.Model):
         else:
             self.status = 'FAILED'
 
-    def to_dict(self):
-        time_format = config.get('main', 'time_format')
-        return {
-            'id': str(self.id),
-            'name': self.name,
-            'version': self.version,
-            'stime': self.stime.strftime(time_format) if self.stime else None,
-            'ftime': self.ftime.strftime(time_format) if self.ftime else None,
-            'duration': self.duration.seconds if self.duration else None,
-            'rollback': self.rollback,
-            'status': self.status,
-            'diff_url': self.diff_url,
-            'release_id': self.release_id,
-        }
+    def to_dict(self, fields=None):
+        """
+        Serialize the package
+
+        :param fields: Only include these fields. Columns which are not
+            included are not loaded.
+        """
+        time_format = get_settings().time_format
+        serializers = self.serializers
+        return dict((f, serializers[f](self, time_format))
+                    for f in fields or serializers)
+
+    # Field name to function(package, time_format), used by to_dict
+    serializers = {
+        'id': lambda p, tf: str(p.id),
+        'name': lambda p, tf: p.name,
+        'version': lambda p, tf: p.version,
+        'stime': lambda p, tf: format_time(p.stime, tf),
+        'ftime': lambda p, tf: format_time(p.ftime, tf),
+        'duration': lambda p, tf: p.duration.seconds if p.duration else None,
+        'rollback': lambda p, tf: p.rollback,
+        'status': lambda p, tf: p.status,
+        'diff_url': lambda p, tf: p.diff_url,
+        'release_id': lambda p, tf: p.release_id,
+    }
 
 
 class PackageResult(db.Model):
@@ -263,3 +338,652 @@ class Platform(db.Model):
     def __init__(self, name):
         self.id = uuid.uuid4()
         self.name = name
+
+
+RELEASE_ROLLUP_KEYS = ('bucket', 'platform', 'team', 'user', 'status',
+                       'rollback')
+PACKAGE_ROLLUP_KEYS = ('bucket', 'platform', 'team', 'user', 'name', 'status',
+                       'rollback')
+
+
+class ReleaseRollup(db.Model):
+    """
+    Count of releases started in an hour, maintained by update_rollups
+
+    Releases on several platforms are counted once under each platform, and
+    once more with an empty platform, which holds the total. A release with
+    no team or user is counted with an empty team or user, so that the key
+    columns can be unique.
+    """
+    __tablename__ = 'release_rollup'
+    __table_args__ = (
+        db.UniqueConstraint(*RELEASE_ROLLUP_KEYS,
+                            name='uq_release_rollup_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(ArrowType, nullable=False, index=True)
+    platform = db.Column(db.Text, nullable=False, server_default='')
+    team = db.Column(db.String, nullable=False, server_default='')
+    user = db.Column(db.String, nullable=False, server_default='')
+    status = db.Column(
+        db.Enum('NOT_STARTED', 'IN_PROGRESS', 'SUCCESSFUL', 'FAILED',
+                name='status_types'))
+    rollback = db.Column(db.Boolean(create_constraint=True))
+    count = db.Column(db.Integer, nullable=False)
+
+
+class PackageRollup(db.Model):
+    """
+    Count of packages started in an hour, maintained by update_rollups
+
+    The team, user, status and rollback are those of the release, as in
+    orlo.stats.packages_by_time. Platforms are counted as in ReleaseRollup.
+    """
+    __tablename__ = 'package_rollup'
+    __table_args__ = (
+        db.UniqueConstraint(*PACKAGE_ROLLUP_KEYS,
+                            name='uq_package_rollup_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(ArrowType, nullable=False, index=True)
+    platform = db.Column(db.Text, nullable=False, server_default='')
+    team = db.Column(db.String, nullable=False, server_default='')
+    user = db.Column(db.String, nullable=False, server_default='')
+    name = db.Column(db.String(120))
+    status = db.Column(
+        db.Enum('NOT_STARTED', 'IN_PROGRESS', 'SUCCESSFUL', 'FAILED',
+                name='status_types'))
+    rollback = db.Column(db.Boolean(create_constraint=True))
+    count = db.Column(db.Integer, nullable=False)
+
+
+class CurrentVersion(db.Model):
+    """
+    Current version of a package, maintained by update_current_versions
+
+    There is a row for each platform the package was released to, and one
+    with an empty platform, for any platform. Rows with by_release set only
+    consider packages whose release was SUCCESSFUL, see
+    orlo.queries.package_versions.
+    """
+    __tablename__ = 'current_version'
+    __table_args__ = (
+        db.Index('ix_current_version_lookup', 'by_release', 'platform',
+                 'name'),
+        # One row per key, so that concurrent updates can not duplicate rows
+        db.UniqueConstraint('name', 'platform', 'by_release', 'version',
+                            name='uq_current_version_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False)
+    platform = db.Column(db.Text, nullable=False, server_default='')
+    by_release = db.Column(db.Boolean(create_constraint=True), nullable=False)
+    version = db.Column(db.String(32), nullable=False)
+    stime = db.Column(ArrowType, nullable=False)
+
+
+def release_status(statuses):
+    """
+    Determine the status of a release from the status of its packages
+
+    If any package has FAILED, the release has FAILED. Otherwise if any package
+    is IN_PROGRESS, or some packages are SUCCESSFUL while others are
+    NOT_STARTED, the release is IN_PROGRESS. Otherwise all packages share the
+    same status, which is the status of the release.
+
+    This must match release_summary_values below.
+
+    :param statuses: Iterable of package statuses
+    :return: The release status, or None if there are no package statuses
+    """
+    statuses = set(statuses)
+    statuses.discard(None)
+    if 'FAILED' in statuses:
+        return 'FAILED'
+    if 'IN_PROGRESS' in statuses or len(statuses) > 1:
+        return 'IN_PROGRESS'
+    if statuses:
+        return statuses.pop()
+    return None
+
+
+def release_summary_values():
+    """
+    Expressions for Release.status, Release.has_rollback and
+    Release.has_in_progress, worked out from the packages of each release
+
+    :return: Dictionary of column name to expression
+    """
+    release = Release.__table__
+    package = Package.__table__
+
+    def any_package(*conditions):
+        return db.exists().where(
+            db.and_(package.c.release_id == release.c.id, *conditions))
+
+    def any_status(status):
+        return any_package(package.c.status == status)
+
+    status = db.case([
+        (any_status('FAILED'), 'FAILED'),
+        (any_status('IN_PROGRESS'), 'IN_PROGRESS'),
+        (db.and_(any_status('SUCCESSFUL'), any_status('NOT_STARTED')),
+         'IN_PROGRESS'),
+        (any_status('SUCCESSFUL'), 'SUCCESSFUL'),
+        (any_status('NOT_STARTED'), 'NOT_STARTED'),
+    ], else_=None)
+
+    return {
+        'status': status,
+        'has_rollback': any_package(package.c.rollback == True),
+        'has_in_progress': any_status('IN_PROGRESS'),
+    }
+
+
+def release_summary_update(release_ids=None):
+    """
+    Statement to update Release.status, Release.has_rollback and
+    Release.has_in_progress from packages
+
+    :param release_ids: Releases to update, or None for all releases
+    :return: Update statement
+    """
+    release = Release.__table__
+    statement = release.update().values(**release_summary_values())
+    if release_ids is not None:
+        statement = statement.where(release.c.id.in_(release_ids))
+    return statement
+
+
+@event.listens_for(Session, 'after_flush')
+def update_release_summaries(session, flush_context):
+    """
+    Update the summary columns of releases whose packages have changed
+
+    Objects inserted with bulk_insert_mappings do not trigger this, so the
+    import sets the summaries itself.
+    """
+    release_ids = set()
+    status_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Package) and obj.release_id is not None:
+            release_ids.add(obj.release_id)
+            if obj in session.new or obj in session.deleted or \
+                    db.inspect(obj).attrs.status.history.has_changes():
+                status_ids.add(obj.release_id)
+
+    if status_ids:
+        # Releases which become or stop being SUCCESSFUL change the current
+        # versions, see update_current_versions
+        release = Release.__table__
+        new_status = release_summary_values()['status']
+        rows = session.execute(
+            db.select([release.c.id, release.c.status, new_status])
+            .where(release.c.id.in_(status_ids)))
+        session.info.setdefault('successful_releases_changed', set()).update(
+            row[0] for row in rows
+            if (row[1] == 'SUCCESSFUL') != (row[2] == 'SUCCESSFUL'))
+
+    if release_ids:
+        session.execute(release_summary_update(release_ids))
+        session.info.setdefault('updated_releases', set()).update(release_ids)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def expire_release_summaries(session, flush_context):
+    """
+    Expire the summary columns updated by update_release_summaries, so that
+    releases already loaded in the session see the new values
+    """
+    release_ids = session.info.pop('updated_releases', None)
+    if not release_ids:
+        return
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Release) and obj.id in release_ids:
+            session.expire(obj, ['status', 'has_rollback', 'has_in_progress'])
+
+
+def rollup_bucket(stime):
+    """
+    Return the rollup bucket a start time falls in, the start of its hour
+
+    :param stime: Arrow, datetime or None
+    :return: Naive UTC datetime, or None if stime is None
+    """
+    if stime is None:
+        return None
+    return arrow.get(stime).to('UTC').floor('hour').naive
+
+
+# Only finished releases are counted in the rollups, as these are the only
+# ones orlo.stats reports on
+ROLLUP_STATUSES = ('SUCCESSFUL', 'FAILED')
+
+
+def bucket_ranges(buckets, chunk=100):
+    """
+    Merge buckets into ranges of consecutive hours
+
+    :param buckets: Buckets from rollup_bucket
+    :param int chunk: Maximum number of ranges to yield at a time
+    :return: Iterator over lists of (start, end) tuples, end exclusive
+    """
+    hour = datetime.timedelta(hours=1)
+    ranges = []
+    for bucket in sorted(buckets):
+        if ranges and ranges[-1][1] == bucket:
+            ranges[-1] = (ranges[-1][0], bucket + hour)
+        else:
+            ranges.append((bucket, bucket + hour))
+    for i in range(0, len(ranges), chunk):
+        yield ranges[i:i + chunk]
+
+
+def rollup_counts(session, release_ids=None, buckets=None):
+    """
+    Count what the given releases, or the releases and packages in the given
+    buckets, contribute to the rollup tables
+
+    :param session: Session to use
+    :param release_ids: Count these releases and all of their packages
+    :param buckets: Count the releases and packages which started in these
+        buckets, from rollup_bucket. If both are None, count everything.
+    :return: Tuple of Counters for ReleaseRollup and PackageRollup, keyed by
+        tuples of RELEASE_ROLLUP_KEYS and PACKAGE_ROLLUP_KEYS
+    """
+    release_counts = collections.Counter()
+    package_counts = collections.Counter()
+
+    if release_ids is not None:
+        # Most changes are to releases which have not finished, which do not
+        # contribute anything
+        release_ids = list(release_ids)
+        finished = set()
+        for i in range(0, len(release_ids), 500):
+            finished.update(row.id for row in session.query(Release.id).filter(
+                Release.id.in_(release_ids[i:i + 500]),
+                Release.status.in_(ROLLUP_STATUSES)))
+        if not finished:
+            return release_counts, package_counts
+        release_ids = finished
+
+    def filtered(query, stime, release_id):
+        query = query.filter(Release.status.in_(ROLLUP_STATUSES))
+        if release_ids is not None:
+            ids = list(release_ids)
+            for i in range(0, len(ids), 500):
+                yield query.filter(release_id.in_(ids[i:i + 500]))
+        elif buckets is not None:
+            # Only the given hours are scanned, so that refreshing a few
+            # buckets far apart does not read everything in between
+            for ranges in bucket_ranges(buckets):
+                yield query.filter(db.or_(*[
+                    db.and_(stime >= start, stime < end)
+                    for start, end in ranges]))
+        else:
+            yield query.filter(stime != None)
+
+    def count(counts, queries, key):
+        # Each row is one object on one platform, ordered by object, so the
+        # total across platforms is counted on the first row of each object
+        for query in queries:
+            last_id = None
+            for row in query.yield_per(1000):
+                bucket = rollup_bucket(row.stime)
+                if bucket is None or (
+                        buckets is not None and bucket not in buckets):
+                    continue
+                if row.id != last_id:
+                    counts[key(bucket, '', row)] += 1
+                    last_id = row.id
+                if row.platform is not None:
+                    counts[key(bucket, row.platform, row)] += 1
+
+    releases = session.query(
+        Release.id, Release.stime, Release.team, Release.user,
+        Release.status, Release.has_rollback,
+        Platform.name.label('platform')) \
+        .outerjoin(Release.platforms) \
+        .order_by(Release.id)
+    count(release_counts, filtered(releases, Release.stime, Release.id),
+          lambda bucket, platform, r: (bucket, platform, r.team or '',
+                                       r.user or '', r.status,
+                                       r.has_rollback))
+
+    packages = session.query(
+        Package.id, Package.stime, Package.name, Release.team, Release.user,
+        Release.status, Release.has_rollback,
+        Platform.name.label('platform')) \
+        .join(Release, Package.release_id == Release.id) \
+        .outerjoin(Release.platforms) \
+        .order_by(Package.id)
+    count(package_counts,
+          filtered(packages, Package.stime, Package.release_id),
+          lambda bucket, platform, r: (bucket, platform, r.team or '',
+                                       r.user or '', r.name, r.status,
+                                       r.has_rollback))
+
+    return release_counts, package_counts
+
+
+def refresh_rollups(session, buckets=None):
+    """
+    Recount the rollup rows for the given buckets
+
+    This is used after bulk inserts, which the flush hooks do not see, and to
+    rebuild the rollups.
+
+    :param session: Session to use
+    :param buckets: Iterable of buckets from rollup_bucket to recount, or None
+        to rebuild the rollup tables entirely
+    """
+    if buckets is not None:
+        buckets = set(b for b in buckets if b is not None)
+        if not buckets:
+            return
+
+    release_counts, package_counts = rollup_counts(session, buckets=buckets)
+    for table, counts, keys in (
+            (ReleaseRollup.__table__, release_counts, RELEASE_ROLLUP_KEYS),
+            (PackageRollup.__table__, package_counts, PACKAGE_ROLLUP_KEYS)):
+        if buckets is None:
+            session.execute(table.delete())
+        else:
+            ordered = sorted(buckets)
+            for i in range(0, len(ordered), 500):
+                session.execute(table.delete().where(
+                    table.c.bucket.in_(ordered[i:i + 500])))
+        if counts:
+            session.execute(table.insert(), [
+                dict(zip(keys, key), count=n) for key, n in counts.items()
+            ])
+
+
+def apply_rollup_deltas(session, table, keys, deltas):
+    """
+    Add the given deltas to the counts in a rollup table
+
+    :param session: Session to use
+    :param table: Rollup table
+    :param tuple keys: Names of the key columns
+    :param deltas: Dictionary of key tuples to the number to add
+    """
+    connection = session.connection()
+    for key, delta in deltas.items():
+        if not delta:
+            continue
+        match = db.and_(*[table.c[k] == v for k, v in zip(keys, key)])
+        update = table.update().where(match).values(
+            count=table.c.count + delta)
+        if connection.execute(update).rowcount == 0:
+            savepoint = connection.begin_nested()
+            try:
+                connection.execute(table.insert().values(
+                    count=delta, **dict(zip(keys, key))))
+                savepoint.commit()
+            except exc.IntegrityError:
+                # Another process inserted the row since the update
+                savepoint.rollback()
+                connection.execute(update)
+        elif delta < 0:
+            session.execute(table.delete().where(
+                db.and_(match, table.c.count <= 0)))
+
+
+def rollup_release_ids(session):
+    """
+    Return the IDs of the releases whose rollup counts may be changed by
+    the pending flush
+    """
+    release_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Package):
+            release_ids.add(obj.release_id or (
+                obj.release.id if obj.release is not None else None))
+            # Packages moved from another release
+            history = db.inspect(obj).attrs.release_id.history
+            release_ids.update(history.deleted or ())
+        elif isinstance(obj, Release) and obj not in session.new:
+            state = db.inspect(obj)
+            if obj in session.deleted or any(
+                    state.attrs[a].history.has_changes()
+                    for a in ('stime', 'team', 'user', 'platforms')):
+                release_ids.add(obj.id)
+    release_ids.discard(None)
+    return release_ids
+
+
+@event.listens_for(Session, 'before_flush')
+def count_rollups_before_flush(session, flush_context, instances):
+    """
+    Record what the releases about to change contribute to the rollups
+    """
+    release_ids = rollup_release_ids(session)
+    if release_ids:
+        session.info['rollup_counts'] = (
+            release_ids, rollup_counts(session, release_ids))
+
+
+@event.listens_for(Session, 'after_flush')
+def update_rollups(session, flush_context):
+    """
+    Update the rollups by the difference in what the flushed releases
+    contribute
+
+    Listeners run in the order they are registered, so this sees the
+    summaries written by update_release_summaries. Objects inserted with
+    bulk_insert_mappings do not trigger this, so the import refreshes the
+    rollups itself.
+    """
+    release_ids, before = session.info.pop(
+        'rollup_counts', (set(), (collections.Counter(),
+                                  collections.Counter())))
+    release_ids = release_ids | rollup_release_ids(session)
+    if not release_ids:
+        return
+
+    after = rollup_counts(session, release_ids)
+    for table, keys, old, new in (
+            (ReleaseRollup.__table__, RELEASE_ROLLUP_KEYS,
+             before[0], after[0]),
+            (PackageRollup.__table__, PACKAGE_ROLLUP_KEYS,
+             before[1], after[1])):
+        deltas = collections.Counter(new)
+        deltas.subtract(old)
+        apply_rollup_deltas(session, table, keys, deltas)
+
+
+# Key of a current_version row. There can be several versions for one name,
+# platform and by_release, if they started at the same time.
+CURRENT_VERSION_KEYS = ('name', 'platform', 'by_release', 'version')
+
+
+def current_versions(session, names):
+    """
+    Work out the current versions of packages
+
+    The current version is that of the last SUCCESSFUL package to start, so
+    that rollbacks are followed. If several packages started at the same
+    time, they are all current. Each combination of platform and by_release
+    is one query, joining the packages to their max(stime) by name, which is
+    covered by ix_package_name_status_stime.
+
+    :param session: Session to use
+    :param list names: Package names to work out, at most a few hundred
+    :return: Dictionary of key tuples of CURRENT_VERSION_KEYS to stime
+    """
+    current = {}
+    for by_platform in (False, True):
+        for by_release in (False, True):
+            def filtered(query):
+                query = query.filter(Package.status == 'SUCCESSFUL',
+                                     Package.stime != None,
+                                     Package.name.in_(names))
+                if by_platform or by_release:
+                    query = query.join(Release,
+                                       Package.release_id == Release.id)
+                if by_platform:
+                    query = query.join(Release.platforms)
+                if by_release:
+                    query = query.filter(Release.status == 'SUCCESSFUL')
+                return query
+
+            columns = [Package.name.label('name')]
+            if by_platform:
+                columns.append(Platform.name.label('platform'))
+            latest = filtered(session.query(
+                db.func.max(Package.stime).label('max_stime'), *columns)) \
+                .group_by(*columns) \
+                .subquery()
+
+            match = [latest.c.name == Package.name,
+                     latest.c.max_stime == Package.stime]
+            if by_platform:
+                match.append(latest.c.platform == Platform.name)
+            query = filtered(session.query(
+                Package.version, Package.stime, *columns)) \
+                .join(latest, db.and_(*match))
+
+            for row in query:
+                platform = row.platform if by_platform else ''
+                current[(row.name, platform, by_release, row.version)] = \
+                    row.stime
+    return current
+
+
+def insert_current_versions(connection, rows):
+    """
+    Insert current_version rows, updating any inserted concurrently
+
+    :param connection: Connection to use
+    :param list rows: Dictionaries of the CURRENT_VERSION_KEYS and stime
+    """
+    table = CurrentVersion.__table__
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert(), rows)
+        savepoint.commit()
+        return
+    except exc.IntegrityError:
+        savepoint.rollback()
+
+    # Another process inserted some of the rows, see uq_current_version_key
+    for row in rows:
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(table.insert().values(**row))
+            savepoint.commit()
+        except exc.IntegrityError:
+            savepoint.rollback()
+            connection.execute(table.update().where(db.and_(
+                table.c.name == row['name'],
+                table.c.platform == row['platform'],
+                table.c.by_release == row['by_release'],
+                table.c.version == row['version'],
+            )).values(stime=row['stime']))
+
+
+def refresh_current_versions(session, names=None):
+    """
+    Bring the current_version rows of the given packages up to date
+
+    The stored rows are compared with current_versions, and only those which
+    differ are written.
+
+    :param session: Session to use
+    :param names: Iterable of package names, or None to rebuild the
+        current_version table entirely
+    """
+    table = CurrentVersion.__table__
+    if names is None:
+        names = set(row.name for row in session.query(Package.name).filter(
+            Package.status == 'SUCCESSFUL').distinct())
+        names.update(row.name for row in
+                     session.query(CurrentVersion.name).distinct())
+    names = sorted(set(n for n in names if n is not None))
+
+    connection = session.connection()
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        current = current_versions(session, chunk)
+        stored = dict(
+            ((row.name, row.platform, row.by_release, row.version),
+             (row.id, row.stime))
+            for row in connection.execute(table.select().where(
+                table.c.name.in_(chunk))))
+
+        stale = [row_id for key, (row_id, _) in stored.items()
+                 if key not in current]
+        if stale:
+            connection.execute(table.delete().where(table.c.id.in_(stale)))
+
+        rows = []
+        for key, stime in current.items():
+            if key not in stored:
+                row = dict(zip(CURRENT_VERSION_KEYS, key))
+                row['stime'] = stime
+                rows.append(row)
+            elif stored[key][1] != stime:
+                connection.execute(table.update().where(
+                    table.c.id == stored[key][0]).values(stime=stime))
+        if rows:
+            insert_current_versions(connection, rows)
+
+
+def successful_package_change(session, package):
+    """
+    Whether a flushed package can change the current versions
+
+    That is if it became or stopped being SUCCESSFUL, or it is SUCCESSFUL and
+    its name, version, start time or release changed.
+    """
+    state = db.inspect(package)
+    if package in session.deleted:
+        return True
+    status = state.attrs.status.history
+    if status.has_changes():
+        return 'SUCCESSFUL' in status.sum()
+    return package.status == 'SUCCESSFUL' and any(
+        state.attrs[a].history.has_changes()
+        for a in ('name', 'version', 'stime', 'release_id'))
+
+
+@event.listens_for(Session, 'after_flush')
+def update_current_versions(session, flush_context):
+    """
+    Update the current versions of the packages changed by the flush
+
+    Only changes to SUCCESSFUL packages, see successful_package_change, and
+    releases which became or stopped being SUCCESSFUL matter, as with
+    by_release a package only counts once its whole release is SUCCESSFUL.
+    update_release_summaries records the latter, and runs first. Flushes
+    which do neither, such as starting a package, do nothing here.
+    """
+    names = set()
+    release_ids = set(session.info.pop('successful_releases_changed', ()))
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Package):
+            if not successful_package_change(session, obj):
+                continue
+            name = db.inspect(obj).attrs.name.history
+            if obj in session.deleted:
+                names.update(name.sum())
+            else:
+                names.add(obj.name)
+                names.update(name.deleted or ())
+        elif isinstance(obj, Release) and obj not in session.new and \
+                db.inspect(obj).attrs.platforms.history.has_changes():
+            release_ids.add(obj.id)
+
+    release_ids.discard(None)
+    release_ids = list(release_ids)
+    for i in range(0, len(release_ids), 500):
+        names.update(row.name for row in session.query(Package.name).filter(
+            Package.release_id.in_(release_ids[i:i + 500]),
+            Package.status == 'SUCCESSFUL').distinct())
+
+    if names:
+        refresh_current_versions(session, names)
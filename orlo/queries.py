@@ -1,10 +1,16 @@
 from __future__ import print_function
 import datetime
+import time
 import arrow
 from orlo.app import app
-from orlo.orm import db, Release, Platform, Package, release_platform
+from orlo.config import get_settings
+from orlo.orm import db, Release, Platform, Package, CurrentVersion, \
+    release_platform
 from orlo.exceptions import OrloError, InvalidUsage
-from sqlalchemy import and_, exc
+from orlo.instrumentation import collect_query_stats
+from orlo.util import decode_cursor
+from sqlalchemy import and_, or_, exc
+from sqlalchemy.orm import load_only, selectinload
 
 __author__ = 'alforbes'
 
@@ -38,7 +44,14 @@ def filter_release_status(query, status):
     Filter the given query by the given release status
 
     Release status is special, because it's actually determined by the
-    package status
+    package status. For SUCCESSFUL and NOT_STARTED, all packages must have
+    the status, which is true of a release without packages. For FAILED and
+    IN_PROGRESS, any package can have it, so a release can be both.
+
+    These are answered from the summary columns kept up to date by
+    orlo.orm.update_release_summaries. Release.status is FAILED when any
+    package has failed, and only has the status of the packages when they
+    all share it, or is None when there are none.
 
     :param query: Query object
     :param status: The status to filter on
@@ -50,40 +63,29 @@ def filter_release_status(query, status):
         raise InvalidUsage("Invalid package status, {} is not in {}".format(
             status, str(enums)))
     if status in ["SUCCESSFUL", "NOT_STARTED"]:
-        # ALL packages must match this status for it to apply to the release
-        # Query logic translates to "Releases which do not have any packages
-        # which satisfy
-        # the condition 'Package.status != status'". I.E, all match.
-        query = query.filter(
-            ~Release.packages.any(
-                Package.status != status
-            ))
-    elif status in ["FAILED", "IN_PROGRESS"]:
-        # ANY package can match for this status to apply to the release
-        query = query.filter(Release.packages.any(Package.status == status))
+        return query.filter(or_(Release.status == status,
+                                Release.status.is_(None)))
+    elif status == "FAILED":
+        return query.filter(Release.status == status)
     else:
-        app.logger.debug("Not filtering query on release status")
-    return query
+        # Release.status is FAILED if any package has failed, even if others
+        # are in progress
+        return query.filter(Release.has_in_progress == True)
 
 
 def filter_release_rollback(query, rollback):
     """
     Filter the given query by whether the releases are rollbacks or not
 
+    A release is a rollback if any of its packages are, this is kept up to
+    date in Release.has_rollback.
+
     :param query: Query object
     :param boolean rollback:
     :return:
     """
-    if rollback is True:
-        # Only count releases which have a rollback package
-        query = query.filter(
-            Release.packages.any(Package.rollback == True)
-        )
-    elif rollback is False:
-        # Only count releases which do not have any rollback packages
-        query = query.filter(
-            ~Release.packages.any(Package.rollback == True)
-        )
+    if rollback is True or rollback is False:
+        query = query.filter(Release.has_rollback == rollback)
     else:  # What the hell did you pass?
         raise TypeError(
             "Bad rollback parameter: '{}', type {}. Boolean expected.".format(
@@ -249,7 +251,120 @@ def apply_package_filters(query, args):
     return query
 
 
-def build_query(object_type, limit=None, offset=None, asc=None, **kwargs):
+# Relationships that are serialized by to_dict()
+SERIALIZED_RELATIONSHIPS = {
+    Release: ('packages', 'platforms', 'notes', 'metadata'),
+    Package: (),
+}
+
+
+def parse_fields(object_type, fields):
+    """
+    Parse and validate a comma separated list of fields to serialize
+
+    :param object_type: Release or Package
+    :param string fields: Comma separated field names, e.g. "id,stime,user"
+    :return: List of field names, or None if fields is empty
+    """
+    if not fields:
+        return None
+    fields = [f.strip() for f in fields.split(',') if f.strip()]
+    valid = list(object_type.serializers)
+    invalid = [f for f in fields if f not in valid]
+    if invalid:
+        raise InvalidUsage("Invalid fields {}, valid fields are {}".format(
+            ', '.join(invalid), ', '.join(sorted(valid))))
+    return fields
+
+
+def eager_load(query, object_type, fields=None):
+    """
+    Load the relationships serialized by to_dict() along with the query
+
+    Without this, each relationship is lazy loaded per object when it is
+    serialized. With it, each relationship is loaded for the whole result in
+    one extra query, so the number of queries does not grow with the number of
+    results.
+
+    :param query: Query object to add the loader options to
+    :param object_type: The object type being queried, Release or Package
+    :param list fields: If given, only load these columns and relationships.
+        id and stime are always loaded, as they are needed for ordering.
+    :return: Query
+    """
+    relationships = SERIALIZED_RELATIONSHIPS[object_type]
+
+    if fields is not None:
+        relationships = [r for r in relationships if r in fields]
+        columns = set(c.key for c in object_type.__table__.columns)
+        columns = columns.intersection(fields) | {'id', 'stime'}
+        query = query.options(
+            load_only(*[getattr(object_type, c) for c in columns]))
+
+    return query.options(
+        *[selectinload(getattr(object_type, r)) for r in relationships])
+
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+def explain_query(query):
+    """
+    Run a query and return the SQL executed, with its plan and timing
+
+    Used by explain=true on the listing routes, to tune filters and indexes.
+    This must be enabled with explain under [db], as it exposes the schema.
+
+    :param query: Query object, e.g. from build_query
+    :return: Dictionary of the rows returned, the time taken, and the
+        statements executed, which includes those of eager loads
+    """
+    if not get_settings().explain:
+        raise InvalidUsage("explain is not enabled, see [db] in the config")
+
+    with collect_query_stats() as stats:
+        start = time.time()
+        rows = len(query.all())
+        seconds = time.time() - start
+
+    connection = db.session.connection()
+    prefix = EXPLAIN_PREFIXES.get(connection.dialect.name)
+    statements = []
+    for statement, parameters in stats.statements:
+        # Skip savepoints and the like
+        if not statement.lstrip().upper().startswith('SELECT'):
+            continue
+        plan = None
+        if prefix:
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = [[str(c) for c in row] for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        if isinstance(parameters, dict):
+            parameters = dict((k, str(v)) for k, v in parameters.items())
+        else:
+            parameters = [str(v) for v in parameters]
+        statements.append({
+            'sql': statement,
+            'parameters': parameters,
+            'plan': plan,
+        })
+
+    return {
+        'rows': rows,
+        'seconds': round(seconds, 6),
+        'statements': statements,
+    }
+
+
+def build_query(object_type, limit=None, offset=None, asc=None, cursor=None,
+                fields=None, **kwargs):
     """
     Return whole releases, based on filters
 
@@ -257,6 +372,11 @@ def build_query(object_type, limit=None, offset=None, asc=None, **kwargs):
     :param limit: Max number of results to return
     :param offset: Offset results. Provides pagination when combined with limit.
     :param asc: Sort ascending instead of the default descending order
+    :param cursor: Only return results after this cursor, as returned in the
+        next_cursor field of a previous page. Unlike offset, this seeks
+        straight to the position by (stime, id), so deep pages are as fast as
+        the first one.
+    :param list fields: Only load these fields, see parse_fields
     :param kwargs: Request arguments
     :return:
     """
@@ -269,15 +389,13 @@ def build_query(object_type, limit=None, offset=None, asc=None, **kwargs):
             object_type
         ))
 
-    if any(field.startswith('package_') for field in kwargs.keys()) \
-            or ("status" in kwargs.keys() and object_type is Release):
+    if any(field.startswith('package_') for field in kwargs.keys()):
         if object_type is not Release:
             raise InvalidUsage(
                 "'package_' parameters are only valid for Release queries. "
                 "(hint: retry without the package_ prefix)")
         else:
-            # Package attributes need the join, as does status as it's really a
-            # package attribute
+            # Package attributes need the join
             query = db.session.query(object_type).join(Package)
     else:
         # No need to join on package if none of our params need it
@@ -296,12 +414,31 @@ def build_query(object_type, limit=None, offset=None, asc=None, **kwargs):
             "An invalid field for table {} was specified: {}".format(
                 object_type.__tablename__, e.args[0]))
 
+    if cursor:
+        cursor_stime, cursor_id = decode_cursor(cursor)
+        after_id = object_type.id > cursor_id if asc else \
+            object_type.id < cursor_id
+        if cursor_stime is None:
+            # Objects without an stime come last, ordered by id
+            query = query.filter(object_type.stime.is_(None), after_id)
+        else:
+            after_stime = object_type.stime > cursor_stime if asc else \
+                object_type.stime < cursor_stime
+            query = query.filter(or_(
+                after_stime,
+                and_(object_type.stime == cursor_stime, after_id),
+                object_type.stime.is_(None)))
+
+    # id breaks ties on stime, so that cursors have a stable position.
+    # Databases differ on where NULLs sort, so objects which have not started
+    # are explicitly put last, where the cursor expects them.
     if asc:
-        stime_field = object_type.stime.asc
+        query = query.order_by(object_type.stime.asc().nullslast(),
+                               object_type.id.asc())
     else:
-        stime_field = object_type.stime.desc
-
-    query = query.order_by(stime_field())
+        query = query.order_by(object_type.stime.desc().nullslast(),
+                               object_type.id.desc())
+    query = eager_load(query, object_type, fields)
 
     if limit:
         try:
@@ -466,7 +603,8 @@ def package_versions(platform=None, by_release=False):
 
     It is not sufficient to just return the highest version of each successful
     package, as they can be rolled back, so we determine the version by last
-    release time
+    release time. This is kept up to date in the current_version table, see
+    orlo.orm.update_current_versions.
 
     :param platform: Platform to filter on
     :param bool by_release: If true, a package, that is part of a release which
@@ -476,33 +614,61 @@ def package_versions(platform=None, by_release=False):
         Default: False.
     """
 
-    # Sub query gets a list of successful packages by last successful release
-    # time
+    q = db.session.query(
+            CurrentVersion.name,
+            CurrentVersion.version) \
+        .filter(CurrentVersion.by_release == bool(by_release),
+                CurrentVersion.platform == (platform or ''))
+
+    return q
+
+
+def package_versions_at(at, platform=None, by_release=False):
+    """
+    List the version of all packages at a point in time
+
+    As package_versions, but only packages which had finished by the given
+    time count, and with by_release, only releases which had finished.
+
+    The grouped subquery walks the (name, status, stime) index of package,
+    so all packages are answered in one query.
+
+    :param arrow.Arrow at: Time to list the versions at
+    :param platform: Platform to filter on
+    :param bool by_release: See package_versions
+    """
+    finished = or_(Package.ftime == None, Package.ftime <= at)
+
     sub_q = db.session.query(
             Package.name.label('name'),
             db.func.max(Package.stime).label('max_stime')) \
-        .filter(Package.status == 'SUCCESSFUL')
+        .filter(Package.status == 'SUCCESSFUL',
+                Package.stime <= at,
+                finished)
 
     if platform or by_release:
-        # Need to join on Release
         sub_q = sub_q.join(Release)
-    if platform:  # filter by platform
+    if platform:
         sub_q = sub_q.filter(Release.platforms.any(Platform.name == platform))
     if by_release:
-        # Filter out packages which are part of a release in progress,
-        # see issue#52
-        sub_q = filter_release_status(sub_q, status="SUCCESSFUL")
+        # The release is SUCCESSFUL now, and none of its packages finished
+        # after the given time, so it was SUCCESSFUL then
+        later = db.aliased(Package)
+        sub_q = sub_q.filter(
+            Release.status == 'SUCCESSFUL',
+            ~db.exists().where(and_(later.release_id == Release.id,
+                                    later.ftime > at)))
 
     sub_q = sub_q \
         .group_by(Package.name) \
         .subquery()
 
-    # q inner-joins Package table with sub_q to get the version
     q = db.session.query(
             Package.name,
             Package.version) \
         .join(sub_q, and_(sub_q.c.max_stime == Package.stime,
                           sub_q.c.name == Package.name)) \
+        .filter(Package.status == 'SUCCESSFUL', finished) \
         .group_by(Package.name, Package.version)
 
     return q
@@ -527,8 +693,8 @@ def count_releases(user=None, package=None, team=None, platform=None,
     Note that rollback and status are special fields when applied to a
     release, as they are Package attributes.
 
-    A "successful" or "in progress" release is defined as a release where all
-    packages match the status. Conversely, a "failed" or "not started" release
+    A "successful" or "not started" release is defined as a release where all
+    packages match the status. Conversely, a "failed" or "in progress" release
     is defined as a release where any package matches.
 
     For rollbacks, if any package is a rollback the release is included,
@@ -569,6 +735,86 @@ def count_releases(user=None, package=None, team=None, platform=None,
     return query
 
 
+def count_releases_by(field=None, value=None, platform=None, stime=None,
+                      ftime=None):
+    """
+    Count releases by status and rollback, grouped by a field
+
+    This returns the same numbers as calling count_releases once for each
+    combination of status and rollback, but does it for every value of the
+    field in a single query using conditional aggregates over Release.status
+    and Release.has_rollback.
+
+    :param string field: Field to group by, one of user, team, platform or
+        package. If None, a single row of global counts is returned
+    :param string value: Only count releases matching this value of field
+    :param string platform: Filter by platform
+    :param stime: Filter by releases that started after
+    :param ftime: Filter by releases that started before
+    :return: Query result [(value, total_successful, total_failed,
+        normal_successful, normal_failed, rollback_successful,
+        rollback_failed)], without the value column if field is None
+    """
+    group_fields = {
+        'user': Release.user,
+        'team': Release.team,
+        'platform': Platform.name,
+        'package': Package.name,
+    }
+    if field is not None and field not in group_fields:
+        raise InvalidUsage("Can not count releases by {}, must be one of "
+                           "{}".format(field, sorted(group_fields.keys())))
+
+    successful = Release.status == 'SUCCESSFUL'
+    failed = Release.status == 'FAILED'
+    normal = Release.has_rollback == False
+    rollback = Release.has_rollback == True
+
+    def count_where(*conditions):
+        return db.func.count(
+            db.distinct(db.case([(and_(*conditions), Release.id)])))
+
+    columns = [
+        count_where(successful).label('total_successful'),
+        count_where(failed).label('total_failed'),
+        count_where(normal, successful).label('normal_successful'),
+        count_where(normal, failed).label('normal_failed'),
+        count_where(rollback, successful).label('rollback_successful'),
+        count_where(rollback, failed).label('rollback_failed'),
+    ]
+
+    if field:
+        group_field = group_fields[field]
+        query = db.session.query(group_field.label('value'), *columns)
+    else:
+        query = db.session.query(*columns)
+
+    query = query.select_from(Release)
+
+    if field == 'platform':
+        query = query.join(Release.platforms)
+    elif field == 'package':
+        query = query.join(Release.packages)
+
+    if platform:
+        if field == 'platform':
+            query = query.filter(Platform.name == platform)
+        else:
+            query = query.filter(
+                Release.platforms.any(Platform.name == platform))
+    if field and value is not None:
+        query = query.filter(group_field == value)
+    if stime:
+        query = query.filter(Release.stime >= stime)
+    if ftime:
+        query = query.filter(Release.stime <= ftime)
+
+    if field:
+        query = query.group_by(group_field)
+
+    return query
+
+
 def count_packages(user=None, team=None, platform=None, status=None,
                    rollback=None):
     """
@@ -1,6 +1,9 @@
 from __future__ import print_function
+import logging
+import random
 from flask import jsonify, request
 from orlo.app import app
+from orlo.config import get_settings
 from orlo import __version__
 
 __author__ = 'alforbes'
@@ -10,16 +13,48 @@ Base application routes and general functions
 """
 
 
+class RequestBody(object):
+    """
+    The body of the current request, for logging
+
+    The body is only read when the log record is formatted, so nothing is read
+    unless a handler emits the record. Bodies longer than request_body_max are
+    not read at all, as that would buffer the whole body in memory.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+    def __str__(self):
+        length = request.content_length
+        if request.mimetype == 'application/x-ndjson':
+            # Streamed, reading it here would load the whole body into memory
+            return '<{} stream, not logged>'.format(request.mimetype)
+        if length is None or length > self.max_bytes:
+            return '<{} bytes, not logged>'.format(
+                length if length is not None else 'unknown')
+        return request.get_data(as_text=True).replace('\n', '')
+
+
 @app.before_request
-def log_post_data():
+def log_request():
     """
-    Before each request, log any POST data, without newlines
+    Before each request, log the method and URL, and the body at debug level
+
+    See [logging] in the config for the options.
     """
-    s = "{m} {u}".format(m=request.method, u=request.url)
-    data = request.get_data(as_text=True)
-    if data:
-        s += " POST data: {}".format(data.replace('\n', ''))
-    app.logger.info(s)
+    if not app.logger.isEnabledFor(logging.INFO):
+        return
+    settings = get_settings()
+    sample_rate = settings.request_sample_rate
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return
+
+    app.logger.info('%s %s', request.method, request.url)
+    max_bytes = settings.request_body_max
+    if max_bytes > 0 and request.content_length != 0 and \
+            request.method in ('POST', 'PUT', 'PATCH'):
+        app.logger.debug('%s data: %s', request.method, RequestBody(max_bytes))
 
 
 @app.route('/', methods=['GET'])
@@ -1,11 +1,19 @@
 import arrow
 import json
+import time
+import uuid
 from flask import jsonify, request
 from orlo.app import app
-from orlo.orm import db, Package, Release, PackageResult, ReleaseNote, Platform
-from orlo.util import validate_request_json
+from orlo.cache import invalidates_cache
+from orlo.config import config
+from orlo.exceptions import InvalidUsage
+from orlo.orm import db, Package, Release, PackageResult, ReleaseNote, \
+    Platform, release_platform, release_status, refresh_rollups, \
+    rollup_bucket, refresh_current_versions
+from orlo.util import validate_request_json, str_to_bool
 from orlo.user_auth import token_auth
 from sqlalchemy.orm import exc
+from six import string_types
 
 __author__ = 'alforbes'
 
@@ -24,6 +32,7 @@ def get_import():
 
 
 @app.route('/releases/import', methods=['POST'])
+@invalidates_cache
 def post_import():
     """
     Import a release.
@@ -82,11 +91,49 @@ def post_import():
         curl -v -X POST -d @releases.json 'http://127.0.0.1:5000/releases/import' -H \
         "Content-Type: application/json"
 
+    **Bulk import**:
+
+    Setting the bulk parameter inserts the releases with bulk inserts, in
+    batches of batch_size releases (default from the import:batch_size
+    config option), all within one transaction. Platforms are looked up once
+    for the whole document. Progress is logged after each batch, and the
+    response includes the throughput in releases per second.
+
+    .. sourcecode:: shell
+
+        curl -v -X POST -d @releases.json \
+        'http://127.0.0.1:5000/releases/import?bulk=true&batch_size=500' \
+        -H "Content-Type: application/json"
+
+    **Newline-delimited JSON**:
+
+    For very large imports, the document can instead be sent with the
+    Content-Type application/x-ndjson, with one release per line. It is read
+    from the request stream and inserted in batches as it arrives, so the
+    whole document is never held in memory. Each batch is committed
+    separately. Lines which can not be imported are reported in the errors
+    field of the response, and do not stop the rest of the import.
+
+    .. sourcecode:: shell
+
+        curl -v -X POST --data-binary @releases.ndjson \
+        'http://127.0.0.1:5000/releases/import' \
+        -H "Content-Type: application/x-ndjson"
+
+    :query bool bulk: Use bulk inserts
+    :query int batch_size: Number of releases to insert per batch, when bulk
+        is set or the document is newline-delimited JSON
     :status 200: The document was accepted
     """
 
+    if request.mimetype == 'application/x-ndjson':
+        return jsonify(ndjson_import(request.stream, get_batch_size())), 200
+
     validate_request_json(request)
 
+    if str_to_bool(request.args.get('bulk', 'false')):
+        return jsonify(bulk_import(request.json, get_batch_size())), 200
+
     releases = []
     for r in request.json:
         # Get the platform, create if it doesn't exist
@@ -146,3 +193,287 @@ def post_import():
         releases.append(release.id)
 
     return jsonify({'releases': [str(x) for x in releases]}), 200
+
+
+def get_batch_size():
+    """
+    Get the import batch size from the request, or the configured default
+    """
+    try:
+        batch_size = int(request.args.get('batch_size') or
+                         config.getint('import', 'batch_size'))
+    except ValueError:
+        raise InvalidUsage("batch_size must be a valid integer value")
+    if batch_size < 1:
+        raise InvalidUsage("batch_size must be greater than zero")
+    return batch_size
+
+
+def resolve_platforms(names):
+    """
+    Fetch the platforms with the given names in one query, creating any that
+    don't exist
+
+    :param names: Iterable of platform names
+    :return: Dictionary of platform name to Platform
+    """
+    names = set(names)
+    platforms = dict(
+        (p.name, p) for p in
+        db.session.query(Platform).filter(Platform.name.in_(names)))
+
+    for name in names - set(platforms.keys()):
+        app.logger.info("Creating platform {}".format(name))
+        platforms[name] = Platform(name)
+        db.session.add(platforms[name])
+    db.session.flush()
+
+    return platforms
+
+
+def release_mappings(r, platforms, mappings):
+    """
+    Add the bulk insert mappings for one release document to mappings
+
+    The fields are interpreted in the same way as post_import. Nothing is
+    added if the document is invalid.
+
+    :param dict r: Release document
+    :param dict platforms: Dictionary of platform name to Platform
+    :param dict mappings: Dictionary of lists to add to, with the keys
+        releases, release_platforms, packages and notes
+    :return: The ID of the release
+    """
+    release_id = uuid.uuid4()
+    statuses = Package.status.property.columns[0].type.enums
+
+    stime = arrow.get(r['stime']) if r.get('stime') else None
+    ftime = arrow.get(r['ftime']) if r.get('ftime') else None
+    release = {
+        'id': release_id,
+        'user': r['user'],
+        'team': r.get('team'),
+        'references': json.dumps(r.get('references')),
+        'stime': stime,
+        'ftime': ftime,
+        'duration': ftime - stime if stime and ftime else None,
+    }
+
+    if not isinstance(r['platforms'], list):
+        raise InvalidUsage("platforms must be a list")
+    release_platforms = [
+        {'release_id': release_id, 'platform_id': platforms[name].id}
+        for name in r['platforms']
+    ]
+
+    notes = [
+        {'id': uuid.uuid4(), 'release_id': release_id, 'content': n}
+        for n in r.get('notes') or []
+    ]
+
+    packages = []
+    for p in r['packages']:
+        if p.get('status') is not None and p['status'] not in statuses:
+            raise InvalidUsage("Invalid package status {}, must be one of "
+                               "{}".format(p['status'], statuses))
+        if p.get('stime'):
+            p_stime = arrow.get(p['stime'])
+        else:
+            p_stime = arrow.get(r['stime'])
+        p_ftime = arrow.get(p['ftime']) if p.get('ftime') else None
+        packages.append({
+            'id': uuid.uuid4(),
+            'release_id': release_id,
+            'name': p['name'],
+            'version': p['version'],
+            'rollback': p.get('rollback'),
+            'status': p.get('status'),
+            'diff_url': p.get('diff_url'),
+            'stime': p_stime,
+            'ftime': p_ftime,
+            'duration': p_ftime - p_stime if p_ftime else None,
+        })
+
+    # Bulk inserts skip the flush hooks that maintain these
+    release['status'] = release_status(p['status'] for p in packages)
+    release['has_rollback'] = any(bool(p['rollback']) for p in packages)
+    release['has_in_progress'] = any(p['status'] == 'IN_PROGRESS'
+                                     for p in packages)
+
+    mappings['releases'].append(release)
+    mappings['release_platforms'] += release_platforms
+    mappings['packages'] += packages
+    mappings['notes'] += notes
+    return release_id
+
+
+def new_mappings():
+    """
+    Return an empty set of mappings for release_mappings
+    """
+    return {
+        'releases': [],
+        'release_platforms': [],
+        'packages': [],
+        'notes': [],
+    }
+
+
+def insert_mappings(mappings):
+    """
+    Bulk insert the mappings built by release_mappings
+
+    The rollups and current versions are not refreshed, see refresh_rollups
+    and refresh_current_versions.
+
+    :param dict mappings:
+    :return: Set of the rollup buckets affected
+    """
+    if mappings['releases']:
+        db.session.bulk_insert_mappings(Release, mappings['releases'])
+    if mappings['release_platforms']:
+        db.session.execute(release_platform.insert(),
+                           mappings['release_platforms'])
+    if mappings['packages']:
+        db.session.bulk_insert_mappings(Package, mappings['packages'])
+    if mappings['notes']:
+        db.session.bulk_insert_mappings(ReleaseNote, mappings['notes'])
+
+    return set(rollup_bucket(m['stime'])
+               for m in mappings['releases'] + mappings['packages'])
+
+
+def log_batch(batch, imported, start, total=None):
+    """
+    Log the progress of an import after a batch
+
+    :param int batch: Batch number
+    :param int imported: Number of releases imported so far
+    :param float start: Time the import started
+    :param int total: Total number of releases, if known
+    """
+    app.logger.info(
+        "Imported batch {}: {}{} releases, {:.1f} releases/s".format(
+            batch, imported, ' of {}'.format(total) if total else '',
+            imported / max(time.time() - start, 1e-6)))
+
+
+def import_summary(release_ids, batches, start):
+    """
+    Summarise an import for the response
+    """
+    elapsed = time.time() - start
+    return {
+        'releases': [str(x) for x in release_ids],
+        'batches': batches,
+        'seconds': round(elapsed, 3),
+        'releases_per_second': round(len(release_ids) / max(elapsed, 1e-6), 1),
+    }
+
+
+def bulk_import(documents, batch_size):
+    """
+    Import a list of releases with bulk inserts
+
+    All batches are inserted in a single transaction.
+
+    :param list documents: List of release documents
+    :param int batch_size: Number of releases to insert per batch
+    :return: Dictionary of the created release IDs and throughput
+    """
+    platforms = resolve_platforms(
+        p for r in documents for p in r['platforms'])
+
+    release_ids = []
+    buckets = set()
+    names = set()
+    start = time.time()
+    batches = 0
+
+    for offset in range(0, len(documents), batch_size):
+        mappings = new_mappings()
+        for r in documents[offset:offset + batch_size]:
+            release_ids.append(release_mappings(r, platforms, mappings))
+        buckets.update(insert_mappings(mappings))
+        names.update(p['name'] for p in mappings['packages'])
+
+        batches += 1
+        log_batch(batches, len(release_ids), start, total=len(documents))
+
+    refresh_rollups(db.session, buckets)
+    refresh_current_versions(db.session, names)
+    db.session.commit()
+
+    return import_summary(release_ids, batches, start)
+
+
+def ndjson_import(stream, batch_size):
+    """
+    Import releases from a stream of newline-delimited JSON
+
+    Lines are read and inserted batch_size at a time, and each batch is
+    committed, so memory use does not depend on the size of the stream.
+    Invalid lines are skipped and reported, blank lines are ignored.
+
+    :param stream: File-like object yielding one release document per line
+    :param int batch_size: Number of releases to insert per batch
+    :return: Dictionary of the created release IDs, errors and throughput
+    """
+    release_ids = []
+    errors = []
+    start = time.time()
+    batches = 0
+
+    def insert_batch(lines):
+        documents = []
+        for line_number, line in lines:
+            try:
+                r = json.loads(line.decode('utf-8'))
+                if not isinstance(r, dict):
+                    raise ValueError("Release must be a JSON object")
+                documents.append((line_number, r))
+            except ValueError as e:
+                errors.append({'line': line_number, 'message': str(e)})
+
+        names = set()
+        for _, r in documents:
+            if isinstance(r.get('platforms'), list):
+                names.update(p for p in r['platforms']
+                             if isinstance(p, string_types))
+        platforms = resolve_platforms(names)
+
+        mappings = new_mappings()
+        for line_number, r in documents:
+            try:
+                release_ids.append(release_mappings(r, platforms, mappings))
+            except KeyError as e:
+                errors.append({'line': line_number,
+                               'message': "Missing field {}".format(e)})
+            except InvalidUsage as e:
+                errors.append({'line': line_number, 'message': e.message})
+            except (TypeError, ValueError, RuntimeError) as e:
+                # RuntimeError is the super-class of arrow's ParserError
+                errors.append({'line': line_number, 'message': str(e)})
+        refresh_rollups(db.session, insert_mappings(mappings))
+        refresh_current_versions(
+            db.session, set(p['name'] for p in mappings['packages']))
+        db.session.commit()
+
+    lines = []
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        lines.append((line_number, line))
+        if len(lines) >= batch_size:
+            insert_batch(lines)
+            lines = []
+            batches += 1
+            log_batch(batches, len(release_ids), start)
+    if lines:
+        insert_batch(lines)
+        batches += 1
+        log_batch(batches, len(release_ids), start)
+
+    summary = import_summary(release_ids, batches, start)
+    summary['errors'] = errors
+    return summary
@@ -1,8 +1,11 @@
 from __future__ import print_function
+import arrow
 from flask import request, jsonify, url_for
 from orlo.app import app
+from orlo.cache import cached_response, conditional_response
+from orlo.exceptions import InvalidUsage
 from orlo.util import str_to_bool
-from orlo.config import config
+from orlo.config import get_settings
 import orlo.queries as queries
 
 __author__ = 'alforbes'
@@ -33,6 +36,8 @@ def info_root():
 
 @app.route('/info/users', methods=['GET'])
 @app.route('/info/users/<username>', methods=['GET'])
+@conditional_response
+@cached_response
 def info_users(username=None):
     """
     Return a dictionary of users optionally filtering by platform
@@ -56,6 +61,8 @@ def info_users(username=None):
 
 @app.route('/info/platforms', methods=['GET'])
 @app.route('/info/platforms/<platform>', methods=['GET'])
+@conditional_response
+@cached_response
 def info_platforms(platform=None):
     """
     Return a summary of the platforms
@@ -76,6 +83,8 @@ def info_platforms(platform=None):
 
 @app.route('/info/packages', methods=['GET'])
 @app.route('/info/packages/<package>', methods=['GET'])
+@conditional_response
+@cached_response
 def info_packages(package=None):
     """
     Summary of packages
@@ -99,6 +108,8 @@ def info_packages(package=None):
 
 
 @app.route('/info/packages/list', methods=['GET'])
+@conditional_response
+@cached_response
 def info_package_list():
     """
     Return list of all known packages
@@ -114,6 +125,8 @@ def info_package_list():
 
 
 @app.route('/info/packages/versions', methods=['GET'])
+@conditional_response
+@cached_response
 def info_package_versions():
     """
     Return current version of all packages
@@ -123,16 +136,29 @@ def info_package_versions():
         is not SUCCESSFUL, will not be considered the current version, even if
         its own status is SUCCESSFUL. If false, a package will be the current
         version as long as its own status is SUCCESSFUL. Default: False.
+    :query string at: Return the versions at this time instead, counting only
+        packages and releases which had finished by then
     """
     platform = request.args.get('platform')
-    exclude_partial_releases = str_to_bool(
-        request.args.get('by_release') or \
-        config.get('behaviour', 'versions_by_release')
-    )
-
-    q = queries.package_versions(
-        platform=platform,
-        by_release=exclude_partial_releases)
+    by_release = request.args.get('by_release')
+    if by_release:
+        exclude_partial_releases = str_to_bool(by_release)
+    else:
+        exclude_partial_releases = get_settings().versions_by_release
+
+    if request.args.get('at'):
+        try:
+            at = arrow.get(request.args['at'])
+        except RuntimeError:  # super-class to arrow's ParserError
+            raise InvalidUsage("A badly formatted datetime string was given")
+        q = queries.package_versions_at(
+            at,
+            platform=platform,
+            by_release=exclude_partial_releases)
+    else:
+        q = queries.package_versions(
+            platform=platform,
+            by_release=exclude_partial_releases)
     result = q.all()
 
     packages = {}
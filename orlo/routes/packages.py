@@ -1,14 +1,16 @@
 from __future__ import print_function
-from flask import jsonify, request, Response, json, g
+from flask import jsonify, request, json, g
 from orlo.app import app
+from orlo.cache import conditional_response
 from orlo import queries
 from orlo.exceptions import InvalidUsage
 from orlo.user_auth import token_auth
-from orlo.orm import db, Release, Package, PackageResult, ReleaseNote, \
+from orlo.orm import Release, Package, PackageResult, ReleaseNote, \
     ReleaseMetadata, Platform
 from orlo.util import validate_request_json, create_release, \
     validate_release_input, validate_package_input, fetch_release, \
-    create_package, fetch_package, stream_json_list, str_to_bool, is_uuid
+    create_package, fetch_package, stream_list, str_to_bool, is_uuid, \
+    prefetch
 from orlo.user_auth import conditional_auth
 
 __author__ = 'alforbes'
@@ -23,15 +25,25 @@ fixing errors.
 
 @app.route('/packages', methods=['GET'])
 @app.route('/packages/<package_id>', methods=['GET'])
+@conditional_response
 def get_packages(package_id=None):
     """
     Return a list of packages to the client
 
     :param package_id:
+    :query string cursor: Return the page after this cursor, as given in the
+        next_cursor field of the previous page
+    :query string format: json (default) or ndjson, one package per line
+    :query string fields: Comma separated list of fields to return
+    :query bool explain: Instead of the packages, return the SQL executed with
+        its parameters, query plan and timing. Requires explain under [db].
     :return:
     """
 
     booleans = ('rollback', )
+    page_size = None
+    output_format = request.args.get('format', 'json')
+    fields = queries.parse_fields(Package, request.args.get('fields'))
 
     if package_id:  # Simple, just fetch one package
         if not is_uuid(package_id):
@@ -44,19 +56,26 @@ def get_packages(package_id=None):
             'limit': 100
         }
         for k in request.args.keys():
+            if k in ('format', 'fields', 'explain'):
+                continue
             if k in booleans:
                 args[k] = str_to_bool(request.args.get(k))
             else:
                 args[k] = request.args.get(k)
-        query = queries.build_query(Package, **args)
+        query = queries.build_query(Package, fields=fields, **args)
+        # limit has been validated by build_query
+        page_size = int(args['limit'])
+
+    if str_to_bool(request.args.get('explain', 'false')):
+        return jsonify(queries.explain_query(query)), 200
 
     # Execute eagerly to avoid confusing stack traces within the Response on
-    # error
-    db.session.execute(query)
+    # error, and to find out whether there are any results
+    results = prefetch(query)
 
-    if query.count() == 0:
+    if results is None:
         response = jsonify(message="No packages found", packages=[])
         return response, 404
 
-    return Response(stream_json_list('packages', query),
-                    content_type='application/json')
+    return stream_list('packages', results, output_format=output_format,
+                       page_size=page_size, fields=fields)
@@ -1,4 +1,4 @@
-from flask import jsonify, request, Response, json, g
+from flask import jsonify, request, json, g
 from orlo.app import app
 from orlo import queries
 from orlo.config import config
@@ -8,14 +8,17 @@ from orlo.orm import db, Release, Package, PackageResult, ReleaseNote, \
     ReleaseMetadata, Platform
 from orlo.util import validate_request_json, create_release, \
     validate_release_input, validate_package_input, fetch_release, \
-    create_package, fetch_package, stream_json_list, str_to_bool, is_uuid
+    create_package, fetch_package, stream_list, str_to_bool, is_uuid, \
+    prefetch
 from orlo.user_auth import conditional_auth
+from orlo.cache import conditional_response, invalidates_cache
 
 security_enabled = config.getboolean('security', 'enabled')
 
 
 @app.route('/releases', methods=['POST'])
 @conditional_auth(conditional_auth(token_auth.token_required))
+@invalidates_cache
 def post_releases():
     """
     Create a release - the first step in a deployment
@@ -67,6 +70,7 @@ def post_releases():
 
 @app.route('/releases/<release_id>/packages', methods=['POST'])
 @conditional_auth(token_auth.token_required)
+@invalidates_cache
 def post_packages(release_id):
     """
     Add a package to a release
@@ -106,6 +110,7 @@ def post_packages(release_id):
 @app.route('/releases/<release_id>/packages/<package_id>/results',
            methods=['POST'])
 @conditional_auth(token_auth.token_required)
+@invalidates_cache
 def post_results(release_id, package_id):
     """
     Post the results of a package release
@@ -125,6 +130,7 @@ def post_results(release_id, package_id):
 
 @app.route('/releases/<release_id>/start', methods=['POST'])
 @conditional_auth(token_auth.token_required)
+@invalidates_cache
 def post_releases_start(release_id):
     """
     Indicate that a release is starting
@@ -143,6 +149,7 @@ def post_releases_start(release_id):
 
 @app.route('/releases/<release_id>/stop', methods=['POST'])
 @conditional_auth(token_auth.token_required)
+@invalidates_cache
 def post_releases_stop(release_id):
     """
     Indicate that a release has finished
@@ -172,6 +179,7 @@ def post_releases_stop(release_id):
 @app.route('/releases/<release_id>/packages/<package_id>/start',
            methods=['POST'])
 @conditional_auth(token_auth.token_required)
+@invalidates_cache
 def post_packages_start(release_id, package_id):
     """
     Indicate that a package has started deploying
@@ -200,6 +208,7 @@ def post_packages_start(release_id, package_id):
 @app.route('/releases/<release_id>/packages/<package_id>/stop',
            methods=['POST'])
 @conditional_auth(token_auth.token_required)
+@invalidates_cache
 def post_packages_stop(release_id, package_id):
     """
     Indicate that a package has finished deploying
@@ -231,6 +240,7 @@ def post_packages_stop(release_id, package_id):
 
 @app.route('/releases/<release_id>/notes', methods=['POST'])
 @conditional_auth(token_auth.token_required)
+@invalidates_cache
 def post_releases_notes(release_id):
     """
     Add a note to a release
@@ -253,6 +263,7 @@ def post_releases_notes(release_id):
 
 @app.route('/releases/<release_id>/metadata', methods=['POST'])
 @conditional_auth(token_auth.token_required)
+@invalidates_cache
 def post_releases_metadata(release_id):
     """
     Add metadata to a release
@@ -279,6 +290,7 @@ def post_releases_metadata(release_id):
 
 @app.route('/releases', methods=['GET'])
 @app.route('/releases/<release_id>', methods=['GET'])
+@conditional_response
 def get_releases(release_id=None):
     """
     Return a list of releases to the client, filters optional
@@ -290,6 +302,16 @@ def get_releases(release_id=None):
         ascending
     :query int limit: Limit the results by int (default 100)
     :query int offset: Offset the results by int
+    :query string cursor: Return the page after this cursor, as given in the
+        next_cursor field of the previous page. Prefer this to offset when
+        walking through many pages.
+    :query string format: json (default) or ndjson. ndjson returns one
+        release per line, which can be processed as it arrives. It does not
+        include next_cursor, set limit=0 to stream every matching release.
+    :query string fields: Comma separated list of fields to return, e.g.
+        id,stime,user. Only these fields are loaded from the database.
+    :query bool explain: Instead of the releases, return the SQL executed with
+        its parameters, query plan and timing. Requires explain under [db].
     :query string user: Filter releases by user the that performed the release
     :query string platform: Filter releases by platform
     :query string stime_before: Only include releases that started before \
@@ -322,14 +344,27 @@ def get_releases(release_id=None):
 
     **Note on status**:
         The release status is calculated from the packages it contains. The
-        possible values are the same as a package. For a release to be
-        considered "SUCCESSFUL" or "NOT_STARTED", all packages must have this
-        value. If any one package has the value "IN_PROGRESS" or "FAILED",
-        that status applies to the whole release, with "FAILED" overriding
-        "IN_PROGRESS".
+        possible values are the same as a package. When filtering, for a
+        release to be considered "SUCCESSFUL" or "NOT_STARTED", all packages
+        must have this value. If any one package has the value "IN_PROGRESS"
+        or "FAILED", the release matches that status, so a release can match
+        both.
+
+        The status field of a release is a single value, with "FAILED"
+        overriding "IN_PROGRESS". A release with some packages successful
+        and others not started is "IN_PROGRESS", and a release without
+        packages has no status.
+
+    **Note on pagination**:
+        Lists of releases include a next_cursor field, which is null when
+        the page was not full, so there are no more results. Releases without
+        a start time are listed after all of the others.
     """
 
     booleans = ('rollback', 'package_rollback',)
+    page_size = None
+    output_format = request.args.get('format', 'json')
+    fields = queries.parse_fields(Release, request.args.get('fields'))
 
     if release_id:  # Simple, just fetch one release
         if not is_uuid(release_id):
@@ -343,19 +378,26 @@ def get_releases(release_id=None):
         # Flatten args, as the ImmutableDict puts some values in a list when
         # expanded
         for k in request.args.keys():
+            if k in ('format', 'fields', 'explain'):
+                continue
             if k in booleans:
                 args[k] = str_to_bool(request.args.get(k))
             else:
                 args[k] = request.args.get(k)
-        query = queries.build_query(Release, **args)
+        query = queries.build_query(Release, fields=fields, **args)
+        # limit has been validated by build_query
+        page_size = int(args['limit'])
+
+    if str_to_bool(request.args.get('explain', 'false')):
+        return jsonify(queries.explain_query(query)), 200
 
     # Execute eagerly to avoid confusing stack traces within the Response on
-    # error
-    db.session.execute(query)
+    # error, and to find out whether there are any results
+    results = prefetch(query)
 
-    if query.count() == 0:
+    if results is None:
         response = jsonify(message="No releases found", releases=[])
         return response, 404
 
-    return Response(stream_json_list('releases', query),
-                    content_type='application/json')
+    return stream_list('releases', results, output_format=output_format,
+                       page_size=page_size, fields=fields)
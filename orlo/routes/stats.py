@@ -3,6 +3,7 @@ from flask import request, jsonify
 
 from orlo import stats
 from orlo.app import app
+from orlo.cache import cached_response, conditional_response
 from orlo.exceptions import InvalidUsage
 import orlo.queries as queries
 
@@ -14,62 +15,66 @@ broken down a different way
 """
 
 
+def releases_stats_dict(counts=None):
+    """
+    Build the stats dictionary for a single row of release counts
+
+    :param counts: A row returned by queries.count_releases_by, or None for
+        all zeros
+    :return:
+    """
+    def count(name):
+        return getattr(counts, name) if counts is not None else 0
+
+    return {
+        'releases': {
+            'normal': {
+                'successful': count('normal_successful'),
+                'failed': count('normal_failed'),
+            },
+            'rollback': {
+                'successful': count('rollback_successful'),
+                'failed': count('rollback_failed'),
+            },
+            'total': {
+                'successful': count('total_successful'),
+                'failed': count('total_failed'),
+            },
+        }
+    }
+
+
 def build_stats_dict(field, value_list, platform=None, stime=None, ftime=None):
     """
     Build a dictionary of our stats
 
+    All values are counted in a single query, see queries.count_releases_by
+
     :param field: The field we are build stats for, i.e. user, package, team or
         platform
     :param value_list: The list of values for the field
     :param platform: Filter by platform
-    :param datetime ftime: Passed to count_releases
-    :param datetime stime: Passed to count_releases
+    :param datetime ftime: Passed to count_releases_by
+    :param datetime stime: Passed to count_releases_by
     :return:
     """
 
     app.logger.debug("Entered build_stats_dict")
 
     d_stats = {}
-    count_releases_args = {
-        'stime': stime,
-        'ftime': ftime,
-        'platform': platform,  # platform can also be the field in the loop below
-    }
-
     for field_value in value_list:
-        app.logger.debug("Getting stats for {} {}".format(field, field_value))
-
-        count_releases_args[field] = field_value  # e.g. need to pass user=username
-
-        c_total_successful = queries.count_releases(
-                status='SUCCESSFUL', **count_releases_args).all()[0][0]
-        c_total_failed = queries.count_releases(
-                status='FAILED', **count_releases_args).all()[0][0]
-        c_normal_successful = queries.count_releases(
-                rollback=False, status='SUCCESSFUL', **count_releases_args).all()[0][0]
-        c_normal_failed = queries.count_releases(
-                rollback=False, status='FAILED', **count_releases_args).all()[0][0]
-        c_rollback_successful = queries.count_releases(
-                rollback=True, status='SUCCESSFUL', **count_releases_args).all()[0][0]
-        c_rollback_failed = queries.count_releases(
-                rollback=True, status='FAILED', **count_releases_args).all()[0][0]
-
-        d_stats[field_value] = {
-            'releases': {
-                'normal': {
-                    'successful': c_normal_successful,
-                    'failed': c_normal_failed,
-                },
-                'rollback': {
-                    'successful': c_rollback_successful,
-                    'failed': c_rollback_failed,
-                },
-                'total': {
-                    'successful': c_total_successful,
-                    'failed': c_total_failed,
-                },
-            }
-        }
+        d_stats[field_value] = releases_stats_dict()
+
+    # Push the filter down to the database when we only want one value
+    value = value_list[0] if len(value_list) == 1 else None
+
+    app.logger.debug("Getting stats for {}".format(field))
+    query = queries.count_releases_by(
+        field, value=value, platform=platform, stime=stime, ftime=ftime)
+
+    for row in query:
+        if row.value in d_stats:
+            d_stats[row.value] = releases_stats_dict(row)
 
     return d_stats
 
@@ -78,57 +83,27 @@ def build_all_stats_dict(stime=None, ftime=None):
     """
     Build a dictionary of our stats
 
-    :param datetime ftime: Passed to count_releases
-    :param datetime stime: Passed to count_releases
+    :param datetime ftime: Passed to count_releases_by
+    :param datetime stime: Passed to count_releases_by
 
     :return:
     """
 
     app.logger.debug("Entered build_all_stats_dict")
 
-    count_releases_args = {
-        'stime': stime,
-        'ftime': ftime,
-    }
-
     app.logger.debug("Getting global stats")
-
-    c_total_successful = queries.count_releases(
-            status='SUCCESSFUL', **count_releases_args).all()[0][0]
-    c_total_failed = queries.count_releases(
-            status='FAILED', **count_releases_args).all()[0][0]
-    c_normal_successful = queries.count_releases(
-            rollback=False, status='SUCCESSFUL', **count_releases_args).all()[0][0]
-    c_normal_failed = queries.count_releases(
-            rollback=False, status='FAILED', **count_releases_args).all()[0][0]
-    c_rollback_successful = queries.count_releases(
-            rollback=True, status='SUCCESSFUL', **count_releases_args).all()[0][0]
-    c_rollback_failed = queries.count_releases(
-            rollback=True, status='FAILED', **count_releases_args).all()[0][0]
+    counts = queries.count_releases_by(stime=stime, ftime=ftime).one()
 
     d_stats = {
-        'global': {
-            'releases': {
-                'normal': {
-                    'successful': c_normal_successful,
-                    'failed': c_normal_failed,
-                },
-                'rollback': {
-                    'successful': c_rollback_successful,
-                    'failed': c_rollback_failed,
-                },
-                'total': {
-                    'successful': c_total_successful,
-                    'failed': c_total_failed,
-                },
-            }
-        }
+        'global': releases_stats_dict(counts)
     }
 
     return d_stats
 
 
 @app.route('/stats')
+@conditional_response
+@cached_response
 def stats_():
     """
     Return dictionary of global stats
@@ -156,6 +131,8 @@ def stats_():
 
 @app.route('/stats/user')
 @app.route('/stats/user/<username>')
+@conditional_response
+@cached_response
 def stats_user(username=None):
     """
     Return a dictionary of statistics for a username (optional), or all users
@@ -195,6 +172,8 @@ def stats_user(username=None):
 
 @app.route('/stats/team')
 @app.route('/stats/team/<team>')
+@conditional_response
+@cached_response
 def stats_team(team=None):
     """
     Return a dictionary of statistics for a team (optional), or all teams
@@ -231,6 +210,8 @@ def stats_team(team=None):
 
 @app.route('/stats/platform')
 @app.route('/stats/platform/<platform>')
+@conditional_response
+@cached_response
 def stats_platform(platform=None):
     """
     Return a dictionary of statistics for a platform name (optional), or all platforms
@@ -268,6 +249,8 @@ def stats_platform(platform=None):
 
 @app.route('/stats/package')
 @app.route('/stats/package/<package>')
+@conditional_response
+@cached_response
 def stats_package(package=None):
     """
     Return a dictionary of statistics for a package name (optional), or all packages
@@ -304,6 +287,8 @@ def stats_package(package=None):
 
 
 @app.route('/stats/by_date/<subject>')
+@conditional_response
+@cached_response
 def stats_by_date(subject='release'):
     """
     Return stats by date
@@ -315,6 +300,10 @@ def stats_by_date(subject='release'):
 
     This endpoint also allows filtering on the same fields as GET /releases, e.g stime_gt. See
     that endpoint for documentation.
+
+    When the only filters are platform, team, user or (for packages) package_name, and the unit
+    is one of year, month, week, iso, day or hour, the counts come from the hourly rollup tables
+    rather than the releases themselves.
     """
 
     # Get the filters into an args directory, if they are set
@@ -332,7 +321,7 @@ def stats_by_date(subject='release'):
     elif subject == 'package':
         release_stats = stats.packages_by_time(unit, summarize_by_unit, **filters)
     else:
-        raise InvalidUsage("subject must release or package, not '{}'".format())
+        raise InvalidUsage("subject must release or package, not '{}'".format(subject))
 
     return jsonify(release_stats)
 
@@ -1,8 +1,8 @@
 from __future__ import print_function
-from collections import OrderedDict
-from orlo.queries import apply_filters, filter_release_rollback, filter_release_status
+from collections import OrderedDict, namedtuple
+from orlo.queries import apply_filters
 from orlo.app import app
-from orlo.orm import db, Release, Package
+from orlo.orm import db, Release, Package, ReleaseRollup, PackageRollup
 from orlo.exceptions import InvalidUsage
 
 __author__ = 'alforbes'
@@ -12,13 +12,60 @@ Functions related to building statistics
 """
 
 
+# Filters which the rollup tables can answer, anything else is counted from
+# the release and package tables
+RELEASE_ROLLUP_FILTERS = ('platform', 'team', 'user')
+PACKAGE_ROLLUP_FILTERS = ('platform', 'team', 'user', 'package_name')
+# Units which can be computed from the start of an hour
+ROLLUP_UNITS = ('iso', 'hour', 'day', 'week', 'month', 'year')
+
+# Units of add_objects_by_time_to_dict mapped to the truncation which keeps
+# all the parts of the time that are used
+TRUNCATE_UNITS = {
+    'year': 'year',
+    'month': 'month',
+    'week': 'day',
+    'iso': 'day',
+    'day': 'day',
+    'hour': 'hour',
+}
+# As above, but for summarize_by_unit, where the unit is an attribute
+SUMMARY_TRUNCATE_UNITS = {
+    'year': 'year',
+    'month': 'month',
+    'week': 'day',
+    'day': 'day',
+    'hour': 'hour',
+}
+TRUNCATE_FORMATS = {
+    'year': '%Y-01-01 00:00:00',
+    'month': '%Y-%m-01 00:00:00',
+    'day': '%Y-%m-%d 00:00:00',
+    'hour': '%Y-%m-%d %H:00:00',
+}
+
+# Categories in the order they are added to the dictionary, as
+# ((<normal|rollback>, <successful|failed>), rollback, status)
+TIME_CATEGORIES = (
+    (('normal', 'successful'), False, 'SUCCESSFUL'),
+    (('normal', 'failed'), False, 'FAILED'),
+    (('rollback', 'successful'), True, 'SUCCESSFUL'),
+    (('rollback', 'failed'), True, 'FAILED'),
+)
+
+
 def releases_by_time(unit, summarize_by_unit=False, **kwargs):
     """
     Return stats by time from the given arguments
 
+    Answered from the rollup tables when the filters allow.
+
     :param summarize_by_unit: Passed to add_release_by_time_to_dict()
     :param unit: Passed to add_release_by_time_to_dict()
     """
+    if can_use_rollups(unit, kwargs, RELEASE_ROLLUP_FILTERS):
+        return get_dict_of_rollups_by_time(
+            ReleaseRollup, unit, summarize_by_unit, **kwargs)
 
     query = db.session.query(Release.id, Release.stime)\
         .join(Package)\
@@ -32,9 +79,14 @@ def packages_by_time(unit, summarize_by_unit=False, **kwargs):
     """
     Count packages by time from the filters given
 
+    Answered from the rollup tables when the filters allow.
+
     :param summarize_by_unit: Passed to add_release_by_time_to_dict()
     :param unit: Passed to add_release_by_time_to_dict()
     """
+    if can_use_rollups(unit, kwargs, PACKAGE_ROLLUP_FILTERS):
+        return get_dict_of_rollups_by_time(
+            PackageRollup, unit, summarize_by_unit, **kwargs)
 
     query = db.session.query(Package.id, Package.name, Package.stime)\
         .join(Release)
@@ -47,48 +99,151 @@ def packages_by_time(unit, summarize_by_unit=False, **kwargs):
 # or generalise a stats_time function
 
 
+def can_use_rollups(unit, filters, allowed_filters):
+    """
+    Whether the rollup tables can answer a query by time
+
+    :param string unit: The unit to group by
+    :param dict filters: The filters given
+    :param tuple allowed_filters: The filters the rollup table supports
+    """
+    return unit in ROLLUP_UNITS and all(f in allowed_filters for f in filters)
+
+
+def get_dict_of_rollups_by_time(rollup, unit, summarize_by_unit=False,
+                                **filters):
+    """
+    Build the same dictionary as get_dict_of_objects_by_time from a rollup
+    table, re-aggregating the hourly buckets to the unit
+
+    :param rollup: ReleaseRollup or PackageRollup
+    :param string unit: See add_objects_by_time_to_dict
+    :param boolean summarize_by_unit: See add_objects_by_time_to_dict
+    :param filters: Filters, see RELEASE_ROLLUP_FILTERS and
+        PACKAGE_ROLLUP_FILTERS
+    :return:
+    """
+    columns = [rollup.bucket.label('stime')]
+    if rollup is PackageRollup:
+        columns.append(rollup.name)
+    query = db.session.query(
+        db.func.sum(rollup.count).label('count'),
+        rollup.rollback, rollup.status, *columns)
+
+    # Rows with an empty platform hold the totals across platforms
+    query = query.filter(rollup.platform == (filters.get('platform') or ''))
+    if 'team' in filters:
+        query = query.filter(rollup.team == filters['team'])
+    if 'user' in filters:
+        query = query.filter(rollup.user == filters['user'])
+    if 'package_name' in filters:
+        query = query.filter(rollup.name == filters['package_name'])
+
+    query = query \
+        .filter(rollup.status.in_(['SUCCESSFUL', 'FAILED'])) \
+        .group_by(rollup.rollback, rollup.status, *columns) \
+        .order_by(rollup.bucket)
+
+    output_dict = OrderedDict()
+    add_counts_by_time_to_dict(query, output_dict, unit, summarize_by_unit)
+    return output_dict
+
+
 def get_dict_of_objects_by_time(query, unit, summarize_by_unit=False):
     """
     Build a dictionary which summarises the objects in the query given
 
+    The objects are counted by time, release status and rollback in one
+    query.
+
     :param query:
     :param unit:
     :param summarize_by_unit:
     :return:
     """
-
-    # Build queries for the individual stats
-    q_normal_successful = filter_release_status(
-        filter_release_rollback(query, rollback=False), 'SUCCESSFUL'
-    )
-    q_normal_failed = filter_release_status(
-        filter_release_rollback(query, rollback=False), 'FAILED'
-    )
-    q_rollback_successful = filter_release_status(
-        filter_release_rollback(query, rollback=True), 'SUCCESSFUL'
-    )
-    q_rollback_failed = filter_release_status(
-        filter_release_rollback(query, rollback=True), 'FAILED'
-    )
+    query = query \
+        .add_columns(Release.has_rollback.label('rollback'),
+                     Release.status.label('status')) \
+        .filter(Release.status.in_(['SUCCESSFUL', 'FAILED']),
+                Release.has_rollback != None)
 
     output_dict = OrderedDict()
-
-    add_objects_by_time_to_dict(
-        q_normal_successful, output_dict, ('normal', 'successful'), unit,
-        summarize_by_unit)
-    add_objects_by_time_to_dict(
-        q_normal_failed, output_dict, ('normal', 'failed'), unit,
-        summarize_by_unit)
-    add_objects_by_time_to_dict(
-        q_rollback_successful, output_dict, ('rollback', 'successful'), unit,
-        summarize_by_unit)
-    add_objects_by_time_to_dict(
-        q_rollback_failed, output_dict, ('rollback', 'failed'), unit,
-        summarize_by_unit)
+    add_counts_by_time_to_dict(
+        count_objects_by_time(query, unit, summarize_by_unit), output_dict,
+        unit, summarize_by_unit)
 
     return output_dict
 
 
+def add_counts_by_time_to_dict(rows, releases_dict, unit='month',
+                               summarize_by_unit=False):
+    """
+    Add counts by time, release status and rollback to a dictionary
+
+    The categories are added in the order of TIME_CATEGORIES, as if each had
+    been added by add_objects_by_time_to_dict in turn.
+
+    :param rows: Rows with stime, rollback, status and count attributes, and
+        optionally name
+    :param dict releases_dict: Dict to add to
+    :param string unit: See add_objects_by_time_to_dict
+    :param boolean summarize_by_unit: See add_objects_by_time_to_dict
+    """
+    categories = {}
+    for row in rows:
+        categories.setdefault((row.rollback, row.status), []).append(row)
+
+    for t_category, rollback, status in TIME_CATEGORIES:
+        for row in categories.get((rollback, status), []):
+            tree_args = time_tree_args(row.stime, unit, summarize_by_unit)
+            if hasattr(row, 'name'):
+                tree_args.append(row.name)
+            tree_args += t_category
+            add_to_tree(releases_dict, tree_args, row.count)
+
+
+def count_objects_by_time(query, unit='month', summarize_by_unit=False):
+    """
+    Count the objects in a query by start time and any other columns
+
+    Where the database supports it, the objects are counted by truncated
+    start time in SQL, see truncate_time. Otherwise each object is fetched
+    and counted as one.
+
+    :param query query: Query with stime and optionally id columns. Any other
+        columns are grouped by.
+    :param string unit: See add_objects_by_time_to_dict
+    :param boolean summarize_by_unit: See add_objects_by_time_to_dict
+    :return: Rows with stime and count attributes, and one for each of the
+        other columns
+    """
+    names = [c['name'] for c in query.column_descriptions
+             if c['name'] not in ('id', 'stime')]
+
+    if summarize_by_unit:
+        truncate_unit = SUMMARY_TRUNCATE_UNITS.get(unit)
+    else:
+        truncate_unit = TRUNCATE_UNITS.get(unit)
+
+    objects = query.subquery()
+    bucket = None
+    if truncate_unit:
+        bucket = truncate_time(objects.c.stime, truncate_unit,
+                               db.engine.dialect.name)
+
+    if bucket is None:
+        row_type = namedtuple('Count', ['stime', 'count'] + names)
+        return (row_type(o.stime, 1, *[getattr(o, n) for n in names])
+                for o in query)
+
+    buckets = db.session.query(
+        bucket.label('stime'), *[objects.c[n] for n in names]).subquery()
+    columns = list(buckets.c)
+    return db.session.query(db.func.count().label('count'), *columns) \
+        .group_by(*columns) \
+        .order_by(buckets.c.stime)
+
+
 def add_objects_by_time_to_dict(query, releases_dict, t_category, unit='month',
                                 summarize_by_unit=False):
     """
@@ -110,39 +265,90 @@ def add_objects_by_time_to_dict(query, releases_dict, t_category, unit='month',
     **Note**: this can also be use for packages
     """
     app.logger.debug("Entered add_objects_by_time_to_dict")
-    for object_ in query:
-        if summarize_by_unit:
-            tree_args = [str(getattr(object_.stime, unit))]
-        else:
-            if unit == 'year':
-                tree_args = [str(object_.stime.year)]
-            elif unit == 'month':
-                tree_args = [str(object_.stime.year), str(object_.stime.month)]
-            elif unit == 'week':
-                # First two args of isocalendar(), year and week
-                tree_args = [str(i) for i in object_.stime.isocalendar()][0:2]
-            elif unit == 'iso':
-                tree_args = [str(i) for i in object_.stime.isocalendar()]
-            elif unit == 'day':
-                tree_args = [str(object_.stime.year), str(object_.stime.month),
-                             str(object_.stime.day)]
-            elif unit == 'hour':
-                tree_args = [str(object_.stime.year), str(object_.stime.month),
-                             str(object_.stime.day), str(object_.stime.hour)]
-            else:
-                raise InvalidUsage(
-                    'Invalid unit "{}" specified for release breakdown'.format(
-                        unit))
-        if hasattr(object_, 'name'):
-            tree_args.append(object_.name)
+    for row in count_objects_by_time(query, unit, summarize_by_unit):
+        tree_args = time_tree_args(row.stime, unit, summarize_by_unit)
+        if hasattr(row, 'name'):
+            tree_args.append(row.name)
         # Append categories
         tree_args += t_category
-        append_tree_recursive(releases_dict, tree_args[0], tree_args)
+        add_to_tree(releases_dict, tree_args, row.count)
+
+
+def truncate_time(column, unit, dialect):
+    """
+    Truncate a time column to the start of the year, month, day or hour
+
+    :param column: Column of ArrowType
+    :param string unit: One of 'year', 'month', 'day' or 'hour'
+    :param string dialect: Name of the database dialect
+    :return: Column expression of the same type, or None if the dialect is
+        not supported
+    """
+    if dialect == 'postgresql':
+        expression = db.func.date_trunc(unit, column)
+    elif dialect in ('sqlite', 'mysql'):
+        # The formats of SQLite's strftime and MySQL's DATE_FORMAT agree here
+        fmt = TRUNCATE_FORMATS[unit]
+        if dialect == 'sqlite':
+            expression = db.func.strftime(fmt, column)
+        else:
+            expression = db.func.date_format(column, fmt)
+    else:
+        return None
+    return db.type_coerce(expression, column.type)
+
+
+def time_tree_args(stime, unit, summarize_by_unit=False):
+    """
+    Return the path in the dictionary for a time, see
+    add_objects_by_time_to_dict
+
+    :param stime: Arrow object
+    :param string unit: Can be 'iso', 'hour', 'day', 'week', 'month', 'year'
+    :param boolean summarize_by_unit: Return only the unit
+    :return: List of strings
+    """
+    if summarize_by_unit:
+        return [str(getattr(stime, unit))]
+    # Arrow looks up the parts of the time dynamically, which is slow
+    stime = getattr(stime, 'datetime', stime)
+    if unit == 'year':
+        return [str(stime.year)]
+    elif unit == 'month':
+        return [str(stime.year), str(stime.month)]
+    elif unit == 'week':
+        # First two args of isocalendar(), year and week
+        return [str(i) for i in stime.isocalendar()][0:2]
+    elif unit == 'iso':
+        return [str(i) for i in stime.isocalendar()]
+    elif unit == 'day':
+        return [str(stime.year), str(stime.month), str(stime.day)]
+    elif unit == 'hour':
+        return [str(stime.year), str(stime.month), str(stime.day),
+                str(stime.hour)]
+    else:
+        raise InvalidUsage(
+            'Invalid unit "{}" specified for release breakdown'.format(unit))
+
+
+def add_to_tree(tree, nodes, count):
+    """
+    Add count to the leaf at the end of the path of nodes
+
+    :param dict tree: The dictionary we are operating on
+    :param list nodes: The path of keys, the last of which holds the count
+    :param int count: The number to add
+    """
+    for node in nodes[:-1]:
+        tree = tree.setdefault(node, {})
+    tree[nodes[-1]] = tree.get(nodes[-1], 0) + count
 
 
 def append_tree_recursive(tree, parent, nodes, node_index=0):
     """
-    Recursively place the nodes under each other
+    Place the nodes under each other, adding one to the leaf
+
+    Despite the name this is no longer recursive, see add_to_tree.
 
     :param dict tree: The dictionary we are operating on
     :param parent: The parent for this node
@@ -150,23 +356,5 @@ def append_tree_recursive(tree, parent, nodes, node_index=0):
     :param node_index: The position in the list list we are up to
     :return:
     """
-    app.logger.debug('Called recursive function with args:\n{}, {}, {}'.format(
-        str(tree), str(parent), str(nodes)))
-
-    child_index = node_index + 1
-    try:
-        # Get the child, one after the parent
-        child = nodes[child_index]
-    except IndexError:
-        # Must be at end
-        if parent in tree:
-            tree[parent] += 1
-        else:
-            tree[parent] = 1
-        return tree
-
-    # Otherwise recurse again
-    if parent not in tree:
-        tree[parent] = {}
-    # Child becomes the parent
-    append_tree_recursive(tree[parent], child, nodes, node_index=child_index)
+    add_to_tree(tree, nodes[node_index:], 1)
+    return tree
@@ -1,5 +1,6 @@
 from orlo.app import app
-from orlo.config import config
+from orlo.cache import LocalCache
+from orlo.config import config, get_settings
 from orlo.exceptions import OrloAuthError
 from flask_httpauth import HTTPBasicAuth
 from flask_tokenauth import TokenAuth, TokenManager
@@ -8,6 +9,11 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import (TimedJSONWebSignatureSerializer
                           as Serializer, BadSignature, SignatureExpired)
 from functools import update_wrapper, wraps
+import hashlib
+import hmac
+import os
+import threading
+import time
 import ldap
 
 
@@ -16,6 +22,13 @@ user_auth = HTTPBasicAuth()
 token_auth = TokenAuth(config.get('security', 'secret_key'))
 token_manager = TokenManager(secret_key=config.get('security', 'secret_key'))
 
+# Successful password verifications, keyed by credential_digest
+verified_credentials = LocalCache(
+    max_entries=config.getint('security', 'auth_cache_size'))
+
+# Token serializers, keyed by secret key
+token_serializers = {}
+
 
 class conditional_auth(object):
     """
@@ -29,14 +42,16 @@ class conditional_auth(object):
         """
         Call method
         """
+        protected = self.decorator(func)
+
         @wraps(func)
         def wrapped(*args, **kwargs):
             """
             Wrapped method
             """
-            if config.getboolean('security', 'enabled'):
+            if get_settings().security_enabled:
                 app.logger.debug("Security enabled")
-                return self.decorator(func)(*args, **kwargs)
+                return protected(*args, **kwargs)
             else:
                 app.logger.debug("Security disabled")
                 return func(*args, **kwargs)
@@ -57,14 +72,13 @@ class User(object):
         return rc
 
     def generate_auth_token(self, expiration=3600):
-        secret_key = config.get('security', 'secret_key')
-        s = Serializer(secret_key, expires_in=expiration)
+        s = Serializer(get_settings().secret_key, expires_in=expiration)
         return s.dumps({'id': self.username})
 
     @staticmethod
     def verify_auth_token(token):
         app.logger.debug("Verify auth token called")
-        s = Serializer(config.get('security', 'secret_key'))
+        s = token_serializer(get_settings().secret_key)
         try:
             data = s.loads(token)
         except SignatureExpired:
@@ -75,6 +89,30 @@ class User(object):
         return user
 
 
+def token_serializer(secret_key):
+    """
+    Return a serializer to load tokens signed with secret_key
+
+    Serializers are reused, as creating one derives the signing key.
+    """
+    serializer = token_serializers.get(secret_key)
+    if serializer is None:
+        serializer = token_serializers[secret_key] = Serializer(secret_key)
+    return serializer
+
+
+def credential_digest(username, password):
+    """
+    Return a digest of a username and password, to key the verification cache
+
+    This is keyed with the secret key, so that the cache does not hold
+    anything which could be used to recover the password without it.
+    """
+    message = u'{}\0{}'.format(username, password).encode('utf-8')
+    return hmac.new(get_settings().secret_key.encode('utf-8'),
+                    message, hashlib.sha256).hexdigest()
+
+
 @user_auth.verify_password
 def verify_password(username_or_token=None, password=None):
     # first try to authenticate by token
@@ -82,18 +120,29 @@ def verify_password(username_or_token=None, password=None):
     if user:
         set_current_user_as(user)
         return True
-    elif not user:
-        password_file_user = verify_password_file(username_or_token, password)
-        if password_file_user:
-            set_current_user_as(username_or_token)
-            return True
-        else:
-            ldap_user = verify_ldap_access(username_or_token, password)
-            if ldap_user:
-                set_current_user_as(username_or_token)
-                return True
-            else:
-                return False
+
+    # Password hashing and LDAP binds are slow, so successful logins are
+    # remembered for auth_cache_ttl seconds
+    ttl = get_settings().auth_cache_ttl
+    digest = credential_digest(username_or_token, password)
+    if ttl > 0:
+        # Clears the cache if the passwd_file has changed. Without a
+        # passwd_file, only LDAP logins are cached.
+        try:
+            get_password_file().load()
+        except (IOError, OSError):
+            pass
+    if ttl > 0 and verified_credentials.get(digest):
+        set_current_user_as(username_or_token)
+        return True
+
+    if verify_password_file(username_or_token, password) or \
+            verify_ldap_access(username_or_token, password):
+        if ttl > 0:
+            verified_credentials.set(digest, username_or_token, ttl)
+        set_current_user_as(username_or_token)
+        return True
+    return False
 
 
 @token_auth.verify_token
@@ -113,39 +162,258 @@ def set_current_user_as(user):
         g.current_user = user
 
 
+class LdapPool(object):
+    """
+    A pool of LDAP connections, reused to bind as each user in turn
+
+    :param string uri: LDAP server URI
+    :param int size: Maximum number of connections, in use or idle
+    :param float timeout: Seconds to wait for the server, and for a free
+        connection when all are in use
+    :param float check_interval: Connections idle for longer than this are
+        checked with a whoami before being reused
+    :param clock: Function returning the time
+    """
+
+    def __init__(self, uri, size=10, timeout=5, check_interval=60,
+                 clock=time.time):
+        self.uri = uri
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.clock = clock
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        """
+        Open a new connection
+        """
+        connection = ldap.initialize(self.uri)
+        connection.protocol_version = ldap.VERSION3
+        connection.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        connection.set_option(ldap.OPT_TIMEOUT, self.timeout)
+        return connection
+
+    def healthy(self, connection, last_used):
+        """
+        Check a connection which has been idle for a while is still usable
+        """
+        if self.clock() - last_used < self.check_interval:
+            return True
+        try:
+            connection.whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
+
+    def acquire(self):
+        """
+        Take a connection from the pool, opening one if none are idle
+
+        :raises OrloAuthError: If all connections stay in use for timeout
+        """
+        if not acquire_semaphore(self.slots, self.timeout):
+            raise OrloAuthError("No LDAP connection free after {}s".format(
+                self.timeout))
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    connection, last_used = self.idle.pop()
+                if self.healthy(connection, last_used):
+                    return connection
+                self.close(connection)
+            return self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, connection, reuse=True):
+        """
+        Return a connection to the pool
+
+        :param bool reuse: False to close the connection, e.g. after an error
+        """
+        if reuse:
+            with self.lock:
+                self.idle.append((connection, self.clock()))
+        else:
+            self.close(connection)
+        self.slots.release()
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def simple_bind(self, who, password):
+        """
+        Check a DN and password with a simple bind
+
+        :return: True if the bind succeeded, False if the credentials are
+            invalid
+        :raises ldap.LDAPError: For other errors, e.g. the server is down
+        """
+        connection = self.acquire()
+        try:
+            connection.simple_bind_s(who, password)
+        except ldap.INVALID_CREDENTIALS:
+            self.release(connection)
+            return False
+        except Exception:
+            self.release(connection, reuse=False)
+            raise
+        self.release(connection)
+        return True
+
+
+def acquire_semaphore(semaphore, timeout):
+    """
+    Acquire a semaphore with a timeout, which Python 2 does not support
+    """
+    try:
+        return semaphore.acquire(timeout=timeout)
+    except TypeError:
+        deadline = time.time() + timeout
+        while not semaphore.acquire(False):
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+ldap_pool = None
+ldap_pool_pid = None
+
+# Credentials which LDAP rejected, keyed by credential_digest
+rejected_credentials = LocalCache(
+    max_entries=config.getint('security', 'auth_cache_size'))
+
+
+def get_ldap_pool():
+    """
+    Return the LDAP pool of this process, creating it on first use
+
+    Connections are not shared with forked processes.
+    """
+    global ldap_pool, ldap_pool_pid
+    if ldap_pool is None or ldap_pool_pid != os.getpid():
+        ldap_pool = LdapPool(
+            'ldap://{}:{}'.format(config.get('security', 'ldap_server'),
+                                  config.get('security', 'ldap_port')),
+            size=config.getint('security', 'ldap_pool_size'),
+            timeout=config.getfloat('security', 'ldap_timeout'),
+            check_interval=config.getfloat('security', 'ldap_check_interval'),
+        )
+        ldap_pool_pid = os.getpid()
+    return ldap_pool
+
+
 def verify_ldap_access(username, password):
     app.logger.debug("Verify ldap called")
+    if not password:
+        # An empty password is an anonymous bind, which would succeed
+        return False
+
+    # Repeated failures, e.g. a client with a stale password, are answered
+    # from the cache for ldap_failure_ttl seconds
+    settings = get_settings()
+    failure_ttl = settings.ldap_failure_ttl
+    digest = credential_digest(username, password)
+    if failure_ttl > 0 and rejected_credentials.get(digest):
+        return False
+
+    ldap_user = "uid=%s,%s" % (username, settings.user_base_dn)
     try:
-        ldap_server = config.get('security', 'ldap_server')
-        ldap_port = config.get('security', 'ldap_port')
-        user_base_dn = config.get('security', 'user_base_dn')
-        l = ldap.initialize('ldap://{}:{}'.format(ldap_server, ldap_port))
-        ldap_user = "uid=%s,%s" % (username, user_base_dn)
-        l.protocol_version = ldap.VERSION3
-        l.simple_bind_s(ldap_user, password)
-        return True
-    except ldap.LDAPError:
+        if get_ldap_pool().simple_bind(ldap_user, password):
+            return True
+    except (ldap.LDAPError, OrloAuthError) as e:
+        app.logger.warning("LDAP bind for {} failed: {}".format(username, e))
         return False
 
+    if failure_ttl > 0:
+        rejected_credentials.set(digest, username, failure_ttl)
+    return False
+
+
+class PasswordFile(object):
+    """
+    Password hashes from a passwd_file, by user
+
+    The file is parsed again when it is replaced, or its modification time or
+    size changes. This also clears verified_credentials, so that passwords
+    which were changed or removed stop working straight away.
+    Lines are of the form user:hash, as written by werkzeug's
+    generate_password_hash.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.users = {}
+        self.signature = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Parse the file, if it has changed since it was last parsed
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            if self.signature is not None:
+                # The file was removed
+                with self.lock:
+                    self.users = {}
+                    self.signature = None
+                    verified_credentials.clear()
+            raise
+        signature = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if signature == self.signature:
+            return
+        with self.lock:
+            verified_credentials.clear()
+            users = {}
+            with open(self.path) as f:
+                for line in f:
+                    user, _, password_hash = line.strip().partition(':')
+                    # The first entry for a user wins, as when the file was
+                    # scanned for each request
+                    users.setdefault(user, password_hash)
+            self.users = users
+            self.signature = signature
+
+    def password_hash(self, username):
+        """
+        Return the password hash of a user, or None if they are not in the file
+        """
+        self.load()
+        return self.users.get(username)
+
+
+password_files = {}
+
+
+def get_password_file():
+    """
+    Return the PasswordFile of the configured passwd_file
+    """
+    path = get_settings().passwd_file
+    if path not in password_files:
+        password_files[path] = PasswordFile(path)
+    return password_files[path]
+
 
 def verify_password_file(username=None, password=None):
     app.logger.debug("Verify password file called")
-    password_file = config.get('security', 'passwd_file')
-    with open(password_file) as f:
-        for line in f:
-            line = line.strip()
-            user = line.split(':')[0]
-            if not user == username:
-                continue
-            # found user return password
-            elif user == username:
-                app.logger.debug("Found user {} in file".format(username))
-                pw = ':'.join(line.split(':')[1:])
-                checked_password = check_password_hash(pw, password)
-                if checked_password:
-                    return True
-                else:
-                    return False
+    pw = get_password_file().password_hash(username)
+    if pw is None:
+        return None
+    app.logger.debug("Found user {} in file".format(username))
+    return check_password_hash(pw, password)
 
 
 @user_auth.error_handler
@@ -165,9 +433,9 @@ def get_token():
     """
     Get a token
     """
-    ttl = config.getint('security', 'token_ttl')
+    ttl = get_settings().token_ttl
     token = token_manager.generate(g.current_user, ttl)
     return jsonify({
         'token': token.decode('ascii'),
-        'duration': config.get('security', 'token_ttl')
+        'duration': str(ttl)
     })
@@ -1,14 +1,23 @@
 from __future__ import print_function, unicode_literals
-from flask import json
+from flask import json, Response
 from orlo.app import app
 from orlo.orm import db, Release, Package, Platform
 from orlo.exceptions import InvalidUsage
 from sqlalchemy.orm import exc
 from six import string_types
+import arrow
+import base64
+import itertools
+import json as stdlib_json
 import uuid
 
 __author__ = 'alforbes'
 
+# Streamed rows are encoded with the stdlib encoder directly, which is much
+# faster than flask's json.dumps, as it does not sort keys or look up the app's
+# encoder for every row. default=str covers the UUIDs in Package.to_dict().
+compact_encoder = stdlib_json.JSONEncoder(separators=(',', ':'), default=str)
+
 
 def append_or_create_platforms(request_platforms):
     """
@@ -150,7 +159,57 @@ def list_to_string(array):
     return '["' + '", "'.join(array) + '"]'
 
 
-def stream_json_list(heading, iterator):
+def encode_cursor(stime, object_id):
+    """
+    Build an opaque pagination cursor from the position of an object
+
+    :param stime: The stime of the last object on the page, may be None
+    :param object_id: The id of the last object on the page
+    :return: Cursor string, safe for use in a url
+    """
+    doc = json.dumps([stime.isoformat() if stime else None, str(object_id)])
+    return base64.urlsafe_b64encode(doc.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by encode_cursor
+
+    :param string cursor: Cursor string
+    :return: Tuple of (stime, id), stime may be None
+    """
+    try:
+        doc = base64.urlsafe_b64decode(str(cursor).encode('ascii'))
+        stime, object_id = json.loads(doc.decode('utf-8'))
+        if stime is not None:
+            stime = arrow.get(stime)
+        return stime, uuid.UUID(object_id)
+    except (AttributeError, TypeError, ValueError, RuntimeError):
+        # RuntimeError is the super-class of arrow's ParserError, and
+        # uuid.UUID raises AttributeError for non-string ids
+        raise InvalidUsage("cursor is not valid")
+
+
+def prefetch(query):
+    """
+    Execute a query and fetch its first result
+
+    This lets us check whether there are any results, and then stream them,
+    while only executing the query once. Errors are also raised here rather
+    than within the streamed Response, where the stack traces are confusing.
+
+    :param query: Any object with __iter__(), e.g. SQLAlchemy Query
+    :return: Iterator over all of the results, or None if there are none
+    """
+    results = iter(query)
+    try:
+        first = next(results)
+    except StopIteration:
+        return None
+    return itertools.chain([first], results)
+
+
+def stream_json_list(heading, iterator, page_size=None, fields=None):
     """
     A lagging generator to stream JSON so we don't have to hold everything in
     memory
@@ -161,32 +220,91 @@ def stream_json_list(heading, iterator):
 
     :param heading: The title of the set, e.g. "releases"
     :param iterator: Any object with __iter__(), e.g. SQLAlchemy Query
+    :param int page_size: If given, add a "next_cursor" field to the document.
+        This is the cursor for the next page if the page was full, or null if
+        it was not, so there are no more results.
+    :param list fields: Passed to to_dict()
     """
+    encode = compact_encoder.encode
     iterator = iterator.__iter__()
     try:
         prev_release = next(iterator)  # get first result
     except StopIteration:
         # StopIteration here means the length was zero, so yield a valid
         # releases doc and stop
-        yield '{{"{}": []}}'.format(heading)
-        raise StopIteration
+        if page_size is None:
+            yield '{{"{}":[]}}'.format(heading)
+        else:
+            yield '{{"{}":[],"next_cursor":null}}'.format(heading)
+        return
 
     # We have some releases. First, yield the opening json
-    yield '{{"{}": ['.format(heading)
+    yield '{{"{}":['.format(heading)
 
     # Iterate over the releases
+    count = 1
     for item in iterator:
-        yield json.dumps(prev_release.to_dict()) + ', '
+        yield encode(prev_release.to_dict(fields)) + ','
         prev_release = item
+        count += 1
 
     # Now yield the last iteration without comma but with the closing brackets
-    yield json.dumps(prev_release.to_dict()) + ']}'
+    if page_size is None:
+        closing = ']}'
+    else:
+        next_cursor = None
+        if page_size and count >= page_size:
+            next_cursor = encode_cursor(prev_release.stime, prev_release.id)
+        closing = '],"next_cursor":{}}}'.format(encode(next_cursor))
+    yield encode(prev_release.to_dict(fields)) + closing
 
     # Must close the db session here to avoid leaking connections,
     # flask-sqlalchemy doesn't do it for us
     db.session.close()
 
 
+def stream_ndjson_list(iterator, fields=None):
+    """
+    A generator to stream newline-delimited JSON, one object per line
+
+    Unlike stream_json_list, clients can parse each line as it arrives rather
+    than waiting for the whole document.
+
+    :param iterator: Any object with __iter__(), e.g. SQLAlchemy Query
+    :param list fields: Passed to to_dict()
+    """
+    encode = compact_encoder.encode
+    for item in iterator:
+        yield encode(item.to_dict(fields)) + '\n'
+
+    # See stream_json_list
+    db.session.close()
+
+
+def stream_list(heading, iterator, output_format='json', page_size=None,
+                fields=None):
+    """
+    Stream a list of objects in the given format
+
+    :param heading: The title of the set, used for json
+    :param iterator: Any object with __iter__(), e.g. SQLAlchemy Query
+    :param output_format: json or ndjson
+    :param int page_size: Passed to stream_json_list, ignored for ndjson
+    :param list fields: Only serialize these fields
+    :return: Response
+    """
+    if output_format == 'ndjson':
+        return Response(stream_ndjson_list(iterator, fields=fields),
+                        content_type='application/x-ndjson')
+    elif output_format == 'json':
+        return Response(
+            stream_json_list(heading, iterator, page_size=page_size,
+                             fields=fields),
+            content_type='application/json')
+    raise InvalidUsage(
+        "format must be json or ndjson, not '{}'".format(output_format))
+
+
 def str_to_bool(value):
     if isinstance(value, string_types):
         try:
@@ -24,6 +24,7 @@ install_requires = [
     'Flask-SQLAlchemy',
     'Flask-Script >= 2.0.5',
     'Flask-TokenAuth',
+    'SQLAlchemy>=1.2',
     'arrow',
     'gunicorn',
     'orloclient>=0.4.5',
@@ -2,6 +2,7 @@ from __future__ import print_function
 from flask_testing import TestCase
 from flask import jsonify
 import orlo
+import orlo.user_auth
 from orlo.orm import db
 from orlo.user_auth import user_auth, token_auth, conditional_auth
 from test_base import ConfigChange
@@ -84,6 +85,9 @@ class OrloAuthTest(TestCase):
 
     def setUp(self):
         db.create_all()
+        orlo.user_auth.verified_credentials.entries.clear()
+        orlo.user_auth.rejected_credentials.entries.clear()
+        orlo.user_auth.ldap_pool = None
         self.mockldap.start()
         self.ldapobj = self.mockldap['ldap://localhost/']
         self.orig_security_enabled = orlo.config.get('security', 'enabled')
@@ -1,6 +1,7 @@
 import orlo
 import unittest
 import os
+import sqlalchemy.event
 from flask_testing import TestCase, LiveServerTestCase
 from orlo.orm import db
 from orlo.orm import Release, db, Package
@@ -219,3 +220,33 @@ class ConfigChange(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         orlo.config.set(self.section, self.option, self.original_state)
+
+
+class CaptureStatements(object):
+    def __init__(self, select_only=False):
+        """
+        Context manager to capture the SQL statements executed
+
+        @param select_only: Only capture SELECT statements. Tests run inside
+            a savepoint, so this leaves out SAVEPOINT and the like.
+        """
+        self.select_only = select_only
+        self.statements = []
+        self.parameters = []
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              *args):
+        if self.select_only and \
+                not statement.lstrip().upper().startswith('SELECT'):
+            return
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def __enter__(self):
+        sqlalchemy.event.listen(
+            db.engine, 'before_cursor_execute', self.before_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sqlalchemy.event.remove(
+            db.engine, 'before_cursor_execute', self.before_cursor_execute)
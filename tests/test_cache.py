@@ -0,0 +1,256 @@
+from __future__ import print_function, unicode_literals
+from unittest import TestCase
+import orlo.cache
+from orlo.cache import LocalCache, RedisCache
+from orlo.__main__ import RebuildVersions
+from orlo.orm import db, CurrentVersion, Release
+from test_base import CaptureStatements, ConfigChange, \
+    ReleaseDbUtil
+from test_route_base import OrloHttpTest
+
+__author__ = 'alforbes'
+
+
+class FakeRedis(object):
+    """
+    Stand-in for a redis client, storing values in a dictionary
+    """
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return value[0] if value else None
+
+    def set(self, key, value, ex=None):
+        self.values[key] = (value.encode('utf-8'), ex)
+
+
+class TestLocalCache(TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.cache = LocalCache(max_entries=2, clock=lambda: self.now)
+
+    def test_get_set(self):
+        self.cache.set('a', '1', 10)
+        self.assertEqual('1', self.cache.get('a'))
+        self.assertIs(None, self.cache.get('b'))
+
+    def test_ttl(self):
+        self.cache.set('a', '1', 10)
+        self.now += 10
+        self.assertIs(None, self.cache.get('a'))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set('a', '1', 10)
+        self.cache.set('b', '2', 10)
+        self.cache.get('a')
+        self.cache.set('c', '3', 10)
+        self.assertEqual('1', self.cache.get('a'))
+        self.assertIs(None, self.cache.get('b'))
+        self.assertEqual('3', self.cache.get('c'))
+
+
+class TestRedisCache(TestCase):
+    def test_get_set(self):
+        client = FakeRedis()
+        cache = RedisCache(client)
+        cache.set('a', '1', 10)
+        self.assertEqual('1', cache.get('a'))
+        self.assertEqual(10, client.values['a'][1])
+        self.assertIs(None, cache.get('b'))
+
+
+class TestCachedResponse(OrloHttpTest, ReleaseDbUtil):
+    """
+    Test caching of the /info and /stats responses
+    """
+    def setUp(self):
+        super(TestCachedResponse, self).setUp()
+        orlo.cache.backend = self.make_backend()
+
+    def tearDown(self):
+        orlo.cache.backend = None
+        super(TestCachedResponse, self).tearDown()
+
+    def make_backend(self):
+        return LocalCache()
+
+    def rename_users(self, user):
+        # Change the data without going through a write route
+        db.session.query(Release).update({'user': user})
+        db.session.commit()
+
+    def test_response_is_cached(self):
+        OrloHttpTest._create_release(self, user='userOne')
+        with ConfigChange('cache', 'enabled', 'true'):
+            first = self.client.get('/info/users')
+            self.rename_users('userTwo')
+            second = self.client.get('/info/users')
+        self.assertEqual(first.json, second.json)
+        self.assertIn('userOne', second.json)
+
+    def test_cache_disabled(self):
+        OrloHttpTest._create_release(self, user='userOne')
+        self.client.get('/info/users')
+        self.rename_users('userTwo')
+        self.assertIn('userTwo', self.client.get('/info/users').json)
+
+    def test_query_args_are_normalized(self):
+        OrloHttpTest._create_release(self, user='userOne')
+        with ConfigChange('cache', 'enabled', 'true'):
+            self.client.get('/stats/by_date/release?unit=day&platform=x')
+            orlo.cache.backend.set = None  # Fails if the response isn't cached
+            response = self.client.get(
+                '/stats/by_date/release?platform=x&unit=day')
+        self.assert200(response)
+
+    def test_write_route_invalidates(self):
+        OrloHttpTest._create_release(self, user='userOne')
+        with ConfigChange('cache', 'enabled', 'true'):
+            self.client.get('/info/users')
+            OrloHttpTest._create_release(self, user='userTwo')
+            response = self.client.get('/info/users')
+        self.assertIn('userTwo', response.json)
+
+    def test_import_invalidates(self):
+        with ConfigChange('cache', 'enabled', 'true'):
+            self.client.get('/info/users')
+            response = self.client.post(
+                '/releases/import', content_type='application/json',
+                data='[{"platforms": ["p"], "stime": "2016-01-01T00:00:00Z", '
+                     '"user": "userThree", "packages": []}]')
+            self.assert200(response)
+            response = self.client.get('/info/users')
+        self.assertIn('userThree', response.json)
+
+    def test_errors_are_not_cached(self):
+        with ConfigChange('cache', 'enabled', 'true'):
+            self.client.get('/stats/by_date/bad_subject')
+            self.assertEqual({}, orlo.cache.backend.entries)
+
+    def test_bump_generation(self):
+        generation = orlo.cache.current_generation()
+        orlo.cache.bump_generation()
+        orlo.cache.bump_generation()
+        self.assertEqual(generation + 2, orlo.cache.current_generation())
+
+
+class TestCachedResponseRedis(TestCachedResponse):
+    """
+    Run the cached response tests against the redis backend
+    """
+    def make_backend(self):
+        return RedisCache(FakeRedis())
+
+    def test_errors_are_not_cached(self):
+        with ConfigChange('cache', 'enabled', 'true'):
+            self.client.get('/stats/by_date/bad_subject')
+            self.assertEqual({}, orlo.cache.backend.client.values)
+
+
+class TestConditionalResponse(OrloHttpTest, ReleaseDbUtil):
+    """
+    Test ETag and Last-Modified handling of the read-only endpoints
+    """
+    PATHS = ['/releases?limit=20', '/packages?limit=20',
+             '/info/packages/versions', '/stats']
+
+    def setUp(self):
+        super(TestConditionalResponse, self).setUp()
+        orlo.cache.backend = LocalCache()
+        release_id = OrloHttpTest._create_release(self, user='userOne')
+        OrloHttpTest._create_package(self, release_id)
+
+    def tearDown(self):
+        orlo.cache.backend = None
+        super(TestConditionalResponse, self).tearDown()
+
+    def _statements(self, path, **headers):
+        with CaptureStatements() as captured:
+            response = self.client.get(path, headers=headers)
+        return response, captured.statements
+
+    def test_etag(self):
+        for path in self.PATHS:
+            response = self.client.get(path)
+            self.assert200(response)
+            etag, weak = response.get_etag()
+            self.assertTrue(weak)
+            self.assertEqual(str(orlo.cache.current_generation()), etag)
+            self.assertIsNotNone(response.last_modified)
+
+    def test_if_none_match(self):
+        for path in self.PATHS:
+            etag = self.client.get(path).headers['ETag']
+            response, statements = self._statements(
+                path, **{'If-None-Match': etag})
+            self.assertEqual(304, response.status_code, path)
+            self.assertEqual(etag, response.headers['ETag'])
+            self.assertEqual(b'', response.data)
+            # Only the write generation is read
+            self.assertEqual(1, len(statements))
+            self.assertIn('write_generation', statements[0])
+
+    def test_if_none_match_after_write(self):
+        etag = self.client.get('/releases?limit=20').headers['ETag']
+        OrloHttpTest._create_release(self, user='userTwo')
+        response = self.client.get(
+            '/releases?limit=20', headers={'If-None-Match': etag})
+        self.assert200(response)
+        self.assertNotEqual(etag, response.headers['ETag'])
+
+    def test_if_none_match_after_rebuild_versions(self):
+        """
+        Test rebuilding the current versions invalidates the cached and
+        conditional responses of /info/packages/versions
+        """
+        release_id = OrloHttpTest._create_release(self, user='userTwo')
+        package_id = OrloHttpTest._create_package(self, release_id)
+        self._start_package(release_id, package_id)
+        self._stop_package(release_id, package_id)
+        # Drift, as the rebuild is there to repair
+        db.session.execute(CurrentVersion.__table__.update().values(
+            version='0.0.1'))
+        db.session.commit()
+
+        path = '/info/packages/versions'
+        with ConfigChange('cache', 'enabled', 'true'):
+            response = self.client.get(path)
+            self.assertEqual('0.0.1', response.json['test-package'])
+            RebuildVersions().run()
+            response = self.client.get(
+                path, headers={'If-None-Match': response.headers['ETag']})
+        self.assert200(response)
+        self.assertEqual('1.2.3', response.json['test-package'])
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get('/stats').headers['Last-Modified']
+        response = self.client.get(
+            '/stats', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(304, response.status_code)
+
+    def test_if_modified_since_before_write(self):
+        response = self.client.get(
+            '/stats',
+            headers={'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+        self.assert200(response)
+
+    def test_if_none_match_takes_precedence(self):
+        last_modified = self.client.get('/stats').headers['Last-Modified']
+        response = self.client.get('/stats', headers={
+            'If-None-Match': 'W/"-1"',
+            'If-Modified-Since': last_modified,
+        })
+        self.assert200(response)
+
+    def test_errors_have_no_etag(self):
+        response = self.client.get('/releases?user=nobody')
+        self.assert404(response)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_disabled(self):
+        with ConfigChange('cache', 'conditional_requests', 'false'):
+            response = self.client.get('/stats')
+        self.assert200(response)
+        self.assertNotIn('ETag', response.headers)
@@ -0,0 +1,168 @@
+from __future__ import print_function, unicode_literals
+import io
+from unittest import TestCase, skipIf
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from orlo.config import config, get_settings, OrloConfigParser, Settings
+from orlo.user_auth import User, conditional_auth, token_serializer
+from test_base import ConfigChange
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
+__author__ = 'alforbes'
+
+
+class TestSettings(TestCase):
+    def test_parsed_once(self):
+        self.assertIs(get_settings(), get_settings())
+
+    def test_typed(self):
+        settings = get_settings()
+        self.assertIsInstance(settings.security_enabled, bool)
+        self.assertIsInstance(settings.token_ttl, int)
+        self.assertIsInstance(settings.warn_ms, float)
+        self.assertEqual(config.get('main', 'time_format'),
+                         settings.time_format)
+
+    def test_frozen(self):
+        with self.assertRaises(AttributeError):
+            get_settings().time_format = '%Y'
+
+    def test_reparsed_after_change(self):
+        before = get_settings()
+        with ConfigChange('main', 'time_format', '%Y'):
+            self.assertEqual('%Y', get_settings().time_format)
+        self.assertIsNot(before, get_settings())
+        self.assertEqual(before, get_settings())
+
+    def test_from_config(self):
+        self.assertEqual(get_settings(), Settings.from_config(config))
+
+
+python3_only = skipIf(not hasattr(OrloConfigParser, 'read_string'),
+                      'read_file, read_string and read_dict are python 3 only')
+
+
+class TestConfigVersion(TestCase):
+    """
+    Test every way of changing the config makes get_settings parse it again
+    """
+    def setUp(self):
+        self.parser = OrloConfigParser()
+
+    def assertChanges(self, method, *args):
+        before = self.parser.version
+        method(*args)
+        self.assertGreater(self.parser.version, before)
+
+    def test_set(self):
+        self.parser.add_section('test')
+        self.assertChanges(self.parser.set, 'test', 'option', 'value')
+        self.assertChanges(self.parser.remove_option, 'test', 'option')
+        self.assertChanges(self.parser.remove_section, 'test')
+
+    def test_read(self):
+        self.assertChanges(self.parser.read, [])
+
+    @python3_only
+    def test_read_file(self):
+        self.assertChanges(self.parser.read_file,
+                           io.StringIO('[test]\na=1\n'))
+        self.assertEqual('1', self.parser.get('test', 'a'))
+
+    @python3_only
+    def test_read_string(self):
+        self.assertChanges(self.parser.read_string, '[test]\na=1\n')
+
+    @python3_only
+    def test_read_dict(self):
+        self.assertChanges(self.parser.read_dict, {'test': {'a': '1'}})
+
+    @python3_only
+    def test_settings_follow_read_string(self):
+        before = config.get('main', 'time_format')
+        self.addCleanup(config.set, 'main', 'time_format', before)
+        config.read_string('[main]\ntime_format = %Y\n')
+        self.assertEqual('%Y', get_settings().time_format)
+
+
+class TestConditionalAuth(TestCase):
+    def setUp(self):
+        self.wrapped = []
+
+        def decorator(func):
+            self.wrapped.append(func)
+
+            def protected(*args, **kwargs):
+                return 'protected'
+            return protected
+
+        self.view = conditional_auth(decorator)(lambda: 'open')
+
+    def test_decorator_applied_once(self):
+        with ConfigChange('security', 'enabled', 'true'):
+            self.assertEqual('protected', self.view())
+            self.assertEqual('protected', self.view())
+        self.assertEqual(1, len(self.wrapped))
+
+    def test_disabled(self):
+        with ConfigChange('security', 'enabled', 'false'):
+            self.assertEqual('open', self.view())
+
+
+class TestTokenSerializer(TestCase):
+    def test_reused(self):
+        self.assertIs(token_serializer('one'), token_serializer('one'))
+        self.assertIsNot(token_serializer('one'), token_serializer('two'))
+
+    def test_verify_auth_token(self):
+        with ConfigChange('security', 'secret_key', 'one'):
+            token = User('userOne', 'one').generate_auth_token()
+            self.assertEqual('userOne', User.verify_auth_token(token))
+        with ConfigChange('security', 'secret_key', 'two'):
+            self.assertIs(None, User.verify_auth_token(token))
+
+
+class TestSettingsPerRequest(TestCase):
+    """
+    Compare the config reads and token check of an authenticated request,
+    parsing the config each time as before, and with the settings object
+    """
+    NUMBER = 20
+
+    def setUp(self):
+        self.token = User('userOne', 'one').generate_auth_token()
+
+    def parse_each_time(self):
+        if config.getboolean('security', 'enabled'):
+            pass
+        Serializer(config.get('security', 'secret_key')).loads(self.token)
+        config.getint('security', 'auth_cache_ttl')
+        config.get('main', 'time_format')
+
+    def settings(self):
+        if get_settings().security_enabled:
+            pass
+        User.verify_auth_token(self.token)
+        get_settings().auth_cache_ttl
+        get_settings().time_format
+
+    def _work(self, request):
+        """
+        Return the config reads and serializers created by NUMBER requests
+        """
+        with patch.object(config, 'get', wraps=config.get) as get, \
+                patch('orlo.user_auth.Serializer',
+                      wraps=Serializer) as serializer:
+            for _ in range(self.NUMBER):
+                request()
+        return get.call_count, serializer.call_count
+
+    def test_settings_per_request(self):
+        # Parse the settings and create the serializer once
+        self.settings()
+        self.assertEqual((0, 0), self._work(self.settings))
+        self.assertGreaterEqual(self._work(self.parse_each_time)[0],
+                                3 * self.NUMBER)
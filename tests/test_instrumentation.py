@@ -0,0 +1,128 @@
+from __future__ import print_function, unicode_literals
+from unittest import TestCase
+from flask import g
+from orlo.instrumentation import QueryStats, collect_query_stats, \
+    current_stats
+from orlo.orm import db
+from test_base import ConfigChange
+from test_route_base import OrloHttpTest
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
+__author__ = 'alforbes'
+
+
+class TestQueryStats(TestCase):
+    def test_add(self):
+        stats = QueryStats()
+        stats.add('SELECT 1', 0.002)
+        stats.add('SELECT 2', 0.005)
+        stats.add('SELECT 3', 0.001)
+        self.assertEqual(3, stats.count)
+        self.assertAlmostEqual(0.008, stats.seconds)
+        self.assertEqual('SELECT 2', stats.slowest_statement)
+        self.assertEqual(
+            {'db_queries': 3, 'db_ms': 8.0, 'db_slowest_ms': 5.0},
+            stats.to_dict())
+
+    def test_server_timing(self):
+        stats = QueryStats()
+        stats.add('SELECT 1', 0.0125)
+        self.assertEqual('db;dur=12.500;desc="1 queries"',
+                         stats.server_timing())
+
+    def test_record(self):
+        stats = QueryStats(record=True)
+        stats.add('SELECT ?', 0.001, (1, ))
+        self.assertEqual([('SELECT ?', (1, ))], stats.statements)
+        self.assertIsNone(QueryStats().statements)
+
+    def test_merge(self):
+        stats = QueryStats()
+        stats.add('SELECT 1', 0.002)
+        other = QueryStats()
+        other.add('SELECT 2', 0.005)
+        stats.merge(other)
+        self.assertEqual(2, stats.count)
+        self.assertAlmostEqual(0.007, stats.seconds)
+        self.assertEqual('SELECT 2', stats.slowest_statement)
+
+
+class TestCollectQueryStats(OrloHttpTest):
+    def test_collect(self):
+        with collect_query_stats() as stats:
+            db.session.execute('SELECT 1')
+        self.assertIn('SELECT 1', [st for st, _ in stats.statements])
+        self.assertEqual(len(stats.statements), stats.count)
+        self.assertIsNone(current_stats())
+
+    def test_added_to_request(self):
+        request_stats = QueryStats()
+        g.query_stats = request_stats
+        self.addCleanup(g.pop, 'query_stats', None)
+        with collect_query_stats() as stats:
+            db.session.execute('SELECT 1')
+        self.assertIs(request_stats, current_stats())
+        self.assertGreater(stats.count, 0)
+        self.assertEqual(stats.count, request_stats.count)
+
+
+class TestRequestQueryStats(OrloHttpTest):
+    """
+    Test the query stats of requests
+    """
+    def setUp(self):
+        super(TestRequestQueryStats, self).setUp()
+        self._create_release()
+
+    def _get(self, path='/releases'):
+        with ConfigChange('db', 'query_stats', 'true'):
+            return self.client.get(path)
+
+    def test_disabled(self):
+        response = self.client.get('/releases')
+        self.assertNotIn('Server-Timing', response.headers)
+
+    def test_server_timing(self):
+        response = self._get()
+        self.assert200(response)
+        timing = response.headers['Server-Timing']
+        self.assertTrue(timing.startswith('db;dur='))
+        self.assertNotIn('desc="0 queries"', timing)
+
+    def test_no_queries(self):
+        response = self._get('/ping')
+        self.assertEqual('db;dur=0.000;desc="0 queries"',
+                         response.headers['Server-Timing'])
+
+    def test_logged(self):
+        with patch('orlo.app.app.logger.debug') as debug:
+            self._get()
+        extra = [c[1]['extra'] for c in debug.call_args_list
+                 if 'extra' in c[1]]
+        self.assertEqual(1, len(extra))
+        self.assertEqual('/releases', extra[0]['path'])
+        self.assertGreater(extra[0]['db_queries'], 0)
+
+    def test_warn_queries(self):
+        with patch('orlo.app.app.logger.warning') as warning:
+            with ConfigChange('db', 'warn_queries', '1'):
+                self._get()
+        self.assertEqual(1, warning.call_count)
+        self.assertIn('/releases', warning.call_args[0][0])
+
+    def test_warn_ms(self):
+        with patch('orlo.app.app.logger.warning') as warning:
+            with ConfigChange('db', 'warn_ms', '0.000001'):
+                self._get()
+        self.assertEqual(1, warning.call_count)
+
+    def test_under_thresholds(self):
+        with patch('orlo.app.app.logger.warning') as warning:
+            with ConfigChange('db', 'warn_queries', '1000'), \
+                    ConfigChange('db', 'warn_ms', '60000'):
+                self._get()
+        self.assertEqual(0, warning.call_count)
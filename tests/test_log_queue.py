@@ -0,0 +1,121 @@
+from __future__ import print_function, unicode_literals
+import logging
+import threading
+from unittest import TestCase, skipIf
+from orlo.app import LogQueue, QueueHandler
+
+__author__ = 'alforbes'
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__(logging.DEBUG)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@skipIf(QueueHandler is None, 'QueueHandler requires Python 3')
+class TestLogQueue(TestCase):
+    def setUp(self):
+        self.target = ListHandler()
+        self.log_queue = LogQueue(self.target)
+        self.logger = logging.getLogger('orlo.test_log_queue')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.log_queue.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.log_queue.handler)
+        self.log_queue.stop()
+
+    def test_records_are_handled(self):
+        self.log_queue.start()
+        for i in range(10):
+            self.logger.info('message %s', i)
+        self.log_queue.stop()
+        self.assertEqual(['message {}'.format(i) for i in range(10)],
+                         self.target.messages)
+
+    def test_start_once_per_process(self):
+        self.log_queue.start()
+        listener = self.log_queue.listener
+        self.log_queue.start()
+        self.assertIs(listener, self.log_queue.listener)
+
+    def test_restart_after_fork(self):
+        """
+        Test a new listener is started when the process has changed
+        """
+        self.log_queue.start()
+        listener = self.log_queue.listener
+        self.log_queue.pid = -1  # As if in a forked worker
+        self.log_queue.start()
+        self.assertIsNot(listener, self.log_queue.listener)
+        listener.stop()
+
+    def test_handler_levels_respected(self):
+        self.target.setLevel(logging.WARNING)
+        self.log_queue.start()
+        self.logger.info('info')
+        self.logger.warning('warning')
+        self.log_queue.stop()
+        self.assertEqual(['warning'], self.target.messages)
+
+
+class BlockingHandler(ListHandler):
+    """
+    Block in emit until released, as a write to a busy disk does
+    """
+    def __init__(self):
+        super(BlockingHandler, self).__init__()
+        self.released = threading.Event()
+        self.threads = set()
+
+    def emit(self, record):
+        self.threads.add(threading.current_thread())
+        self.released.wait(10)
+        super(BlockingHandler, self).emit(record)
+
+
+@skipIf(QueueHandler is None, 'QueueHandler requires Python 3')
+class TestLogQueueBlocking(TestCase):
+    """
+    Compare logging straight to a slow handler, as the write routes did,
+    against logging through LogQueue
+    """
+    RECORDS = 100
+
+    def setUp(self):
+        self.target = BlockingHandler()
+        self.logger = logging.getLogger('orlo.test_log_queue.blocking')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def test_logging_does_not_wait_for_handler(self):
+        log_queue = LogQueue(self.target)
+        log_queue.start()
+        self.logger.addHandler(log_queue.handler)
+        try:
+            for i in range(self.RECORDS):
+                self.logger.info('Create release %s', i)
+            # Every call returned while the handler is still blocked
+            self.assertEqual([], self.target.messages)
+        finally:
+            self.target.released.set()
+            self.logger.removeHandler(log_queue.handler)
+            log_queue.stop()
+        self.assertEqual(self.RECORDS, len(self.target.messages))
+        self.assertNotIn(threading.current_thread(), self.target.threads)
+
+    def test_direct_logging_waits_for_handler(self):
+        self.target.released.set()
+        self.logger.addHandler(self.target)
+        try:
+            self.logger.info('Create release %s', 0)
+        finally:
+            self.logger.removeHandler(self.target)
+        self.assertEqual(['Create release 0'], self.target.messages)
+        self.assertEqual(set([threading.current_thread()]),
+                         self.target.threads)
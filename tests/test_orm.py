@@ -2,14 +2,22 @@ from __future__ import print_function
 from test_route_base import OrloTest
 from random import randrange
 from orlo.orm import db
-from orlo.orm import Release, Package, PackageResult, Platform
+from orlo.orm import Release, Package, PackageResult, Platform, \
+    CurrentVersion, release_status, refresh_current_versions, \
+    insert_current_versions
 from orlo.app import app
+import orlo.queries
 from sqlalchemy.orm import exc
+import sqlalchemy.exc
 import arrow
 import datetime
 import uuid
 from six import string_types
 from test_base import ReleaseDbUtil
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
 
 __author__ = 'alforbes'
 
@@ -59,3 +67,243 @@ class TestFields(OrloDbTest):
         self.assertIsInstance(p.duration, datetime.timedelta)
         self.assertIsInstance(p.status, string_types)
         self.assertIsInstance(p.version, string_types)
+
+    def test_serializers_cover_fields(self):
+        """
+        Test that every serialized field is a column or a relationship which
+        eager_load knows about
+        """
+        for object_type in (Release, Package):
+            loadable = set(c.key for c in object_type.__table__.columns) | \
+                set(orlo.queries.SERIALIZED_RELATIONSHIPS[object_type])
+            self.assertEqual(set(), set(object_type.serializers) - loadable)
+            obj = db.session.query(object_type).first()
+            self.assertEqual(set(object_type.serializers),
+                             set(obj.to_dict()))
+
+
+class TestReleaseSummary(OrloDbTest):
+    """
+    Test Release.status and Release.has_rollback follow the packages
+    """
+    def _release(self):
+        return db.session.query(Release).one()
+
+    def test_status_without_packages(self):
+        """
+        Test a release without packages has no status
+        """
+        self._create_release()
+        self.assertIs(self._release().status, None)
+        self.assertIs(self._release().has_rollback, False)
+
+    def test_status_not_started(self):
+        release_id = self._create_release()
+        self._create_package(release_id)
+        self.assertEqual(self._release().status, 'NOT_STARTED')
+
+    def test_status_follows_start_and_stop(self):
+        release_id = self._create_release()
+        package_id = self._create_package(release_id)
+        release = self._release()
+
+        self._start_package(package_id)
+        self.assertEqual(release.status, 'IN_PROGRESS')
+        self._stop_package(package_id)
+        self.assertEqual(release.status, 'SUCCESSFUL')
+
+    def test_status_failed(self):
+        self._create_finished_release(success=False)
+        self.assertEqual(self._release().status, 'FAILED')
+
+    def test_status_failed_overrides_in_progress(self):
+        release_id = self._create_release()
+        failed_id = self._create_package(release_id, name='failed')
+        started_id = self._create_package(release_id, name='started')
+        self._start_package(failed_id)
+        self._stop_package(failed_id, success=False)
+        self._start_package(started_id)
+        self.assertEqual(self._release().status, 'FAILED')
+
+    def test_status_partly_successful(self):
+        """
+        Test a release with some packages finished and others not started is
+        in progress
+        """
+        release_id = self._create_release()
+        done_id = self._create_package(release_id, name='done')
+        self._create_package(release_id, name='waiting')
+        self._start_package(done_id)
+        self._stop_package(done_id)
+        self.assertEqual(self._release().status, 'IN_PROGRESS')
+
+    def test_has_in_progress(self):
+        release_id = self._create_release()
+        package_id = self._create_package(release_id)
+        self.assertIs(self._release().has_in_progress, False)
+        self._start_package(package_id)
+        self.assertIs(self._release().has_in_progress, True)
+        self._stop_package(package_id, success=False)
+        self.assertIs(self._release().has_in_progress, False)
+
+    def test_has_rollback(self):
+        release_id = self._create_release()
+        self._create_package(release_id, name='normal')
+        self.assertIs(self._release().has_rollback, False)
+        self._create_package(release_id, name='rollback', rollback=True)
+        self.assertIs(self._release().has_rollback, True)
+
+    def test_release_status(self):
+        """
+        Test the python rules match the ones used in the database
+        """
+        cases = [
+            ([], None),
+            ([None], None),
+            (['NOT_STARTED'], 'NOT_STARTED'),
+            (['SUCCESSFUL', 'SUCCESSFUL'], 'SUCCESSFUL'),
+            (['SUCCESSFUL', 'NOT_STARTED'], 'IN_PROGRESS'),
+            (['SUCCESSFUL', 'IN_PROGRESS'], 'IN_PROGRESS'),
+            (['IN_PROGRESS', 'FAILED'], 'FAILED'),
+        ]
+        for statuses, expected in cases:
+            self.assertEqual(release_status(statuses), expected)
+
+
+class TestCurrentVersion(OrloDbTest):
+    """
+    Test the current_version table follows the packages
+    """
+    def _versions(self):
+        return set(
+            (r.name, r.platform, r.by_release, r.version)
+            for r in db.session.query(CurrentVersion))
+
+    def _release(self, version, stop=True, platforms=None):
+        release_id = self._create_release(platforms=platforms or ['p1'])
+        package_id = self._create_package(release_id, version=version)
+        self._start_package(package_id)
+        if stop:
+            self._stop_package(package_id)
+        return release_id, package_id
+
+    def test_successful_package(self):
+        self._release('1.0.0', platforms=['p1', 'p2'])
+        self.assertEqual(self._versions(), set([
+            ('test-package', '', False, '1.0.0'),
+            ('test-package', '', True, '1.0.0'),
+            ('test-package', 'p1', False, '1.0.0'),
+            ('test-package', 'p1', True, '1.0.0'),
+            ('test-package', 'p2', False, '1.0.0'),
+            ('test-package', 'p2', True, '1.0.0'),
+        ]))
+
+    def test_unfinished_package(self):
+        self._release('1.0.0', stop=False)
+        self.assertEqual(self._versions(), set())
+
+    def test_failed_package(self):
+        self._release('1.0.0')
+        release_id = self._create_release(platforms=['p1'])
+        package_id = self._create_package(release_id, version='2.0.0')
+        self._start_package(package_id)
+        self._stop_package(package_id, success=False)
+        self.assertEqual(
+            set(v for _, _, _, v in self._versions()), set(['1.0.0']))
+
+    def test_by_release_waits_for_release(self):
+        """
+        Test that with by_release, a package only counts once its release is
+        successful
+        """
+        self._release('1.0.0')
+        release_id, _ = self._release('2.0.0')
+        other_id = self._create_package(release_id, name='other')
+        self.assertIn(('test-package', 'p1', False, '2.0.0'), self._versions())
+        self.assertIn(('test-package', 'p1', True, '1.0.0'), self._versions())
+
+        self._start_package(other_id)
+        self._stop_package(other_id)
+        self.assertIn(('test-package', 'p1', True, '2.0.0'), self._versions())
+
+    def test_refresh_matches(self):
+        """
+        Test rebuilding the table gives the same rows as maintaining it
+        """
+        self._release('1.0.0', platforms=['p1', 'p2'])
+        release_id, _ = self._release('2.0.0', platforms=['p2'])
+        self._create_package(release_id, name='other')
+        maintained = self._versions()
+
+        db.session.query(CurrentVersion).delete()
+        refresh_current_versions(db.session)
+        self.assertEqual(maintained, self._versions())
+
+    def test_same_stime(self):
+        """
+        Test packages which started at the same time are all current
+        """
+        release_id = self._create_release(platforms=['p1'])
+        stime = arrow.utcnow()
+        for version in ('1.0.0', '1.0.1'):
+            package_id = self._create_package(release_id, version=version)
+            self._start_package(package_id)
+            self._stop_package(package_id)
+            db.session.query(Package).get(package_id).stime = stime
+            db.session.flush()
+        self.assertEqual(
+            set(v for n, p, b, v in self._versions() if p == '' and not b),
+            set(['1.0.0', '1.0.1']))
+
+    def test_only_successful_changes_refresh(self):
+        """
+        Test flushes which can not change a current version do not work it out
+        """
+        release_id = self._create_release(platforms=['p1'])
+        package_id = self._create_package(release_id)
+        with patch('orlo.orm.refresh_current_versions') as refresh:
+            self._start_package(package_id)
+            db.session.query(Package).get(package_id).diff_url = 'http://x'
+            db.session.flush()
+            self.assertEqual(refresh.call_count, 0)
+
+            self._stop_package(package_id)
+            self.assertEqual(refresh.call_count, 1)
+            self.assertEqual(refresh.call_args[0][1], set(['test-package']))
+
+    def test_refresh_writes_changes_only(self):
+        """
+        Test refreshing an up to date table leaves the rows as they are
+        """
+        self._release('1.0.0', platforms=['p1', 'p2'])
+        ids = set(r.id for r in db.session.query(CurrentVersion))
+        refresh_current_versions(db.session)
+        db.session.expire_all()
+        self.assertEqual(
+            ids, set(r.id for r in db.session.query(CurrentVersion)))
+
+    def test_key_unique(self):
+        self._release('1.0.0')
+        row = {'name': 'test-package', 'platform': '', 'by_release': False,
+               'version': '1.0.0', 'stime': arrow.utcnow()}
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            with db.session.begin_nested():
+                db.session.execute(CurrentVersion.__table__.insert(), [row])
+
+    def test_insert_concurrent(self):
+        """
+        Test rows inserted by another process since they were read are updated
+        """
+        self._release('1.0.0')
+        stime = arrow.get(2020, 1, 1)
+        insert_current_versions(db.session.connection(), [
+            {'name': 'test-package', 'platform': '', 'by_release': False,
+             'version': '1.0.0', 'stime': stime},
+            {'name': 'test-package', 'platform': '', 'by_release': False,
+             'version': '0.9.0', 'stime': stime},
+        ])
+        rows = db.session.query(CurrentVersion).filter(
+            CurrentVersion.platform == '',
+            CurrentVersion.by_release == False).all()
+        self.assertEqual(sorted((r.version, r.stime) for r in rows),
+                         [('0.9.0', stime), ('1.0.0', stime)])
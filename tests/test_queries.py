@@ -1,11 +1,14 @@
 from __future__ import print_function, unicode_literals
 import arrow
 from test_orm import OrloDbTest
+from test_base import CaptureStatements
 import orlo.queries
 import orlo.exceptions
 import orlo.stats
-from orlo.orm import Release, Package
+from orlo.orm import db, Release, Package, ReleaseNote, ReleaseMetadata
 from time import sleep
+import six
+import uuid
 import sqlalchemy.orm
 import logging
 
@@ -364,6 +367,192 @@ class TestPackageVersions(OrloQueryTest):
             self.assertEqual(ver, '1.0')
 
 
+class TestPackageVersionsAt(OrloQueryTest):
+    """
+    Test package_versions_at
+    """
+    def _deploy(self, version, name='packageOne', platforms=None):
+        rid = self._create_release(platforms=platforms or ['platformOne'])
+        pid = self._create_package(rid, name=name, version=version)
+        self._start_package(pid)
+        self._stop_package(pid)
+        sleep(0.01)  # To ensure some time separation
+        return rid
+
+    def _versions(self, at, **kwargs):
+        return dict(orlo.queries.package_versions_at(at, **kwargs).all())
+
+    def test_package_versions_at(self):
+        before = arrow.utcnow()
+        self._deploy('1.0.0')
+        first = arrow.utcnow()
+        self._deploy('2.0.0')
+
+        self.assertEqual({}, self._versions(before))
+        self.assertEqual({'packageOne': '1.0.0'}, self._versions(first))
+        self.assertEqual({'packageOne': '2.0.0'},
+                         self._versions(arrow.utcnow()))
+
+    def test_package_versions_at_excludes_unfinished(self):
+        """
+        Test that a package which had started but not finished does not count
+        """
+        self._deploy('1.0.0')
+        rid = self._create_release(platforms=['platformOne'])
+        pid = self._create_package(rid, name='packageOne', version='2.0.0')
+        self._start_package(pid)
+        during = arrow.utcnow()
+        sleep(0.01)
+        self._stop_package(pid)
+
+        self.assertEqual({'packageOne': '1.0.0'}, self._versions(during))
+
+    def test_package_versions_at_with_platform(self):
+        self._deploy('1.0.0', platforms=['platformOne'])
+        self._deploy('2.0.0', platforms=['platformTwo'])
+        self.assertEqual(
+            {'packageOne': '1.0.0'},
+            self._versions(arrow.utcnow(), platform='platformOne'))
+
+    def test_package_versions_at_by_release(self):
+        """
+        Test that with by_release, a release that finished after the given
+        time does not count
+        """
+        self._deploy('1.0.0')
+        self._deploy('1.0.0', name='packageTwo')
+        rid = self._create_release(platforms=['platformOne'])
+        pid1 = self._create_package(rid, name='packageOne', version='2.0.0')
+        pid2 = self._create_package(rid, name='packageTwo', version='2.0.0')
+        self._start_package(pid1)
+        self._start_package(pid2)
+        self._stop_package(pid1)
+        partial = arrow.utcnow()
+        sleep(0.01)
+        self._stop_package(pid2)
+
+        self.assertEqual({'packageOne': '2.0.0', 'packageTwo': '1.0.0'},
+                         self._versions(partial))
+        self.assertEqual({'packageOne': '1.0.0', 'packageTwo': '1.0.0'},
+                         self._versions(partial, by_release=True))
+        self.assertEqual({'packageOne': '2.0.0', 'packageTwo': '2.0.0'},
+                         self._versions(arrow.utcnow(), by_release=True))
+
+
+class TestPackageVersionsAtQueries(OrloQueryTest):
+    """
+    Compare package_versions_at against looking up each package on its own,
+    over a synthetic history
+    """
+    PACKAGES = 200
+    RELEASES = 20
+
+    def setUp(self):
+        super(TestPackageVersionsAtQueries, self).setUp()
+        start = arrow.get(2016, 1, 1)
+        releases = []
+        packages = []
+        for r in range(self.RELEASES):
+            release_id = uuid.uuid4()
+            stime = start.shift(days=r)
+            releases.append({
+                'id': release_id, 'stime': stime, 'user': 'bench',
+                'status': 'SUCCESSFUL', 'has_rollback': False})
+            for p in range(self.PACKAGES):
+                packages.append({
+                    'id': uuid.uuid4(), 'release_id': release_id,
+                    'name': 'package{}'.format(p),
+                    'version': '{}.0'.format(r),
+                    'stime': stime.shift(minutes=p % 60),
+                    'ftime': stime.shift(minutes=p % 60 + 1),
+                    'status': 'FAILED' if (p + r) % 7 == 0 else 'SUCCESSFUL',
+                })
+        # Core inserts skip the flush hooks, which are not being measured
+        db.session.execute(Release.__table__.insert(), releases)
+        db.session.execute(Package.__table__.insert(), packages)
+        db.session.commit()
+        self.at = start.shift(days=self.RELEASES // 2, hours=12)
+
+    def per_package(self):
+        versions = {}
+        names = [n for n, in db.session.query(Package.name).distinct()]
+        for name in names:
+            row = db.session.query(Package.version) \
+                .filter(Package.name == name,
+                        Package.status == 'SUCCESSFUL',
+                        Package.stime <= self.at) \
+                .order_by(Package.stime.desc()).first()
+            if row:
+                versions[name] = row.version
+        return versions
+
+    def test_package_versions_at_queries(self):
+        """
+        Test package_versions_at gives the same versions in one query, where
+        looking up each package takes one per package
+        """
+        with CaptureStatements(select_only=True) as per_package:
+            versions = self.per_package()
+        with CaptureStatements(select_only=True) as single:
+            single_versions = dict(
+                orlo.queries.package_versions_at(self.at).all())
+
+        self.assertEqual(self.PACKAGES, len(single_versions))
+        self.assertEqual(versions, single_versions)
+        self.assertEqual(self.PACKAGES + 1, len(per_package.statements))
+        self.assertEqual(1, len(single.statements))
+
+
+class TestIndexUsage(OrloQueryTest):
+    """
+    Test that the filters of build_query use the composite indexes, with
+    sqlite's EXPLAIN QUERY PLAN
+    """
+    def setUp(self):
+        super(TestIndexUsage, self).setUp()
+        if db.engine.dialect.name != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is specific to sqlite')
+
+    def _plan(self, query):
+        with CaptureStatements(select_only=True) as captured:
+            query.all()
+
+        statement, parameters = captured.statements[0], captured.parameters[0]
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, index, object_type, **kwargs):
+        plan = self._plan(orlo.queries.build_query(object_type, **kwargs))
+        self.assertIn('INDEX {}'.format(index), plan)
+
+    def test_filter_user(self):
+        self.assertUsesIndex('ix_release_user_stime', Release, user='userOne')
+
+    def test_filter_user_and_time(self):
+        self.assertUsesIndex('ix_release_user_stime', Release, user='userOne',
+                             stime_gt='2016-01-01T00:00:00Z')
+
+    def test_filter_team(self):
+        self.assertUsesIndex('ix_release_team_stime', Release, team='teamOne')
+
+    def test_filter_platform(self):
+        # Either release_platform index serves the EXISTS equally well
+        plan = self._plan(
+            orlo.queries.build_query(Release, platform='platformOne'))
+        six.assertRegex(
+            self, plan, 'INDEX ix_release_platform_(platform_id_release_id|'
+                        'release_id_platform_id)')
+
+    def test_filter_package_name(self):
+        self.assertUsesIndex('ix_package_name_status_stime', Release,
+                             package_name='packageOne')
+
+    def test_filter_packages_by_release(self):
+        self.assertUsesIndex('ix_package_release_id_status_rollback', Package,
+                             release_id=str(uuid.uuid4()), status='FAILED')
+
+
 class TestInfo(OrloQueryTest):
     """
     Test the _info functions
@@ -599,6 +788,101 @@ class CountReleasesRollback(TestCountReleases):
         self.assertEqual(1, result[0][0])
 
 
+class CountReleasesByTest(OrloQueryTest):
+    """
+    Test count_releases_by, which should agree with count_releases
+    """
+
+    COLUMNS = (
+        # (column, count_releases args)
+        ('total_successful', {'status': 'SUCCESSFUL'}),
+        ('total_failed', {'status': 'FAILED'}),
+        ('normal_successful', {'rollback': False, 'status': 'SUCCESSFUL'}),
+        ('normal_failed', {'rollback': False, 'status': 'FAILED'}),
+        ('rollback_successful', {'rollback': True, 'status': 'SUCCESSFUL'}),
+        ('rollback_failed', {'rollback': True, 'status': 'FAILED'}),
+    )
+
+    def setUp(self):
+        super(CountReleasesByTest, self).setUp()
+        for _ in range(0, 2):
+            self._create_finished_release()
+        self._create_finished_release(success=False)
+
+        # A release by another user, with one rollback package that failed
+        rid = self._create_release(user='userTwo', team='teamTwo',
+                                   platforms=['platformTwo'])
+        pid1 = self._create_package(rid, name='packageTwo')
+        pid2 = self._create_package(rid, name='packageThree', rollback=True)
+        for pid, success in ((pid1, True), (pid2, False)):
+            self._start_package(pid)
+            self._stop_package(pid, success=success)
+
+    def assertAgreesWithCountReleases(self, field):
+        """
+        Assert that every row matches the equivalent count_releases query
+        """
+        rows = orlo.queries.count_releases_by(field).all()
+        self.assertTrue(rows)
+        for row in rows:
+            for column, args in self.COLUMNS:
+                args = dict(args)
+                args[field] = row.value
+                expected = orlo.queries.count_releases(**args).all()[0][0]
+                self.assertEqual(expected, getattr(row, column),
+                                 "{} {} {}".format(field, row.value, column))
+
+    def test_count_releases_by_user(self):
+        """
+        Test count_releases_by user
+        """
+        self.assertAgreesWithCountReleases('user')
+
+    def test_count_releases_by_team(self):
+        """
+        Test count_releases_by team
+        """
+        self.assertAgreesWithCountReleases('team')
+
+    def test_count_releases_by_platform(self):
+        """
+        Test count_releases_by platform
+        """
+        self.assertAgreesWithCountReleases('platform')
+
+    def test_count_releases_by_package(self):
+        """
+        Test count_releases_by package
+        """
+        self.assertAgreesWithCountReleases('package')
+
+    def test_count_releases_by_global(self):
+        """
+        Test count_releases_by without a field returns a single row of totals
+        """
+        rows = orlo.queries.count_releases_by().all()
+        self.assertEqual(1, len(rows))
+        for column, args in self.COLUMNS:
+            expected = orlo.queries.count_releases(**args).all()[0][0]
+            self.assertEqual(expected, getattr(rows[0], column))
+
+    def test_count_releases_by_value(self):
+        """
+        Test that giving a value only returns that value
+        """
+        rows = orlo.queries.count_releases_by('user', value='userTwo').all()
+        self.assertEqual(1, len(rows))
+        self.assertEqual('userTwo', rows[0].value)
+        self.assertEqual(1, rows[0].rollback_failed)
+
+    def test_count_releases_by_invalid_field(self):
+        """
+        Test that an invalid field raises InvalidUsage
+        """
+        with self.assertRaises(orlo.exceptions.InvalidUsage):
+            orlo.queries.count_releases_by('version')
+
+
 class CountPackagesTest(OrloQueryTest):
     """
     Parent class for testing the CountPackages function
@@ -773,6 +1057,77 @@ class TestBuildQuery(OrloQueryTest):
         self.assertEqual(result[0].id, pid)
 
 
+class TestBuildQueryEagerLoad(OrloQueryTest):
+    """
+    Test that build_query loads the relationships of a page of releases in a
+    fixed number of queries
+    """
+
+    def setUp(self):
+        super(TestBuildQueryEagerLoad, self).setUp()
+        for _ in range(0, 6):
+            rid = self._create_release()
+            for name in ('packageOne', 'packageTwo'):
+                pid = self._create_package(rid, name=name)
+                self._start_package(pid)
+                self._stop_package(pid)
+            db.session.add(ReleaseNote(rid, 'a note'))
+            db.session.add(ReleaseMetadata(rid, 'key', 'value'))
+        db.session.commit()
+
+    def count_queries(self, limit, fields=None):
+        """
+        Count the queries executed to fetch and serialize a page of releases
+        """
+        db.session.expunge_all()
+        with CaptureStatements() as captured:
+            query = orlo.queries.build_query(
+                Release, limit=limit, fields=fields)
+            releases = [r.to_dict(fields) for r in query]
+
+        self.assertEqual(limit, len(releases))
+        return len(captured.statements)
+
+    def test_query_count_is_constant(self):
+        """
+        Test that the number of queries does not depend on the page size
+        """
+        self.assertEqual(self.count_queries(2), self.count_queries(6))
+
+    def test_fields_are_loaded_in_one_query(self):
+        """
+        Test that unrequested relationships and columns are not loaded
+        """
+        self.assertEqual(1, self.count_queries(6, ['id', 'stime', 'user']))
+
+    def test_fields_with_relationship(self):
+        """
+        Test that only the requested relationship is loaded
+        """
+        self.assertEqual(2, self.count_queries(6, ['id', 'packages']))
+
+    def test_parse_fields(self):
+        """
+        Test parse_fields splits and validates the list
+        """
+        self.assertEqual(
+            ['id', 'user', 'packages'],
+            orlo.queries.parse_fields(Release, 'id, user,packages'))
+        self.assertIsNone(orlo.queries.parse_fields(Release, ''))
+        with self.assertRaises(orlo.exceptions.InvalidUsage):
+            orlo.queries.parse_fields(Package, 'id,packages')
+
+    def test_relationships_are_loaded(self):
+        """
+        Test that the eagerly loaded relationships are serialized
+        """
+        release = orlo.queries.build_query(Release, limit=1).one().to_dict()
+        self.assertEqual(2, len(release['packages']))
+        self.assertEqual(['test_platform'], release['platforms'])
+        self.assertEqual(['a note'], release['notes'])
+        self.assertEqual({'key': 'value'}, release['metadata'])
+
+
 class GetPackageTest(OrloQueryTest):
     """
     Test the packages method
@@ -5,7 +5,15 @@ import uuid
 from orlo.orm import db, Package, Release
 from orlo.config import config
 from time import sleep
-from test_base import OrloTest
+import logging
+from orlo.app import app
+from orlo.routes.base import log_request
+from test_base import OrloTest, ConfigChange
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
 
 
 class OrloHttpTest(OrloTest):
@@ -191,3 +199,138 @@ class BaseUrlTest(OrloHttpTest):
         response = self.client.get('/version')
         self.assert200(response)
         self.assertEqual(__version__, response.json['version'])
+
+
+class ListHandler(logging.Handler):
+    """
+    Keep the messages logged, formatting them as a real handler would
+    """
+    def __init__(self):
+        super(ListHandler, self).__init__(logging.DEBUG)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class RequestLoggingTest(OrloHttpTest):
+    """
+    Test logging of requests in the before_request hook
+    """
+    level = logging.DEBUG
+
+    def setUp(self):
+        super(RequestLoggingTest, self).setUp()
+        self.handler = ListHandler()
+        self.old_level = app.logger.level
+        app.logger.addHandler(self.handler)
+        app.logger.setLevel(self.level)
+
+    def tearDown(self):
+        app.logger.removeHandler(self.handler)
+        app.logger.setLevel(self.old_level)
+        super(RequestLoggingTest, self).tearDown()
+
+
+class TestRequestLogging(RequestLoggingTest):
+    def _post(self, data):
+        return self.client.post('/releases', data=data,
+                                content_type='application/json')
+
+    def test_url_logged(self):
+        self.client.get('/ping')
+        self.assertIn('GET http://localhost/ping', self.handler.messages)
+
+    def test_body_logged(self):
+        self._post('{"platforms": ["test"],\n "user": "bob"}')
+        self.assertIn('POST data: {"platforms": ["test"], "user": "bob"}',
+                      self.handler.messages)
+
+    def test_large_body_not_read(self):
+        with ConfigChange('logging', 'request_body_max', '10'):
+            self._post('{"platforms": ["test"], "user": "bob"}')
+        self.assertIn('POST data: <38 bytes, not logged>',
+                      self.handler.messages)
+
+    def test_body_disabled(self):
+        with ConfigChange('logging', 'request_body_max', '0'):
+            self._post('{"platforms": ["test"], "user": "bob"}')
+        self.assertFalse([m for m in self.handler.messages if 'data:' in m])
+
+    def test_ndjson_not_read(self):
+        self.client.post('/releases/import', data='{}\n',
+                         content_type='application/x-ndjson')
+        self.assertIn('POST data: <application/x-ndjson stream, not logged>',
+                      self.handler.messages)
+
+    def test_sampling(self):
+        with ConfigChange('logging', 'request_sample_rate', '0'):
+            self.client.get('/ping')
+        self.assertEqual([], self.handler.messages)
+
+
+class TestRequestLoggingInfo(RequestLoggingTest):
+    level = logging.INFO
+
+    def test_body_not_logged(self):
+        self.client.post('/releases', content_type='application/json',
+                         data='{"platforms": ["test"], "user": "bob"}')
+        self.assertIn('POST http://localhost/releases', self.handler.messages)
+        self.assertFalse([m for m in self.handler.messages if 'data:' in m])
+
+
+class TestRequestLoggingBodyRead(RequestLoggingTest):
+    """
+    Compare logging an import-sized body as before, with log_request
+    """
+    level = logging.INFO
+    RELEASES = 50
+
+    def setUp(self):
+        super(TestRequestLoggingBodyRead, self).setUp()
+        release = {
+            'platforms': ['test_platform'],
+            'stime': '2016-01-01T09:00:00Z',
+            'user': 'testuser',
+            'notes': ['lorem ipsum ' * 10],
+            'packages': [{'name': 'test-package', 'version': '1.2.3',
+                          'status': 'SUCCESSFUL'}] * 5,
+        }
+        self.data = json.dumps([release] * self.RELEASES)
+
+    @staticmethod
+    def log_post_data():
+        """
+        The previous before_request hook
+        """
+        from flask import request
+        s = "{m} {u}".format(m=request.method, u=request.url)
+        data = request.get_data(as_text=True)
+        if data:
+            s += " POST data: {}".format(data.replace('\n', ''))
+        app.logger.info(s)
+
+    def _reads(self, hook):
+        """
+        Return the number of times hook reads the body of an import
+        """
+        with app.test_request_context(
+                '/releases/import', method='POST', data=self.data,
+                content_type='application/json'):
+            with patch('flask.Request.get_data',
+                       return_value=self.data) as get_data:
+                hook()
+        return get_data.call_count
+
+    def test_request_logging_body_read(self):
+        """
+        Test the body of an import is not read to be logged, where it was
+        read into memory at every level
+        """
+        self.assertGreater(len(self.data),
+                           config.getint('logging', 'request_body_max'))
+        for level in (logging.INFO, logging.DEBUG):
+            app.logger.setLevel(level)
+            self.assertEqual(1, self._reads(self.log_post_data))
+            self.assertEqual(0, self._reads(log_request))
+            self.assertTrue(self.handler.messages)
@@ -36,6 +36,7 @@ class TestImport(OrloTest):
     ]
     """
     doc_dict = json.loads(doc)
+    url = '/releases/import'
 
     def setUp(self):
         db.create_all()
@@ -46,7 +47,7 @@ class TestImport(OrloTest):
         Import our test document
         """
         response = self.client.post(
-                '/releases/import',
+                self.url,
                 data=self.doc,
                 content_type='application/json',
         )
@@ -182,6 +183,14 @@ class TestNormalImport(TestImport):
         """
         self.assertEqual(self.package.status, self.doc_dict[0]['packages'][0]['status'])
 
+    def test_import_release_summary(self):
+        """
+        Test the release status and rollback summary are set
+        """
+        self.assertEqual(self.release.status, 'SUCCESSFUL')
+        self.assertIs(self.release.has_rollback, True)
+        self.assertIs(self.release.has_in_progress, False)
+
     def test_import_param_package_diff_url(self):
         """
         Test package diff_url is recorded
@@ -233,3 +242,169 @@ class TestNullTime(TestImport):
             self.package.stime.strftime(config.get('main', 'time_format')),
             self.doc_dict[0]['stime'])
 
+
+
+class TestBulkImport(TestNormalImport):
+    """
+    Run the normal import tests in bulk mode
+    """
+    url = '/releases/import?bulk=true'
+
+
+class TestBulkImportNullTime(TestNullTime):
+    """
+    Run the null time tests in bulk mode
+    """
+    url = '/releases/import?bulk=true'
+
+
+class TestBulkImportBatches(OrloTest):
+    """
+    Test bulk importing several releases in batches
+    """
+    release = {
+        "platforms": ["GumtreeUK", "GumtreeIE"],
+        "stime": "2015-12-09T12:34:45Z",
+        "user": "bob",
+        "notes": ["note 1"],
+        "packages": [{"name": "test-package-1", "version": "0.0.1"}],
+    }
+
+    def _bulk_import(self, count, batch_size):
+        response = self.client.post(
+            '/releases/import?bulk=true&batch_size={}'.format(batch_size),
+            data=json.dumps([self.release] * count),
+            content_type='application/json',
+        )
+        self.assert200(response)
+        return response.json
+
+    def test_bulk_import_returns_ids(self):
+        """
+        Test that the created release IDs are returned
+        """
+        result = self._bulk_import(5, 2)
+        self.assertEqual(5, len(result['releases']))
+        self.assertEqual(3, result['batches'])
+        self.assertIn('releases_per_second', result)
+        self.assertEqual(
+            sorted(result['releases']),
+            sorted(str(r.id) for r in db.session.query(Release)))
+
+    def test_bulk_import_relationships(self):
+        """
+        Test that platforms, packages and notes are attached to each release
+        """
+        self._bulk_import(3, 2)
+        self.assertEqual(2, db.session.query(Platform).count())
+        for release in db.session.query(Release):
+            self.assertEqual(2, len(release.platforms))
+            self.assertEqual(1, len(release.packages))
+            self.assertEqual(1, len(release.notes))
+
+    def test_bulk_import_existing_platform(self):
+        """
+        Test that existing platforms are reused
+        """
+        self._bulk_import(1, 1)
+        self._bulk_import(1, 1)
+        self.assertEqual(2, db.session.query(Platform).count())
+
+    def test_bulk_import_rollups(self):
+        """
+        Test that bulk imported releases are counted in the rollups
+        """
+        self.release = dict(self.release, packages=[
+            {"name": "test-package-1", "version": "0.0.1",
+             "status": "SUCCESSFUL"}])
+        self._bulk_import(3, 2)
+        self._bulk_import(1, 1)
+        for url in ('/stats/by_date/release?unit=day',
+                    '/stats/by_date/release?unit=day&platform=GumtreeIE'):
+            response = self.client.get(url)
+            self.assertEqual(
+                4, response.json['2015']['12']['9']['normal']['successful'])
+
+    def test_bulk_import_current_versions(self):
+        """
+        Test that bulk imported packages become the current versions
+        """
+        self.release = dict(self.release, packages=[
+            {"name": "test-package-1", "version": "0.0.1",
+             "stime": "2015-12-09T12:34:45Z", "status": "SUCCESSFUL"}])
+        self._bulk_import(3, 2)
+        response = self.client.get(
+            '/info/packages/versions?platform=GumtreeIE&by_release=true')
+        self.assertEqual({'test-package-1': '0.0.1'}, response.json)
+
+    def test_bulk_import_bad_batch_size(self):
+        """
+        Test that an invalid batch size returns 400
+        """
+        response = self.client.post(
+            '/releases/import?bulk=true&batch_size=0',
+            data=json.dumps([self.release]),
+            content_type='application/json',
+        )
+        self.assert400(response)
+
+
+class TestNdjsonImport(OrloTest):
+    """
+    Test importing newline-delimited JSON
+    """
+    release = {
+        "platforms": ["GumtreeUK"],
+        "stime": "2015-12-09T12:34:45Z",
+        "user": "bob",
+        "packages": [{"name": "test-package-1", "version": "0.0.1"}],
+    }
+
+    def _ndjson_import(self, lines, batch_size=2):
+        response = self.client.post(
+            '/releases/import?batch_size={}'.format(batch_size),
+            data='\n'.join(lines) + '\n',
+            content_type='application/x-ndjson',
+        )
+        self.assert200(response)
+        return response.json
+
+    def test_ndjson_import(self):
+        """
+        Test that every line is imported
+        """
+        result = self._ndjson_import([json.dumps(self.release)] * 5)
+        self.assertEqual(5, len(result['releases']))
+        self.assertEqual(3, result['batches'])
+        self.assertEqual([], result['errors'])
+        self.assertEqual(5, db.session.query(Release).count())
+        self.assertEqual(5, db.session.query(Package).count())
+
+    def test_ndjson_import_reports_errors(self):
+        """
+        Test that bad lines are reported without stopping the import
+        """
+        missing_user = dict(self.release)
+        del missing_user['user']
+        lines = [
+            json.dumps(self.release),
+            '{"not valid json',
+            json.dumps(missing_user),
+            '',
+            json.dumps(self.release),
+        ]
+        result = self._ndjson_import(lines)
+        self.assertEqual(2, len(result['releases']))
+        self.assertEqual([2, 3], [e['line'] for e in result['errors']])
+        self.assertEqual(2, db.session.query(Release).count())
+
+    def test_ndjson_import_bad_status(self):
+        """
+        Test that an invalid package status is reported for the line
+        """
+        bad_status = dict(self.release)
+        bad_status['packages'] = [
+            {"name": "test-package-1", "version": "0.0.1", "status": "FOO"}]
+        result = self._ndjson_import([json.dumps(bad_status)])
+        self.assertEqual([], result['releases'])
+        self.assertEqual(1, result['errors'][0]['line'])
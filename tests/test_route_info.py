@@ -1,4 +1,5 @@
 from __future__ import print_function
+import arrow
 from test_route_base import OrloHttpTest
 
 __author__ = 'alforbes'
@@ -168,3 +169,18 @@ class TestInfoUrl(OrloHttpTest):
         response = self.client.get('/info/packages/versions?by_release=true')
         self.assert200(response)
         self.assertIn('test-package', response.json)
+
+    def test_info_package_versions_at(self):
+        self._create_finished_release()
+        response = self.client.get(
+            '/info/packages/versions?at=2000-01-01T00:00:00Z')
+        self.assert200(response)
+        self.assertEqual({}, response.json)
+        response = self.client.get('/info/packages/versions?at={}'.format(
+            arrow.utcnow().isoformat().replace('+', '%2B')))
+        self.assert200(response)
+        self.assertIn('test-package', response.json)
+
+    def test_info_package_versions_at_bad_time(self):
+        response = self.client.get('/info/packages/versions?at=yesterday')
+        self.assert400(response)
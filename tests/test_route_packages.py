@@ -71,3 +71,59 @@ class GetPackagesTest(OrloHttpTest):
         self.assertIsInstance(p['packages'], list)
         self.assertEqual(3, len(p['packages']))
 
+
+    def test_get_package_next_cursor(self):
+        """
+        Test that packages can be paged through by cursor
+        """
+        for _ in range(0, 3):
+            self._create_finished_release()
+        p = self._get_packages(filters=['limit=2'])
+        self.assertEqual(2, len(p['packages']))
+        p = self._get_packages(filters=[
+            'limit=2', 'cursor={}'.format(p['next_cursor'])])
+        self.assertEqual(1, len(p['packages']))
+        self.assertIsNone(p['next_cursor'])
+
+    def test_get_package_next_cursor_not_started(self):
+        """
+        Test that paging continues past packages which have not started
+        """
+        release_id = self._create_release()
+        package_ids = [self._create_package(release_id, name='p{}'.format(i))
+                       for i in range(3)]
+        self._start_package(release_id, package_ids[0])
+        for asc in ['true', 'false']:
+            seen = []
+            filters = ['limit=2', 'asc={}'.format(asc)]
+            while True:
+                p = self._get_packages(filters=filters)
+                seen.extend(package['id'] for package in p['packages'])
+                if not p['next_cursor']:
+                    break
+                filters = ['limit=2', 'asc={}'.format(asc),
+                           'cursor={}'.format(p['next_cursor'])]
+            self.assertEqual(package_ids[0], seen[0])
+            self.assertEqual(sorted(package_ids), sorted(seen))
+
+    def test_get_package_ndjson(self):
+        """
+        Test that format=ndjson returns one package per line
+        """
+        for _ in range(0, 3):
+            self._create_finished_release()
+        response = self.client.get('/packages?format=ndjson')
+        self.assert200(response)
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(3, len(lines))
+        for line in lines:
+            self.assertEqual('test-package', json.loads(line)['name'])
+
+    def test_get_package_fields(self):
+        """
+        Test that fields limits the fields returned
+        """
+        self._create_finished_release()
+        p = self._get_packages(filters=['fields=name,version'])
+        self.assertEqual({'name': 'test-package', 'version': '1.2.3'},
+                         p['packages'][0])
@@ -1,12 +1,15 @@
 from __future__ import print_function, unicode_literals
 from datetime import datetime, timedelta
 import json
+import threading
 import uuid
 from orlo.orm import db, Package, Release
 from orlo.config import config
 from time import sleep
+import orlo.queries
+import orlo.util
 from test_route_base import OrloHttpTest
-from test_base import OrloLiveTest
+from test_base import OrloLiveTest, CaptureStatements, ConfigChange
 
 
 __author__ = 'alforbes'
@@ -527,6 +530,100 @@ class TestGetContract(OrloHttpTest):
         # Last in list should be last to be created
         self.assertEqual(r['releases'][2]['id'], rid)
 
+    def test_get_release_next_cursor(self):
+        """
+        Test that walking the pages by cursor returns every release once
+        """
+        rids = []
+        for _ in range(0, 5):
+            rids.append(self._create_release())
+
+        seen = []
+        filters = ['limit=2']
+        while True:
+            r = self._get_releases(filters=filters)
+            seen += [release['id'] for release in r['releases']]
+            if not r['next_cursor']:
+                break
+            filters = ['limit=2', 'cursor={}'.format(r['next_cursor'])]
+
+        self.assertEqual(sorted(rids), sorted(seen))
+        self.assertEqual(len(rids), len(seen))
+
+    def test_get_release_next_cursor_asc(self):
+        """
+        Test that the cursor follows the order given by asc
+        """
+        rids = []
+        for _ in range(0, 3):
+            rids.append(self._create_release())
+            sleep(0.1)
+
+        r = self._get_releases(filters=['limit=1', 'asc=true'])
+        self.assertEqual(r['releases'][0]['id'], rids[0])
+        r = self._get_releases(filters=[
+            'limit=1', 'asc=true', 'cursor={}'.format(r['next_cursor'])])
+        self.assertEqual(r['releases'][0]['id'], rids[1])
+
+    def test_get_release_next_cursor_null_on_last_page(self):
+        """
+        Test that next_cursor is null when the page is not full
+        """
+        self._create_release()
+        r = self._get_releases(filters=['limit=2'])
+        self.assertIsNone(r['next_cursor'])
+
+    def test_get_release_bad_cursor(self):
+        """
+        Test that an invalid cursor returns 400
+        """
+        self._create_release()
+        r = self._get_releases(filters=['cursor=foo'], expected_status=400)
+        self.assertIn('message', r)
+
+    def test_get_release_ndjson(self):
+        """
+        Test that format=ndjson returns one release per line
+        """
+        rids = [self._create_release() for _ in range(0, 3)]
+        response = self.client.get('/releases?format=ndjson')
+        self.assert200(response)
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(
+            sorted(rids), sorted(json.loads(l)['id'] for l in lines))
+
+    def test_get_release_bad_format(self):
+        """
+        Test that an unknown format returns 400
+        """
+        self._create_release()
+        r = self._get_releases(filters=['format=xml'], expected_status=400)
+        self.assertIn('message', r)
+
+    def test_get_release_fields(self):
+        """
+        Test that fields limits the fields returned
+        """
+        rid = self._create_release()
+        r = self._get_releases(filters=['fields=id,stime,user'])
+        self.assertEqual(
+            {'id': rid, 'user': 'testuser'},
+            {'id': r['releases'][0]['id'], 'user': r['releases'][0]['user']})
+        self.assertEqual(['id', 'stime', 'user'],
+                         sorted(r['releases'][0].keys()))
+
+    def test_get_release_bad_fields(self):
+        """
+        Test that an unknown field returns 400
+        """
+        self._create_release()
+        r = self._get_releases(filters=['fields=id,foo'], expected_status=400)
+        self.assertIn('message', r)
+        # Summary columns which are not serialized
+        self._get_releases(filters=['fields=id,has_in_progress'],
+                           expected_status=400)
+
     def test_get_release_package_name(self):
         """
         Filter on releases which have a particular package name
@@ -608,6 +705,38 @@ class TestGetContract(OrloHttpTest):
         r = self._get_releases(filters=['package_status=FAILED'])
         self.assertEqual(len(r['releases']), 1)
 
+    def test_get_release_status(self):
+        """
+        Test the status filter matches all packages for SUCCESSFUL and
+        NOT_STARTED, and any package for FAILED and IN_PROGRESS
+        """
+        empty = self._create_release()
+
+        failed_and_started = self._create_release()
+        pid = self._create_package(failed_and_started, name='failed')
+        self._start_package(failed_and_started, pid)
+        self._stop_package(failed_and_started, pid, success=False)
+        pid = self._create_package(failed_and_started, name='started')
+        self._start_package(failed_and_started, pid)
+
+        # Matches none of the statuses
+        partly_done = self._create_release()
+        pid = self._create_package(partly_done, name='done')
+        self._start_package(partly_done, pid)
+        self._stop_package(partly_done, pid, success=True)
+        self._create_package(partly_done, name='waiting')
+
+        expected = {
+            'SUCCESSFUL': [empty],
+            'NOT_STARTED': [empty],
+            'FAILED': [failed_and_started],
+            'IN_PROGRESS': [failed_and_started],
+        }
+        for status, release_ids in expected.items():
+            r = self._get_releases(filters=['status={}'.format(status)])
+            self.assertEqual(release_ids,
+                             [release['id'] for release in r['releases']])
+
     def test_get_release_package_duration_gt(self):
         """
         Filter on releases with a package of duration greater than X
@@ -725,3 +854,151 @@ class TestGetContract(OrloHttpTest):
             notes
         )
 
+
+
+class TestGetReleasesQueryCount(OrloHttpTest):
+    """
+    Test that GET /releases only executes the filtered query once
+    """
+    RELEASES = 500
+
+    def setUp(self):
+        super(TestGetReleasesQueryCount, self).setUp()
+        release = {
+            'platforms': ['test_platform'],
+            'stime': '2016-01-01T09:00:00Z',
+            'user': 'testuser',
+            'packages': [{'name': 'test-package', 'version': '1.2.3',
+                          'status': 'SUCCESSFUL'}],
+        }
+        response = self.client.post(
+            '/releases/import?bulk=true',
+            data=json.dumps([release] * self.RELEASES),
+            content_type='application/json',
+        )
+        self.assert200(response)
+
+    def _statements(self, path):
+        with CaptureStatements() as captured:
+            response = self.client.get(path)
+        # The ETag lookup of the write generation is not a release query
+        return response, [s for s in captured.statements
+                          if 'write_generation' not in s]
+
+    def test_filtered_query_executed_once(self):
+        """
+        Test that a filtered listing executes one query
+        """
+        response, statements = self._statements(
+            '/releases?user=testuser&status=SUCCESSFUL&fields=id,user')
+        self.assert200(response)
+        self.assertEqual(1, len(statements))
+
+    def test_empty_result_executed_once(self):
+        """
+        Test that the 404 for an empty result executes one query
+        """
+        response, statements = self._statements(
+            '/releases?user=nobody&fields=id')
+        self.assert404(response)
+        self.assertEqual(1, len(statements))
+
+    def test_prefetch_statements(self):
+        """
+        Compare the statements of execute, count and iterate with prefetch
+        """
+        def query():
+            return orlo.queries.build_query(
+                Release, limit=self.RELEASES, user='testuser',
+                status='SUCCESSFUL', fields=['id', 'user'])
+
+        def execute_count_iterate():
+            q = query()
+            db.session.execute(q)
+            q.count()
+            return list(q)
+
+        def prefetch():
+            return list(orlo.util.prefetch(query()))
+
+        with CaptureStatements(select_only=True) as old:
+            old_rows = execute_count_iterate()
+        with CaptureStatements(select_only=True) as new:
+            new_rows = prefetch()
+        self.assertEqual(self.RELEASES, len(new_rows))
+        self.assertEqual([r.id for r in old_rows], [r.id for r in new_rows])
+        self.assertEqual(3, len(old.statements))
+        self.assertEqual(1, len(new.statements))
+
+
+class TestGetReleasesExplain(OrloHttpTest):
+    """
+    Test explain=true on GET /releases and /packages
+    """
+    def setUp(self):
+        super(TestGetReleasesExplain, self).setUp()
+        release_id = self._create_release(user='userOne')
+        self._create_package(release_id)
+
+    def test_explain_disabled(self):
+        response = self.client.get('/releases?explain=true')
+        self.assert400(response)
+
+    def test_explain_releases(self):
+        with ConfigChange('db', 'explain', 'true'):
+            response = self.client.get(
+                '/releases?user=userOne&explain=true')
+        self.assert200(response)
+        self.assertEqual(1, response.json['rows'])
+        self.assertIn('seconds', response.json)
+        statement = response.json['statements'][0]
+        self.assertIn('release.user = ', statement['sql'])
+        self.assertIn('userOne', statement['parameters'])
+        if db.engine.dialect.name == 'sqlite':
+            self.assertIn('ix_release_user_stime',
+                          json.dumps(statement['plan']))
+        # The eager loads are included
+        self.assertGreater(len(response.json['statements']), 1)
+
+    def test_explain_packages(self):
+        with ConfigChange('db', 'explain', 'true'):
+            response = self.client.get('/packages?explain=true&fields=id,name')
+        self.assert200(response)
+        self.assertEqual(1, response.json['rows'])
+        self.assertIn('FROM package', response.json['statements'][0]['sql'])
+
+    def test_explain_other_connections(self):
+        """
+        Test statements run on other connections, as by other requests, are
+        not included
+        """
+        query = orlo.queries.build_query(Release, user='userOne')
+
+        def other_request():
+            other = db.engine.connect()
+            try:
+                other.execute('SELECT 1 AS other_request')
+            finally:
+                other.close()
+
+        class OtherRequestQuery(object):
+            def all(self):
+                thread = threading.Thread(target=other_request)
+                thread.start()
+                thread.join()
+                return query.all()
+
+        with ConfigChange('db', 'explain', 'true'):
+            result = orlo.queries.explain_query(OtherRequestQuery())
+        self.assertEqual(1, result['rows'])
+        for statement in result['statements']:
+            self.assertNotIn('other_request', statement['sql'])
+        self.assertIn('release.user = ', result['statements'][0]['sql'])
+
+    def test_explain_is_not_a_filter(self):
+        """
+        Test explain=false returns the results as normal
+        """
+        response = self.client.get('/releases?explain=false')
+        self.assert200(response)
+        self.assertEqual(1, len(response.json['releases']))
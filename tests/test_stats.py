@@ -1,9 +1,24 @@
 from __future__ import print_function, unicode_literals
 import arrow
+import datetime
+import json
+import sqlalchemy.exc
+import timeit
+from collections import OrderedDict
+from unittest import TestCase
 import orlo.queries
 import orlo.exceptions
 import orlo.stats
+from orlo.orm import db, Release, Package, ReleaseRollup, refresh_rollups, \
+    rollup_bucket, apply_rollup_deltas, bucket_ranges, RELEASE_ROLLUP_KEYS
+from orlo.util import append_or_create_platforms
 from test_orm import OrloDbTest
+from test_base import CaptureStatements
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
 
 __author__ = 'alforbes'
 
@@ -194,3 +209,437 @@ class TestPackageTime(OrloStatsTest):
 
     def test_package_time_with_unit_day(self):
         pass
+
+
+class OrloStatsDataTest(OrloDbTest):
+    """
+    Parent class for tests which need releases spread over time
+    """
+    # Forces the results to be counted from the release and package tables
+    FALLBACK = {'stime_gt': arrow.get(2000, 1, 1)}
+
+    def setUp(self):
+        super(OrloDbTest, self).setUp()
+        start = arrow.get(2016, 12, 31, 22, 30)
+        self.create_release(start, ['p1', 'p2'], platforms=['a', 'b'])
+        self.create_release(start.shift(hours=+1), ['p1'], success=False)
+        self.create_release(start.shift(hours=+2), ['p2'], rollback=True,
+                            user='alice', platforms=['b'])
+        self.create_release(start.shift(days=+9), ['p1', 'p2'],
+                            team='other team')
+        self.create_release(start.shift(days=+40), ['p1'], rollback=True,
+                            success=False, platforms=['a', 'c'])
+        # Not finished, not counted
+        release_id = self.create_release(start, ['p1'])
+        self._create_package(release_id, name='p3')
+
+    def create_release(self, stime, packages, success=True, rollback=False,
+                       user='testuser', team='test team', platforms=None):
+        release_id = self._create_release(
+            user=user, team=team, platforms=platforms or ['a'])
+        release = db.session.query(Release).filter(
+            Release.id == release_id).one()
+        release.stime = stime
+        for name in packages:
+            package_id = self._create_package(
+                release_id, name=name, rollback=rollback)
+            package = db.session.query(Package).filter(
+                Package.id == package_id).one()
+            package.start()
+            package.stime = stime.shift(minutes=+len(name))
+            package.stop(success=success)
+            db.session.commit()
+        return release_id
+
+
+class TestRollups(OrloStatsDataTest):
+    """
+    Test the rollup tables give the same results as counting the releases
+    """
+    def assertRollupsMatch(self, **filters):
+        # The order of the top level keys isn't significant, as jsonify sorts
+        # them
+        for by_time in (orlo.stats.releases_by_time,
+                        orlo.stats.packages_by_time):
+            for unit in orlo.stats.ROLLUP_UNITS:
+                fallback = dict(filters, **self.FALLBACK)
+                self.assertEqual(
+                    dict(by_time(unit, **filters)),
+                    dict(by_time(unit, **fallback)))
+                if unit == 'iso':
+                    continue  # Not an attribute, can't be summarized
+                self.assertEqual(
+                    dict(by_time(unit, summarize_by_unit=True, **filters)),
+                    dict(by_time(unit, summarize_by_unit=True, **fallback)))
+
+    def test_rollups_match(self):
+        self.assertRollupsMatch()
+
+    def test_rollups_match_with_filters(self):
+        self.assertRollupsMatch(platform='b')
+        self.assertRollupsMatch(platform='c')
+        self.assertRollupsMatch(user='alice')
+        self.assertRollupsMatch(team='other team')
+        self.assertRollupsMatch(platform='a', team='test team')
+
+    def test_rollups_match_with_package_name(self):
+        fallback = dict(package_name='p2', **self.FALLBACK)
+        self.assertEqual(
+            dict(orlo.stats.packages_by_time('day', package_name='p2')),
+            dict(orlo.stats.packages_by_time('day', **fallback)))
+
+    def test_rollups_are_used(self):
+        """
+        Test the rollups answer queries without a time filter
+        """
+        db.session.query(ReleaseRollup).update({'count': 10})
+        result = orlo.stats.releases_by_time('year', platform='b')
+        self.assertEqual(10, result['2016']['normal']['successful'])
+
+    def test_rollups_follow_status(self):
+        """
+        Test a finished release which gets a new package is no longer counted
+        """
+        release_id = self.create_release(arrow.get(2017, 3, 1), ['p1'])
+        self.assertEqual(
+            1, orlo.stats.releases_by_time('month')['2017']['3']
+            ['normal']['successful'])
+        self._create_package(release_id, name='p4')
+        self.assertNotIn('3', orlo.stats.releases_by_time('month')['2017'])
+        self.assertRollupsMatch()
+
+    def test_rollups_follow_platforms(self):
+        release = db.session.query(Release).filter(
+            Release.user == 'alice').one()
+        release.platforms = append_or_create_platforms(['c'])
+        db.session.commit()
+        self.assertRollupsMatch(platform='b')
+        self.assertRollupsMatch(platform='c')
+
+    def test_refresh_rollups(self):
+        """
+        Test rebuilding the rollups gives the same counts
+        """
+        def counts():
+            return sorted(
+                (r.bucket, r.platform or '', r.team, r.user, r.status,
+                 r.rollback, r.count) for r in db.session.query(ReleaseRollup))
+        before = counts()
+        refresh_rollups(db.session)
+        self.assertEqual(before, counts())
+        self.assertRollupsMatch()
+
+    def test_refresh_rollups_buckets(self):
+        """
+        Test refreshing some buckets only reads and replaces those buckets
+        """
+        start = arrow.get(2016, 12, 31, 22, 30)
+        buckets = {rollup_bucket(start), rollup_bucket(start.shift(days=+40))}
+        other = db.session.query(ReleaseRollup).filter(
+            ReleaseRollup.bucket == rollup_bucket(start.shift(days=+9))).all()
+        for rollup in other:
+            rollup.count = 99
+        db.session.commit()
+        ReleaseRollup.query.filter(
+            ReleaseRollup.bucket.in_(buckets)).delete(synchronize_session=False)
+
+        with patch('orlo.orm.rollup_bucket', wraps=rollup_bucket) as mock:
+            refresh_rollups(db.session, buckets)
+        scanned = set(rollup_bucket(c[0][0]) for c in mock.call_args_list)
+        self.assertEqual(buckets, scanned)
+
+        self.assertEqual([99] * len(other), [r.count for r in other])
+        for rollup in other:
+            rollup.count = 1
+        self.assertRollupsMatch()
+
+    def test_rollup_key_unique(self):
+        """
+        Test a second row with the same key, including an empty platform, is
+        rejected
+        """
+        row = db.session.query(ReleaseRollup).filter(
+            ReleaseRollup.platform == '').first()
+        table = ReleaseRollup.__table__
+        connection = db.session.connection()
+        savepoint = connection.begin_nested()
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            connection.execute(table.insert().values(count=1, **dict(
+                (k, getattr(row, k)) for k in RELEASE_ROLLUP_KEYS)))
+        savepoint.rollback()
+
+    def test_apply_rollup_deltas_race(self):
+        """
+        Test a row inserted by another process between the update and the
+        insert is updated rather than duplicated
+        """
+        table = ReleaseRollup.__table__
+        key = (datetime.datetime(2017, 6, 1), '', 'team', 'user',
+               'SUCCESSFUL', False)
+        session = RacingSession(
+            db.session, table.insert().values(
+                count=5, **dict(zip(RELEASE_ROLLUP_KEYS, key))))
+        apply_rollup_deltas(session, table, RELEASE_ROLLUP_KEYS, {key: 2})
+        rows = db.session.query(ReleaseRollup).filter(
+            ReleaseRollup.bucket == key[0]).all()
+        self.assertEqual([7], [r.count for r in rows])
+
+
+class RacingSession(object):
+    """
+    Session whose connection runs another process's insert just after the
+    first update
+    """
+    def __init__(self, session, insert):
+        self.session = session
+        self.insert = insert
+
+    def connection(self):
+        return RacingConnection(self.session.connection(), self)
+
+
+class RacingConnection(object):
+    def __init__(self, connection, racing_session):
+        self.connection = connection
+        self.racing_session = racing_session
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def execute(self, statement, *args, **kwargs):
+        result = self.connection.execute(statement, *args, **kwargs)
+        insert = self.racing_session.insert
+        if insert is not None and \
+                isinstance(statement, sqlalchemy.sql.expression.Update):
+            self.racing_session.insert = None
+            self.connection.execute(insert)
+        return result
+
+
+class TestBucketRanges(TestCase):
+    def test_bucket_ranges(self):
+        hour = datetime.timedelta(hours=1)
+        start = datetime.datetime(2016, 1, 1)
+        buckets = [start + hour * i for i in (5, 0, 1, 2, 9)]
+        self.assertEqual(
+            [[(start, start + hour * 3),
+              (start + hour * 5, start + hour * 6)],
+             [(start + hour * 9, start + hour * 10)]],
+            list(bucket_ranges(buckets, chunk=2)))
+
+
+class TestTimeBucketing(OrloStatsDataTest):
+    """
+    Test counting by time in SQL gives the same results as fetching the rows
+    """
+    def assertBucketsMatch(self, **filters):
+        filters.update(self.FALLBACK)
+        for by_time in (orlo.stats.releases_by_time,
+                        orlo.stats.packages_by_time):
+            for unit in orlo.stats.TRUNCATE_UNITS:
+                summarize = [False]
+                if unit in orlo.stats.SUMMARY_TRUNCATE_UNITS:
+                    summarize.append(True)
+                for summarize_by_unit in summarize:
+                    in_sql = by_time(unit, summarize_by_unit, **filters)
+                    with patch('orlo.stats.truncate_time', return_value=None):
+                        rows = by_time(unit, summarize_by_unit, **filters)
+                    self.assertEqual(dict(rows), dict(in_sql))
+
+    def test_buckets_match(self):
+        self.assertBucketsMatch()
+
+    def test_buckets_match_with_filters(self):
+        self.assertBucketsMatch(platform='b')
+        self.assertBucketsMatch(package_name='p2')
+
+    def test_truncate_time(self):
+        """
+        Test truncate_time on this database
+        """
+        expected = {
+            'year': arrow.get(2016, 1, 1),
+            'month': arrow.get(2016, 12, 1),
+            'day': arrow.get(2016, 12, 31),
+            'hour': arrow.get(2016, 12, 31, 22),
+        }
+        stime = db.session.query(db.func.min(Release.stime)).subquery()
+        for unit, value in expected.items():
+            truncated = orlo.stats.truncate_time(
+                list(stime.c)[0], unit, db.engine.dialect.name)
+            self.assertEqual(value, db.session.query(truncated).scalar())
+
+    def test_truncate_time_unsupported_dialect(self):
+        self.assertIs(
+            orlo.stats.truncate_time(Release.stime, 'day', 'oracle'), None)
+
+
+class TestTimeBucketingBenchmark(OrloDbTest):
+    """
+    Compare counting by time in SQL with fetching every row
+    """
+    RELEASES = 1000
+
+    def setUp(self):
+        super(OrloDbTest, self).setUp()
+        start = arrow.get(2016, 1, 1)
+        releases = []
+        for i in range(self.RELEASES):
+            stime = start.shift(hours=i * 7).isoformat()
+            releases.append({
+                'platforms': ['test_platform'],
+                'stime': stime,
+                'user': 'testuser',
+                'packages': [
+                    {'name': name, 'version': '1.0.0', 'stime': stime,
+                     'status': 'SUCCESSFUL' if i % 5 else 'FAILED',
+                     'rollback': i % 7 == 0}
+                    for name in ('p1', 'p2')
+                ],
+            })
+        response = self.client.post(
+            '/releases/import?bulk=true', data=json.dumps(releases),
+            content_type='application/json')
+        self.assert200(response)
+
+    def test_benchmark_time_bucketing(self):
+        def in_sql():
+            return orlo.stats.packages_by_time(
+                'day', **OrloStatsDataTest.FALLBACK)
+
+        def rows():
+            with patch('orlo.stats.truncate_time', return_value=None):
+                return orlo.stats.packages_by_time(
+                    'day', **OrloStatsDataTest.FALLBACK)
+
+        self.assertEqual(dict(in_sql()), dict(rows()))
+        sql_time = min(timeit.repeat(in_sql, number=3, repeat=3))
+        rows_time = min(timeit.repeat(rows, number=3, repeat=3))
+        print('{} releases by day: rows {:.3f}s, in SQL {:.3f}s'.format(
+            self.RELEASES, rows_time, sql_time))
+        # The timings are close enough to be noisy, so check that far fewer
+        # rows are fetched
+        query = db.session.query(Package.id, Package.stime)
+        counted = list(orlo.stats.count_objects_by_time(query, 'day'))
+        self.assertEqual(query.count(), sum(r.count for r in counted))
+        self.assertLess(len(counted) * 2, query.count())
+
+    def test_benchmark_categories(self):
+        """
+        Compare counting the four categories in one query with one each
+        """
+        def query():
+            return db.session.query(Package.id, Package.name, Package.stime) \
+                .join(Release)
+
+        def one_query():
+            return orlo.stats.get_dict_of_objects_by_time(query(), 'day')
+
+        def four_queries():
+            output_dict = OrderedDict()
+            for t_category, rollback, status in orlo.stats.TIME_CATEGORIES:
+                orlo.stats.add_objects_by_time_to_dict(
+                    query().filter(Release.has_rollback == rollback,
+                                   Release.status == status),
+                    output_dict, t_category, 'day')
+            return output_dict
+
+        self.assertEqual(dict(one_query()), dict(four_queries()))
+        one_time = min(timeit.repeat(one_query, number=5, repeat=3))
+        four_time = min(timeit.repeat(four_queries, number=5, repeat=3))
+        print('{} releases by day: four queries {:.3f}s, one query '
+              '{:.3f}s'.format(self.RELEASES, four_time, one_time))
+        # With the release status columns indexed, the four queries are
+        # cheap, so the timings are close. Check the number of queries.
+        self.assertEqual(1, self.count_statements(one_query))
+        self.assertEqual(4, self.count_statements(four_queries))
+
+    @staticmethod
+    def count_statements(func):
+        with CaptureStatements(select_only=True) as captured:
+            func()
+        return len(captured.statements)
+
+
+def append_tree_recursive(tree, parent, nodes, node_index=0):
+    """
+    The recursive append_tree_recursive which orlo.stats used to have, less
+    its debug logging, to compare with
+    """
+    child_index = node_index + 1
+    try:
+        child = nodes[child_index]
+    except IndexError:
+        tree[parent] = tree.get(parent, 0) + 1
+        return tree
+    if parent not in tree:
+        tree[parent] = {}
+    append_tree_recursive(tree[parent], child, nodes, node_index=child_index)
+
+
+def arrow_time_tree_args(stime, unit, summarize_by_unit=False):
+    """
+    time_tree_args as orlo.stats used to have it, reading from the Arrow
+    """
+    if summarize_by_unit:
+        return [str(getattr(stime, unit))]
+    if unit == 'year':
+        return [str(stime.year)]
+    elif unit == 'month':
+        return [str(stime.year), str(stime.month)]
+    elif unit == 'week':
+        return [str(i) for i in stime.isocalendar()][0:2]
+    elif unit == 'iso':
+        return [str(i) for i in stime.isocalendar()]
+    elif unit == 'day':
+        return [str(stime.year), str(stime.month), str(stime.day)]
+    elif unit == 'hour':
+        return [str(stime.year), str(stime.month), str(stime.day),
+                str(stime.hour)]
+
+
+class TestTimeTree(TestCase):
+    """
+    Compare building the stats tree with time_tree_args and add_to_tree
+    against the recursive append_tree_recursive
+    """
+    ROWS = 2000
+    category = ['normal', 'successful']
+
+    @classmethod
+    def setUpClass(cls):
+        start = datetime.datetime(2016, 1, 1)
+        cls.rows = [
+            (arrow.Arrow.fromdatetime(start + datetime.timedelta(minutes=i * 7)),
+             'p{}'.format(i % 5))
+            for i in range(cls.ROWS)]
+
+    def test_same_tree(self):
+        units = [(u, False) for u in orlo.stats.TRUNCATE_UNITS] + \
+            [(u, True) for u in orlo.stats.SUMMARY_TRUNCATE_UNITS]
+        for unit, summarize_by_unit in units:
+            recursive = OrderedDict()
+            flat = OrderedDict()
+            for stime, name in self.rows:
+                nodes = arrow_time_tree_args(stime, unit, summarize_by_unit) \
+                    + [name] + self.category
+                append_tree_recursive(recursive, nodes[0], nodes)
+                nodes = orlo.stats.time_tree_args(
+                    stime, unit, summarize_by_unit) + [name] + self.category
+                orlo.stats.add_to_tree(flat, nodes, 1)
+            self.assertEqual(recursive, flat, unit)
+
+    def test_not_logged_per_row(self):
+        """
+        Test the tree is not formatted into a debug message for each row,
+        which made building it quadratic
+        """
+        tree = {}
+        with patch('orlo.stats.app.logger.debug') as debug:
+            for stime, _ in self.rows:
+                nodes = orlo.stats.time_tree_args(stime, 'day')
+                orlo.stats.append_tree_recursive(tree, nodes[0], nodes)
+        self.assertFalse(debug.called)
+        self.assertEqual(self.ROWS, sum(
+            count for months in tree.values() for days in months.values()
+            for count in days.values()))
@@ -0,0 +1,352 @@
+from __future__ import print_function, unicode_literals
+import base64
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from werkzeug.security import generate_password_hash
+import ldap
+import orlo.user_auth
+from orlo.exceptions import OrloAuthError
+from orlo.user_auth import LdapPool, PasswordFile, credential_digest, \
+    verify_ldap_access, verify_password_file
+from test_base import ConfigChange
+from test_route_base import OrloHttpTest
+
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
+__author__ = 'alforbes'
+
+
+class PasswordFileTest(object):
+    """
+    Mixin to write a passwd_file to a temporary directory
+    """
+    def make_passwd_file(self, users):
+        self.passwd_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.passwd_dir)
+        self.passwd_file = os.path.join(self.passwd_dir, 'passwd')
+        self.write_passwd_file(users)
+        return self.passwd_file
+
+    def write_passwd_file(self, users):
+        with open(self.passwd_file, 'w') as f:
+            for user, password in users:
+                f.write('{}:{}\n'.format(
+                    user, generate_password_hash(password, 'pbkdf2:sha256:1')))
+
+
+class TestPasswordFile(TestCase, PasswordFileTest):
+    def setUp(self):
+        self.password_file = PasswordFile(self.make_passwd_file(
+            [('userOne', 'one'), ('userTwo', 'two'), ('userOne', 'other')]))
+
+    def test_password_hash(self):
+        self.assertTrue(
+            self.password_file.password_hash('userTwo').startswith('pbkdf2'))
+        self.assertIsNone(self.password_file.password_hash('userThree'))
+
+    def test_first_entry_wins(self):
+        with ConfigChange('security', 'passwd_file', self.passwd_file):
+            self.assertTrue(verify_password_file('userOne', 'one'))
+            self.assertFalse(verify_password_file('userOne', 'other'))
+            self.assertIsNone(verify_password_file('userThree', 'three'))
+
+    def test_not_reparsed(self):
+        self.password_file.load()
+        with patch('orlo.user_auth.open', create=True) as mock_open:
+            self.password_file.password_hash('userOne')
+        self.assertFalse(mock_open.called)
+
+    def test_reloaded_on_change(self):
+        self.password_file.load()
+        self.write_passwd_file([('userThree', 'three')])
+        # Make sure the modification time changes
+        stat = os.stat(self.passwd_file)
+        os.utime(self.passwd_file, (stat.st_atime, stat.st_mtime + 1))
+        self.assertIsNone(self.password_file.password_hash('userOne'))
+        self.assertIsNotNone(self.password_file.password_hash('userThree'))
+
+    def test_reload_clears_verified_credentials(self):
+        self.addCleanup(orlo.user_auth.verified_credentials.clear)
+        self.password_file.load()
+        orlo.user_auth.verified_credentials.set('digest', 'userOne', 60)
+        self.password_file.load()
+        self.assertEqual('userOne',
+                         orlo.user_auth.verified_credentials.get('digest'))
+
+        os.remove(self.passwd_file)
+        with self.assertRaises(OSError):
+            self.password_file.load()
+        self.assertIsNone(orlo.user_auth.verified_credentials.get('digest'))
+
+
+class TestCredentialDigest(TestCase):
+    def test_digest(self):
+        digest = credential_digest('user', 'password')
+        self.assertEqual(64, len(digest))
+        self.assertNotIn('password', digest)
+        self.assertEqual(digest, credential_digest('user', 'password'))
+        self.assertNotEqual(digest, credential_digest('user', 'passwore'))
+        # The separator keeps the username and password apart
+        self.assertNotEqual(credential_digest('ab', 'c'),
+                            credential_digest('a', 'bc'))
+
+    def test_keyed_by_secret(self):
+        digest = credential_digest('user', 'password')
+        with ConfigChange('security', 'secret_key', 'another secret'):
+            self.assertNotEqual(digest, credential_digest('user', 'password'))
+
+
+class AuthTest(OrloHttpTest, PasswordFileTest):
+    """
+    Make authenticated requests against a passwd_file
+    """
+    def setUp(self):
+        super(AuthTest, self).setUp()
+        orlo.user_auth.verified_credentials.entries.clear()
+        self.make_passwd_file([('userOne', 'one')])
+        self.config_changes = [
+            ConfigChange('security', 'enabled', 'true'),
+            ConfigChange('security', 'secret_key', 'not the default'),
+            ConfigChange('security', 'passwd_file', self.passwd_file),
+        ]
+        for change in self.config_changes:
+            change.__enter__()
+
+    def tearDown(self):
+        for change in reversed(self.config_changes):
+            change.__exit__(None, None, None)
+        orlo.user_auth.verified_credentials.entries.clear()
+        super(AuthTest, self).tearDown()
+
+    def get_token(self, username='userOne', password='one'):
+        credentials = base64.b64encode(
+            '{}:{}'.format(username, password).encode('utf-8'))
+        return self.client.get('/token', headers={
+            'Authorization': 'Basic ' + credentials.decode('utf-8')})
+
+
+@patch('orlo.user_auth.verify_ldap_access', return_value=False)
+class TestVerificationCache(AuthTest):
+    def test_login_is_cached(self, mock_ldap):
+        self.assert200(self.get_token())
+        with patch('orlo.user_auth.check_password_hash') as check:
+            self.assert200(self.get_token())
+        self.assertFalse(check.called)
+
+    def test_bad_login_is_not_cached(self, mock_ldap):
+        self.assert401(self.get_token(password='wrong'))
+        self.assertEqual({}, orlo.user_auth.verified_credentials.entries)
+        self.assert401(self.get_token(password='wrong'))
+
+    def test_cache_holds_digest(self, mock_ldap):
+        self.get_token()
+        key, = orlo.user_auth.verified_credentials.entries
+        self.assertEqual(credential_digest('userOne', 'one'), key)
+
+    def test_cache_disabled(self, mock_ldap):
+        with ConfigChange('security', 'auth_cache_ttl', '0'):
+            self.assert200(self.get_token())
+        self.assertEqual({}, orlo.user_auth.verified_credentials.entries)
+
+    def test_passwd_file_change_clears_cache(self, mock_ldap):
+        self.assert200(self.get_token())
+        self.write_passwd_file([('userOne', 'changed')])
+        # Make sure the modification time changes
+        stat = os.stat(self.passwd_file)
+        os.utime(self.passwd_file, (stat.st_atime, stat.st_mtime + 1))
+        self.assert401(self.get_token())
+        self.assert200(self.get_token(password='changed'))
+
+    def test_ldap_login_is_cached(self, mock_ldap):
+        mock_ldap.return_value = True
+        self.assert200(self.get_token('ldapUser', 'secret'))
+        self.assertEqual(1, mock_ldap.call_count)
+        self.assert200(self.get_token('ldapUser', 'secret'))
+        self.assertEqual(1, mock_ldap.call_count)
+
+
+@patch('orlo.user_auth.verify_ldap_access', return_value=False)
+class TestVerificationCacheHashes(AuthTest):
+    """
+    Compare the password hashes checked by password authenticated requests
+    with and without the verification cache
+    """
+    REQUESTS = 20
+
+    def _hashes_checked(self):
+        with patch('orlo.user_auth.check_password_hash',
+                   wraps=orlo.user_auth.check_password_hash) as check:
+            for _ in range(self.REQUESTS):
+                self.assert200(self.get_token())
+        return check.call_count
+
+    def test_verification_cache_hashes(self, mock_ldap):
+        with ConfigChange('security', 'auth_cache_ttl', '0'):
+            self.assertEqual(self.REQUESTS, self._hashes_checked())
+        self.assertEqual(1, self._hashes_checked())
+
+
+class FakeLdapConnection(object):
+    """
+    Stands in for an ldap connection, accepting the passwords in users
+    """
+    def __init__(self, users, down=False):
+        self.users = users
+        self.down = down
+        self.binds = 0
+        self.whoamis = 0
+        self.unbound = False
+        self.options = {}
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def whoami_s(self):
+        self.whoamis += 1
+        if self.down:
+            raise ldap.SERVER_DOWN('down')
+        return ''
+
+    def simple_bind_s(self, who, password):
+        self.binds += 1
+        if self.down:
+            raise ldap.SERVER_DOWN('down')
+        if self.users.get(who) != password:
+            raise ldap.INVALID_CREDENTIALS('bad password')
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+class LdapTest(TestCase):
+    USERS = {'uid=ldapUser,ou=people,ou=example,o=test': 'secret'}
+
+    def setUp(self):
+        self.connections = []
+        patcher = patch('orlo.user_auth.ldap.initialize',
+                        side_effect=self.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def initialize(self, uri):
+        connection = FakeLdapConnection(self.USERS)
+        self.connections.append(connection)
+        return connection
+
+
+class TestLdapPool(LdapTest):
+    DN = 'uid=ldapUser,ou=people,ou=example,o=test'
+
+    def setUp(self):
+        super(TestLdapPool, self).setUp()
+        self.now = 1000.0
+        self.pool = LdapPool('ldap://localhost:389', size=2, timeout=0.1,
+                             check_interval=60, clock=lambda: self.now)
+
+    def test_connection_is_reused(self):
+        self.assertTrue(self.pool.simple_bind(self.DN, 'secret'))
+        self.assertTrue(self.pool.simple_bind(self.DN, 'secret'))
+        self.assertEqual(1, len(self.connections))
+        self.assertEqual(2, self.connections[0].binds)
+
+    def test_invalid_credentials(self):
+        self.assertFalse(self.pool.simple_bind(self.DN, 'wrong'))
+        self.assertFalse(self.connections[0].unbound)
+        self.assertEqual(1, len(self.pool.idle))
+
+    def test_timeouts_are_set(self):
+        self.pool.simple_bind(self.DN, 'secret')
+        self.assertEqual(0.1, self.connections[0].options[
+            ldap.OPT_NETWORK_TIMEOUT])
+        self.assertEqual(0.1, self.connections[0].options[ldap.OPT_TIMEOUT])
+
+    def test_server_error_discards_connection(self):
+        self.pool.simple_bind(self.DN, 'secret')
+        self.connections[0].down = True
+        with self.assertRaises(ldap.SERVER_DOWN):
+            self.pool.simple_bind(self.DN, 'secret')
+        self.assertTrue(self.connections[0].unbound)
+        self.assertEqual([], self.pool.idle)
+
+    def test_idle_connection_is_checked(self):
+        self.pool.simple_bind(self.DN, 'secret')
+        self.pool.simple_bind(self.DN, 'secret')
+        self.assertEqual(0, self.connections[0].whoamis)
+
+        self.now += 61
+        self.pool.simple_bind(self.DN, 'secret')
+        self.assertEqual(1, self.connections[0].whoamis)
+        self.assertEqual(1, len(self.connections))
+
+    def test_unhealthy_connection_is_replaced(self):
+        self.pool.simple_bind(self.DN, 'secret')
+        self.connections[0].down = True
+        self.now += 61
+        self.assertTrue(self.pool.simple_bind(self.DN, 'secret'))
+        self.assertEqual(2, len(self.connections))
+        self.assertTrue(self.connections[0].unbound)
+
+    def test_size_is_bounded(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        with self.assertRaises(OrloAuthError):
+            self.pool.acquire()
+        self.pool.release(first)
+        self.assertIs(first, self.pool.acquire())
+        self.pool.release(first)
+        self.pool.release(second)
+
+
+class TestVerifyLdapAccess(LdapTest):
+    def setUp(self):
+        super(TestVerifyLdapAccess, self).setUp()
+        orlo.user_auth.ldap_pool = None
+        orlo.user_auth.rejected_credentials.entries.clear()
+        self.config_changes = [
+            ConfigChange('security', 'ldap_server', 'localhost'),
+            ConfigChange('security', 'user_base_dn',
+                         'ou=people,ou=example,o=test'),
+        ]
+        for change in self.config_changes:
+            change.__enter__()
+
+    def tearDown(self):
+        for change in reversed(self.config_changes):
+            change.__exit__(None, None, None)
+        orlo.user_auth.ldap_pool = None
+
+    def binds(self):
+        return sum(c.binds for c in self.connections)
+
+    def test_verify(self):
+        self.assertTrue(verify_ldap_access('ldapUser', 'secret'))
+        self.assertTrue(verify_ldap_access('ldapUser', 'secret'))
+        self.assertEqual(1, len(self.connections))
+
+    def test_empty_password(self):
+        self.assertFalse(verify_ldap_access('ldapUser', ''))
+        self.assertEqual(0, self.binds())
+
+    def test_failure_is_cached(self):
+        self.assertFalse(verify_ldap_access('ldapUser', 'wrong'))
+        self.assertFalse(verify_ldap_access('ldapUser', 'wrong'))
+        self.assertEqual(1, self.binds())
+        self.assertTrue(verify_ldap_access('ldapUser', 'secret'))
+
+    def test_failure_cache_disabled(self):
+        with ConfigChange('security', 'ldap_failure_ttl', '0'):
+            self.assertFalse(verify_ldap_access('ldapUser', 'wrong'))
+            self.assertFalse(verify_ldap_access('ldapUser', 'wrong'))
+        self.assertEqual(2, self.binds())
+
+    def test_server_error_is_not_cached(self):
+        self.assertTrue(verify_ldap_access('ldapUser', 'secret'))
+        self.connections[0].down = True
+        self.assertFalse(verify_ldap_access('ldapUser', 'secret'))
+        self.assertTrue(verify_ldap_access('ldapUser', 'secret'))
+        self.assertEqual(2, len(self.connections))
@@ -1,7 +1,18 @@
 from __future__ import print_function
 from unittest import TestCase
+from flask import json
+import arrow
+import base64
+import uuid
+import orlo
+import orlo.exceptions
 import orlo.util
 
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
 __author__ = 'alforbes'
 
 
@@ -19,3 +30,111 @@ class TestUtil(TestCase):
         """
         for v in ['false', 'FaLsE', 'f', '0', '-99', 0, -99]:
             self.assertIs(orlo.util.str_to_bool(v), False)
+
+    def test_cursor_round_trip(self):
+        """
+        Test that decode_cursor returns what was given to encode_cursor
+        """
+        stime = arrow.get('2016-01-01T09:30:00.123456+00:00')
+        object_id = uuid.uuid4()
+        cursor = orlo.util.encode_cursor(stime, object_id)
+        self.assertEqual(orlo.util.decode_cursor(cursor), (stime, object_id))
+
+    def test_cursor_round_trip_no_stime(self):
+        """
+        Test a cursor for an object which has not started
+        """
+        object_id = uuid.uuid4()
+        cursor = orlo.util.encode_cursor(None, object_id)
+        self.assertEqual(orlo.util.decode_cursor(cursor), (None, object_id))
+
+    def test_decode_cursor_invalid(self):
+        """
+        Test that an invalid cursor raises InvalidUsage
+        """
+        non_string_id = base64.urlsafe_b64encode(
+            b'["2016-01-01T00:00:00", 1]').decode('ascii')
+        for cursor in ['foo', 'WyJmb28iXQ==', '', non_string_id]:
+            with self.assertRaises(orlo.exceptions.InvalidUsage):
+                orlo.util.decode_cursor(cursor)
+
+
+class TestCompactEncoder(TestCase):
+    """
+    Compare the streaming serializer with flask's json.dumps
+    """
+    ROWS = 20
+
+    row = {
+        'id': str(uuid.uuid4()),
+        'packages': [{
+            'id': str(uuid.uuid4()),
+            'name': 'test-package',
+            'version': '1.2.3',
+            'stime': '2016-01-01T09:00:00Z',
+            'ftime': '2016-01-01T09:10:00Z',
+            'duration': 600,
+            'rollback': False,
+            'status': 'SUCCESSFUL',
+            'diff_url': None,
+            'release_id': uuid.uuid4(),
+        }] * 3,
+        'platforms': ['test_platform'],
+        'references': ['TestTicket-123'],
+        'stime': '2016-01-01T09:00:00Z',
+        'ftime': '2016-01-01T09:30:00Z',
+        'duration': 1800,
+        'metadata': {'env': 'test'},
+        'user': 'testuser',
+        'team': 'test team',
+        'notes': ['test note lorem ipsum'],
+    }
+
+    def test_compact_encoder_output(self):
+        """
+        Test that the compact encoder produces the same document
+        """
+        with orlo.app.app_context():
+            self.assertEqual(
+                json.loads(json.dumps(self.row)),
+                json.loads(orlo.util.compact_encoder.encode(self.row)))
+
+    def test_compact_encoder_smaller(self):
+        """
+        Test that the compact encoder leaves out the whitespace
+        """
+        with orlo.app.app_context():
+            flask_json = json.dumps(self.row)
+            compact_json = orlo.util.compact_encoder.encode(self.row)
+        self.assertNotIn(', "', compact_json)
+        self.assertNotIn('": ', compact_json)
+        self.assertLess(len(compact_json), len(flask_json))
+
+    def test_stream_skips_flask_json(self):
+        """
+        Test that streamed rows are encoded once each by the compact encoder,
+        without flask's json.dumps, which sorts the keys and looks up the
+        app's encoder for every row
+        """
+        rows = [Row(self.row) for _ in range(self.ROWS)]
+        encode = orlo.util.compact_encoder.encode
+        with orlo.app.app_context():
+            with patch('orlo.util.json.dumps') as dumps, \
+                    patch.object(orlo.util.compact_encoder, 'encode',
+                                 side_effect=encode) as compact:
+                document = ''.join(
+                    orlo.util.stream_json_list('releases', rows))
+        self.assertFalse(dumps.called)
+        self.assertEqual(self.ROWS, compact.call_count)
+        self.assertEqual(self.ROWS, len(json.loads(document)['releases']))
+
+
+class Row(object):
+    """
+    Stands in for a Release in stream_json_list
+    """
+    def __init__(self, document):
+        self.document = document
+
+    def to_dict(self, fields=None):
+        return self.document